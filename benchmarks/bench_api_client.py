@@ -0,0 +1,77 @@
+"""
+Page fetching benchmark against a local replay of recorded ClinicalTrials.gov pages.
+
+Compares the original approach (bare requests.get, full response.json()) with the pooled session
+and streaming parser of ClinicalTrialsAPIClient.
+
+    python -m benchmarks.bench_api_client --pages 10
+    python -m benchmarks.bench_api_client --pages-dir benchmarks/data/pages
+"""
+import argparse
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+
+import requests
+
+from benchmarks.recordings import synthesize_pages
+from benchmarks.servers import ReplayServer
+from clients.api_client import ClinicalTrialsAPIClient
+
+
+def fetch_with_bare_requests(url, start_date, end_date):
+    params = ClinicalTrialsAPIClient(base_url=url)._build_params(start_date, end_date)
+    while True:
+        data = requests.get(url, params=params).json()
+        yield data.get("studies", [])
+        if not data.get("nextPageToken"):
+            return
+        params["pageToken"] = data["nextPageToken"]
+        time.sleep(0.1)  # Same rate limiting as fetch_trials
+
+
+def fetch_with_client(url, start_date, end_date):
+    client = ClinicalTrialsAPIClient(base_url=url)
+    for page in client._fetch_pages(start_date, end_date):
+        yield page
+
+
+def stream_with_client(url, start_date, end_date):
+    client = ClinicalTrialsAPIClient(base_url=url)
+    # One study at a time, nothing holds a full page
+    for study in client.stream_studies(start_date, end_date):
+        yield [study]
+
+
+def measure(name, fetch, server):
+    server.connections.clear()
+    tracemalloc.start()
+    started = time.perf_counter()
+    first_study_at = None
+    studies = 0
+    for page in fetch(server.url, date(2024, 10, 20), date(2024, 10, 22)):
+        if first_study_at is None and page:
+            first_study_at = time.perf_counter() - started
+        studies += len(page)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>14}: {studies / elapsed:8.0f} studies/s, first study after {first_study_at * 1000:6.1f} ms, "
+          f"peak {peak / 2 ** 20:6.1f} MiB, {len(server.connections)} connections")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages-dir", help="recorded pages, synthesized in a temporary directory when omitted")
+    parser.add_argument("--pages", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pages_dir = args.pages_dir or tmp_dir
+        if not args.pages_dir:
+            synthesize_pages(pages_dir, pages=args.pages)
+        with ReplayServer(pages_dir) as server:
+            measure("bare requests", fetch_with_bare_requests, server)
+            measure("pooled pages", fetch_with_client, server)
+            measure("pooled stream", stream_with_client, server)
@@ -0,0 +1,66 @@
+"""
+Offline throughput comparison of single-study vs batched disease extraction, and of single-study
+extraction behind the dictionary matcher (LLM only called on low coverage).
+
+    python -m benchmarks.bench_batched_extraction --studies 500 --latency 0.4
+"""
+import argparse
+import random
+import time
+from unittest import mock
+
+import mongomock
+
+from pipelines.trial_pipeline import ClinicalTrialPipeline
+from transformations.fake_llm import FakeDiseaseLLM, KNOWN_DISEASES
+from transformations.trial_transformation import StudyRecord
+
+
+# Not in the bundled vocabulary, studies mentioning them still need the LLM in "matched" mode
+RARE_DISEASES = ["fabry disease", "gaucher disease", "pompe disease", "wilson disease"]
+
+
+def make_studies(count, seed=0):
+    rng = random.Random(seed)
+    studies = []
+    for i in range(count):
+        diseases = rng.sample(KNOWN_DISEASES, 2)
+        if i % 4 == 0:
+            diseases[1] = rng.choice(RARE_DISEASES)
+        studies.append(StudyRecord(
+            trialId=f"NCT{i:08d}",
+            eligibilityCriteria=(
+                "Inclusion Criteria:\n"
+                f"* Adults aged 18 or older with a confirmed diagnosis of {diseases[0]}\n"
+                f"* History of {diseases[1]} treated for at least {rng.randint(1, 24)} months\n"
+                "* Signed informed consent\n\n"
+                "Exclusion Criteria:\n* Pregnancy"
+            ),
+        ))
+    return studies
+
+
+def run(mode, studies, llm, batch_token_budget):
+    with mock.patch("clients.db_client.MongoClient", mongomock.MongoClient):
+        pipeline = ClinicalTrialPipeline(
+            api_source="mocked_api", cache_type=None, checkpoint_type=None, llm=llm,
+            batch_token_budget=batch_token_budget if mode == "batched" else None,
+            match_min_coverage=0.8 if mode == "matched" else None
+        )
+    started = time.perf_counter()
+    pipeline.enrich(studies)
+    elapsed = time.perf_counter() - started
+    print(f"{mode:>8}: {len(studies) / elapsed:8.1f} studies/s, {llm.calls} LLM calls, {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--studies", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.4, help="seconds of fixed latency per LLM call")
+    parser.add_argument("--per-item-latency", type=float, default=0.02, help="extra seconds per batched study")
+    parser.add_argument("--batch-token-budget", type=int, default=3000)
+    args = parser.parse_args()
+
+    for mode in ("single", "batched", "matched"):
+        fake_llm = FakeDiseaseLLM(latency=args.latency, per_item_latency=args.per_item_latency, seed=0)
+        run(mode, make_studies(args.studies), fake_llm, args.batch_token_budget)
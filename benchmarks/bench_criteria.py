@@ -0,0 +1,58 @@
+"""
+CPU stage micro-benchmark: eligibility criteria splitting with the former per-call regex, with
+the precompiled splitter in-process, and with the splitter in a process pool (chunked tasks).
+
+    python -m benchmarks.bench_criteria --studies 20000 --workers 4
+"""
+import argparse
+import random
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+
+from benchmarks.recordings import synthesize_study
+from transformations.eligibility import split_eligibility_batch
+
+
+def legacy_split(eligibility_criteria):
+    inclusion_pattern = r"Inclusion Criteria:(.+?)(?:Exclusion Criteria:|$)"
+    match = re.search(inclusion_pattern, eligibility_criteria, re.DOTALL | re.IGNORECASE)
+    return match.group(1).strip() if match else ""
+
+
+def make_texts(count, seed=0):
+    rng = random.Random(seed)
+    return [
+        synthesize_study(rng, i, 20)["protocolSection"]["eligibilityModule"]["eligibilityCriteria"]
+        for i in range(count)
+    ]
+
+
+def report(mode, count, elapsed):
+    print(f"{mode:>9}: {count / elapsed:10.0f} studies/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--studies", type=int, default=20000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=64)
+    args = parser.parse_args()
+    texts = make_texts(args.studies)
+    chunks = [texts[i:i + args.chunk_size] for i in range(0, len(texts), args.chunk_size)]
+
+    started = time.perf_counter()
+    [legacy_split(text) for text in texts]
+    report("legacy", len(texts), time.perf_counter() - started)
+
+    started = time.perf_counter()
+    list(chain.from_iterable(map(split_eligibility_batch, chunks)))
+    report("inline", len(texts), time.perf_counter() - started)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        # Warm the workers up so process start-up is not measured
+        list(pool.map(split_eligibility_batch, [[]] * args.workers))
+        started = time.perf_counter()
+        list(chain.from_iterable(pool.map(split_eligibility_batch, chunks)))
+        report("pool", len(texts), time.perf_counter() - started)
@@ -0,0 +1,82 @@
+"""
+Scaling of the distributed backfill with the number of worker processes, against a local mongod.
+
+A coordinator enqueues shard jobs, then 1, 2, 4... worker processes drain the queue. Every
+worker runs ClinicalTrialPipeline.run on its jobs, with pages replayed by a local ReplayServer
+(which serves every recorded page for any date range, so all jobs weigh the same) and a
+FakeDiseaseLLM. Everything goes to the clinical_trials_benchmark database, dropped before each round.
+
+    python -m benchmarks.bench_job_queue --mongo-uri mongodb://localhost:27017 --workers 1 2 4
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+
+from benchmarks.bench_pipeline import BENCHMARK_DATABASE, _use_database
+from benchmarks.recordings import synthesize_pages
+from benchmarks.servers import ReplayServer
+from clients.checkpoint_client import MongoCheckpointStore
+from clients.job_queue import MongoJobQueue
+from pipelines.job_worker import JobWorker
+from pipelines.trial_pipeline import ClinicalTrialPipeline
+from transformations.fake_llm import FakeDiseaseLLM
+
+
+def make_pipeline(server_url, latency):
+    pipeline = ClinicalTrialPipeline(
+        cache_type=None, checkpoint_type=None, llm=FakeDiseaseLLM(latency=latency),
+        match_min_coverage=None, requests_per_minute=100_000, tokens_per_minute=100_000_000
+    )
+    pipeline.crawler.base_url = server_url
+    _use_database(pipeline.db_client, BENCHMARK_DATABASE, drop=False)
+    # A job reclaimed from a dead worker resumes from its checkpoint
+    pipeline.checkpoints = MongoCheckpointStore(pipeline.db_client.db)
+    return pipeline
+
+
+def work(server_url, latency, worker_id):
+    pipeline = make_pipeline(server_url, latency)
+    JobWorker(pipeline, MongoJobQueue(pipeline.db_client.db), worker_id=worker_id, poll_interval=0.2).run()
+
+
+def run_round(server_url, workers, jobs, latency):
+    pipeline = ClinicalTrialPipeline(cache_type=None, checkpoint_type=None)
+    _use_database(pipeline.db_client, BENCHMARK_DATABASE)
+    job_queue = MongoJobQueue(pipeline.db_client.db)
+    start_date = date(2024, 1, 1)
+    job_queue.enqueue(pipeline.api_source, [(start_date + timedelta(days=day),) * 2 for day in range(jobs)])
+
+    started = time.perf_counter()
+    processes = [
+        multiprocessing.Process(target=work, args=(server_url, latency, f"bench-{index}")) for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+    counts = job_queue.counts()
+    print(f"{workers:>3} workers: {counts['done'] / elapsed:6.2f} jobs/s, {counts['done']} done, "
+          f"{counts['failed']} failed in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-uri", required=True, help="local mongod shared by every worker")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--jobs", type=int, default=16)
+    parser.add_argument("--pages", type=int, default=2)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds of latency per fake LLM call")
+    args = parser.parse_args()
+    os.environ["MONGO_URI"] = args.mongo_uri
+
+    with tempfile.TemporaryDirectory() as pages_dir:
+        synthesize_pages(pages_dir, pages=args.pages, page_size=args.page_size)
+        # Distinct studies per shard, like the real API, so concurrent jobs never upsert the same trial
+        with ReplayServer(pages_dir, distinct_queries=True) as server:
+            for workers in args.workers:
+                run_round(server.url, workers, args.jobs, args.latency)
@@ -0,0 +1,66 @@
+"""
+LLM client reuse benchmark against a local MockOpenAIServer.
+
+Compares one DiseaseExtractionTransformation per study (each with its own ChatOpenAI and HTTP
+connection pool, as the pipeline used to do) with a single shared extractor on the pooled
+HTTP client. Several pages are extracted in a row to show warm connections being reused.
+
+    python -m benchmarks.bench_llm_client --studies 200 --pages 3 --threads 50 --latency 0.02
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_openai import ChatOpenAI
+
+from benchmarks.servers import MockOpenAIServer
+from transformations.llm_extraction import DiseaseExtractionTransformation
+
+
+def per_study_extractor(_):
+    # Former behaviour: a fresh client, and connection pool, for every study
+    llm = ChatOpenAI(model=DiseaseExtractionTransformation.MODEL_NAME, temperature=0, max_retries=0)
+    return DiseaseExtractionTransformation(llm=llm)
+
+
+def measure(name, get_extractor, server, studies, pages, threads):
+    server.connections.clear()
+    latencies = []
+    errors = []
+
+    def extract(index):
+        started = time.perf_counter()
+        try:
+            get_extractor(index).extract(f"Adults with asthma, study {index}")
+        except Exception as e:
+            errors.append(e)
+            return
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in range(pages):
+            list(executor.map(extract, range(studies)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name:>10}: {len(latencies) / elapsed:7.0f} studies/s, p50 {p50 * 1000:6.1f} ms, p99 {p99 * 1000:6.1f} ms, "
+          f"{len(server.connections)} connections, {len(errors)} errors")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--studies", type=int, default=200, help="studies per page")
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the mock server takes to answer")
+    args = parser.parse_args()
+
+    with MockOpenAIServer(answer="asthma", latency=args.latency) as server:
+        os.environ["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY") or "sk-benchmark"
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        measure("per study", per_study_extractor, server, args.studies, args.pages, args.threads)
+        shared = DiseaseExtractionTransformation(max_connections=args.threads)
+        measure("shared", lambda _: shared, server, args.studies, args.pages, args.threads)
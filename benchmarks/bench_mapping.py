@@ -0,0 +1,130 @@
+"""
+Mapping micro-benchmark on recorded (or synthesized) ClinicalTrials.gov pages.
+
+Each mode runs in its own process so peak RSS is comparable:
+  legacy  - the former dict-of-dicts mapping over fully loaded pages
+  records - StudyRecord mapping over fully loaded pages
+  stream  - StudyRecord mapping fed by the streaming page parser, no page is ever fully loaded
+
+    python -m benchmarks.bench_mapping --pages 40
+    python -m benchmarks.bench_mapping --pages-dir benchmarks/data/pages
+"""
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import islice
+
+from benchmarks.recordings import synthesize_pages
+from clients.json_stream import StreamingPageParser
+from transformations.trial_transformation import ClinicalTrialTransformationMapping
+
+
+def legacy_transform(raw_studies):
+    """Mapping as it was before StudyRecord (content hash included), kept here as the baseline."""
+    structured_studies = []
+    for study in raw_studies:
+        protocol_section = study.get('protocolSection', {})
+        identification_module = protocol_section.get('identificationModule', {})
+        status_module = protocol_section.get('statusModule', {})
+        design_module = protocol_section.get('designModule', {})
+        contacts_locations_module = protocol_section.get('contactsLocationsModule', {})
+        eligibility_module = protocol_section.get('eligibilityModule', {})
+        overall_officials = contacts_locations_module.get('overallOfficials', [])
+        pi_info = next((
+            official for official in overall_officials
+            if official.get('role', '').upper() == 'PRINCIPAL_INVESTIGATOR'
+        ), {})
+        locations = contacts_locations_module.get('locations', [])
+        structured_study = {
+            "trialId": identification_module.get('nctId', 'Unknown'),
+            "title": identification_module.get('briefTitle', 'Unknown'),
+            "startDate": (status_module.get('startDateStruct') or {}).get('date', 'Unknown'),
+            "endDate": (status_module.get('completionDateStruct') or {}).get('date', 'Unknown'),
+            "phase": design_module.get('phases', ['Unknown']),
+            "principalInvestigator": {
+                "name": pi_info.get('name', 'Unknown'),
+                "affiliation": pi_info.get('affiliation', 'Unknown'),
+            },
+            "locations": [
+                {
+                    "facility": location.get('facility', 'Unknown'),
+                    "city": location.get('city', 'Unknown'),
+                    "country": location.get('country', 'Unknown'),
+                } for location in locations
+            ] if locations else [{"facility": "Unknown", "city": "Unknown", "country": "Unknown"}],
+            "eligibilityCriteria": eligibility_module.get('eligibilityCriteria', 'Unknown'),
+        }
+        structured_study["contentHash"] = hashlib.sha256(
+            json.dumps(structured_study, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        structured_studies.append(structured_study)
+    return structured_studies
+
+
+def page_files(pages_dir):
+    return [os.path.join(pages_dir, name) for name in sorted(os.listdir(pages_dir)) if name.startswith("page_")]
+
+
+def iter_loaded_pages(pages_dir):
+    for path in page_files(pages_dir):
+        with open(path) as page_file:
+            yield json.load(page_file).get("studies", [])
+
+
+def iter_streamed_studies(pages_dir):
+    for path in page_files(pages_dir):
+        with open(path, "rb") as page_file:
+            yield from StreamingPageParser().parse(iter(lambda: page_file.read(64 * 1024), b""))
+
+
+def run_mode(mode, pages_dir, page_size=500):
+    mapping = ClinicalTrialTransformationMapping()
+    studies = 0
+    started = time.perf_counter()
+    if mode == "legacy":
+        for raw_studies in iter_loaded_pages(pages_dir):
+            studies += len(legacy_transform(raw_studies))
+    elif mode == "records":
+        for raw_studies in iter_loaded_pages(pages_dir):
+            studies += len(mapping.transform(raw_studies))
+    else:
+        records = mapping.iter_transform(iter_streamed_studies(pages_dir))
+        while True:
+            page = list(islice(records, page_size))
+            if not page:
+                break
+            studies += len(page)
+    elapsed = time.perf_counter() - started
+    peak_rss_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {"mode": mode, "studies": studies, "studies_per_second": studies / elapsed, "peak_rss_mib": peak_rss_mib}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages-dir", help="recorded pages, synthesized in a temporary directory when omitted")
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--mode", choices=["legacy", "records", "stream"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        # Child process: one mode, result as JSON on the last line
+        print(json.dumps(run_mode(args.mode, args.pages_dir)))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pages_dir = args.pages_dir or tmp_dir
+        if not args.pages_dir:
+            synthesize_pages(pages_dir, pages=args.pages)
+        for mode in ("legacy", "records", "stream"):
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_mapping", "--mode", mode, "--pages-dir", pages_dir],
+                capture_output=True, text=True, check=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:>8}: {result['studies_per_second']:9.0f} studies/s, peak RSS {result['peak_rss_mib']:6.1f} MiB")
@@ -0,0 +1,163 @@
+"""
+End-to-end benchmark of ClinicalTrialPipeline.run, fully offline: recorded (or synthesized)
+ClinicalTrials.gov pages are replayed by a local server, a FakeDiseaseLLM with configurable
+latency and error rate stands in for ChatOpenAI, and studies go to mongomock (or a local mongod).
+
+Reports studies/s, p50/p99 latency per stage (from the pipeline metrics) and peak RSS. With
+--check, the run uses the settings of the thresholds file and exits with status 1 when a limit
+is crossed, so an optimization (or a regression) has a reproducible number to compare with.
+
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --pages 10 --latency 0.2 --error-rate 0.05
+    python -m benchmarks.bench_pipeline --mongo-uri mongodb://localhost:27017
+    python -m benchmarks.bench_pipeline --check
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import date
+from unittest import mock
+
+import mongomock
+
+from benchmarks.recordings import synthesize_pages
+from benchmarks.servers import ReplayServer
+from clients.metrics import REGISTRY
+from pipelines.trial_pipeline import ClinicalTrialPipeline
+from transformations.fake_llm import FakeDiseaseLLM
+
+THRESHOLDS_PATH = os.path.join(os.path.dirname(__file__), "pipeline_thresholds.json")
+# Kept apart from the clinical_trials database when running against a real mongod
+BENCHMARK_DATABASE = "clinical_trials_benchmark"
+
+# Stage name -> histogram (and labels) it is read from
+STAGES = {
+    "fetch": ("clinical_trials_page_fetch_seconds", ()),
+    "mapping": ("study_mapping_seconds", ()),
+    "llm": ("llm_request_seconds", (("kind", "single"),)),
+    "enrich": ("page_enrich_seconds", ()),
+    "write": ("page_write_seconds", ()),
+    "bulk_write": ("mongo_bulk_write_seconds", ()),
+}
+
+
+def _use_database(db_client, name, drop=True):
+    """Point a MongoDBClient at another database of the same server, emptied first by default."""
+    if drop:
+        db_client.client.drop_database(name)
+    db_client.db = db_client.client[name]
+    db_client.collection = db_client.db["studies"]
+    db_client.dead_letters = db_client.db["dead_letters"]
+    db_client.state = db_client.db["pipeline_state"]
+    db_client.ensure_indexes()
+
+
+def run_benchmark(pages_dir, latency=0.05, error_rate=0.0, match_min_coverage=0.8, mongo_uri=None,
+                  requests_per_minute=100_000):
+    """Run the pipeline once over the replayed pages, returns the measurements as a dict."""
+    llm = FakeDiseaseLLM(latency=latency, error_rate=error_rate, seed=0)
+    pipeline_options = dict(
+        cache_type=None, checkpoint_type=None, llm=llm, match_min_coverage=match_min_coverage,
+        # The fake LLM has no quota, the default limits would measure the rate limiter instead of the pipeline
+        requests_per_minute=requests_per_minute, tokens_per_minute=requests_per_minute * 1000
+    )
+    with ReplayServer(pages_dir) as server:
+        if mongo_uri:
+            with mock.patch.dict(os.environ, {"MONGO_URI": mongo_uri}):
+                pipeline = ClinicalTrialPipeline(**pipeline_options)
+            _use_database(pipeline.db_client, BENCHMARK_DATABASE)
+        else:
+            with mock.patch("clients.db_client.MongoClient", mongomock.MongoClient):
+                pipeline = ClinicalTrialPipeline(**pipeline_options)
+        pipeline.crawler.base_url = server.url
+
+        snapshot = REGISTRY.snapshot()
+        started = time.perf_counter()
+        pipeline.run(date(2024, 10, 20), date(2024, 10, 22))
+        elapsed = time.perf_counter() - started
+
+    histograms = REGISTRY.histogram_stats(since=snapshot)
+    studies = pipeline.db_client.collection.count_documents({})
+    return {
+        "studies": studies,
+        "seconds": elapsed,
+        "studies_per_second": studies / elapsed,
+        "llm_calls": llm.calls,
+        "dead_letters": pipeline.db_client.dead_letters.count_documents({}),
+        "stages": {
+            stage: histograms[key] for stage, key in STAGES.items() if key in histograms
+        },
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def check_thresholds(result, limits):
+    """Descriptions of the limits the result crosses, empty when it passes."""
+    failures = []
+    if result["studies_per_second"] < limits.get("min_studies_per_second", 0):
+        failures.append(f"{result['studies_per_second']:.0f} studies/s < {limits['min_studies_per_second']}")
+    if result["peak_rss_mib"] > limits.get("max_peak_rss_mib", float("inf")):
+        failures.append(f"peak RSS {result['peak_rss_mib']:.0f} MiB > {limits['max_peak_rss_mib']}")
+    for stage, max_p99 in limits.get("max_p99_seconds", {}).items():
+        p99 = result["stages"].get(stage, {}).get("p99")
+        if p99 is None:
+            # A stage that stopped being measured must not pass silently
+            failures.append(f"{stage} was not measured")
+        elif p99 > max_p99:
+            failures.append(f"{stage} p99 {p99:.3f}s > {max_p99}s")
+    return failures
+
+
+def print_result(result):
+    print(f"{result['studies']} studies in {result['seconds']:.2f}s: {result['studies_per_second']:.0f} studies/s, "
+          f"{result['llm_calls']} LLM calls, {result['dead_letters']} dead letters, "
+          f"peak RSS {result['peak_rss_mib']:.1f} MiB")
+    for stage, stats in result["stages"].items():
+        print(f"{stage:>11}: count={stats['count']:<6} p50={stats['p50'] * 1000:8.1f} ms  p99={stats['p99'] * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages-dir", help="recorded pages, synthesized in a temporary directory when omitted")
+    parser.add_argument("--pages", type=int, default=4)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds of latency per fake LLM call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of fake LLM calls that fail")
+    parser.add_argument("--no-matcher", action="store_true", help="send every study to the LLM")
+    parser.add_argument("--requests-per-minute", type=int, default=100_000, help="LLM rate limit of the pipeline")
+    parser.add_argument("--mongo-uri", help=f"local mongod to write to (database {BENCHMARK_DATABASE}), mongomock when omitted")
+    parser.add_argument("--check", action="store_true", help="run with the settings of the thresholds file and enforce its limits")
+    parser.add_argument("--thresholds", default=THRESHOLDS_PATH)
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args()
+
+    limits = None
+    if args.check:
+        with open(args.thresholds) as thresholds_file:
+            thresholds = json.load(thresholds_file)
+        vars(args).update(thresholds["settings"])
+        limits = thresholds["limits"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pages_dir = args.pages_dir or tmp_dir
+        if not args.pages_dir:
+            synthesize_pages(pages_dir, pages=args.pages, page_size=args.page_size)
+        result = run_benchmark(
+            pages_dir, latency=args.latency, error_rate=args.error_rate,
+            match_min_coverage=None if args.no_matcher else 0.8, mongo_uri=args.mongo_uri,
+            requests_per_minute=args.requests_per_minute
+        )
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print_result(result)
+    if limits is not None:
+        failures = check_thresholds(result, limits)
+        for failure in failures:
+            print(f"REGRESSION: {failure}")
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,118 @@
+"""
+Record ClinicalTrials.gov v2 pages for offline replay, or synthesize pages of the same shape.
+
+    python -m benchmarks.recordings record benchmarks/data/pages --start 2024-10-20 --end 2024-10-21
+    python -m benchmarks.recordings synthesize benchmarks/data/pages --pages 10
+"""
+import argparse
+import json
+import os
+import random
+from datetime import date
+
+import requests
+
+from clients.api_client import CLINICAL_TRIALS_URL, ClinicalTrialsAPIClient
+
+CONDITIONS = [
+    "asthma", "hypertension", "type 2 diabetes", "breast cancer", "non-small cell lung cancer", "melanoma",
+    "chronic kidney disease", "heart failure", "atrial fibrillation", "HIV", "hepatitis C", "COVID-19",
+    "Alzheimer's disease", "Parkinson's disease", "multiple sclerosis", "rheumatoid arthritis", "psoriasis",
+    "major depressive disorder", "schizophrenia", "obesity",
+]
+COUNTRIES = [
+    ("United States", ["Boston", "Houston", "Seattle"]), ("France", ["Paris", "Lyon"]),
+    ("Germany", ["Berlin", "Munich"]), ("China", ["Beijing", "Shanghai"]), ("Morocco", ["Rabat", "Casablanca"]),
+]
+BOILERPLATE = [
+    "Age 18 years or older at the time of signing the informed consent form.",
+    "Ability to understand and the willingness to sign a written informed consent document.",
+    "Women of childbearing potential must agree to use adequate contraception.",
+    "Adequate organ and marrow function as defined in the protocol.",
+    "ECOG performance status of 0 or 1.",
+]
+
+
+def _write_page(directory, index, payload):
+    with open(os.path.join(directory, f"page_{index:04d}.json"), "w") as page_file:
+        json.dump(payload, page_file)
+
+
+def record_pages(directory, start_date, end_date, page_size=500, max_pages=None):
+    """Save the real API answers, with page tokens rewritten to file indexes."""
+    os.makedirs(directory, exist_ok=True)
+    params = ClinicalTrialsAPIClient()._build_params(start_date, end_date, page_size)
+    index = 0
+    while max_pages is None or index < max_pages:
+        response = requests.get(CLINICAL_TRIALS_URL, params=params, timeout=(10, 60))
+        response.raise_for_status()
+        payload = response.json()
+        next_token = payload.pop("nextPageToken", None)
+        if next_token and (max_pages is None or index + 1 < max_pages):
+            payload["nextPageToken"] = str(index + 1)
+            params["pageToken"] = next_token
+        _write_page(directory, index, payload)
+        index += 1
+        if "nextPageToken" not in payload:
+            break
+    return index
+
+
+def synthesize_study(rng, index, day):
+    conditions = rng.sample(CONDITIONS, rng.randint(1, 3))
+    inclusion = [f"Confirmed diagnosis of {condition}" for condition in conditions] + rng.sample(BOILERPLATE, 3)
+    inclusion += [f"Additional protocol requirement {i}: " + " ".join(rng.choices(BOILERPLATE, k=2)) for i in range(rng.randint(0, 8))]
+    exclusion = ["Pregnant or breastfeeding women", f"Uncontrolled {rng.choice(CONDITIONS)}"]
+    locations = []
+    for _ in range(rng.randint(1, 6)):
+        country, cities = rng.choice(COUNTRIES)
+        locations.append({"facility": f"Hospital {rng.randint(1, 500)}", "city": rng.choice(cities), "country": country})
+    return {"protocolSection": {
+        "identificationModule": {"nctId": f"NCT{index:08d}", "briefTitle": f"Study of {' and '.join(conditions)}"},
+        "statusModule": {
+            "overallStatus": rng.choice(["RECRUITING", "COMPLETED", "NOT_YET_RECRUITING"]),
+            "startDateStruct": {"date": f"20{rng.randint(15, 24)}-{rng.randint(1, 12):02d}"},
+            "completionDateStruct": {"date": f"20{rng.randint(25, 30)}-{rng.randint(1, 12):02d}-01"},
+            "lastUpdatePostDateStruct": {"date": f"2024-10-{day:02d}"},
+        },
+        "designModule": {"phases": [rng.choice(["PHASE1", "PHASE2", "PHASE3", "NA"])]},
+        "sponsorCollaboratorsModule": {"leadSponsor": {"name": f"Sponsor {rng.randint(1, 50)}"}},
+        "contactsLocationsModule": {
+            "overallOfficials": [{"name": f"Dr Investigator {index}", "affiliation": "University Hospital", "role": "PRINCIPAL_INVESTIGATOR"}],
+            "locations": locations,
+        },
+        "eligibilityModule": {"eligibilityCriteria": (
+            "Inclusion Criteria:\n\n" + "\n".join(f"* {line}" for line in inclusion)
+            + "\n\nExclusion Criteria:\n\n" + "\n".join(f"* {line}" for line in exclusion)
+        )},
+    }}
+
+
+def synthesize_pages(directory, pages=4, page_size=500, seed=0):
+    """Generate pages shaped like the v2 API answers, for machines without network access."""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    for index in range(pages):
+        studies = [synthesize_study(rng, index * page_size + i, 20 + i % 3) for i in range(page_size)]
+        payload = {"studies": studies}
+        if index + 1 < pages:
+            payload["nextPageToken"] = str(index + 1)
+        _write_page(directory, index, payload)
+    return pages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", choices=["record", "synthesize"])
+    parser.add_argument("directory")
+    parser.add_argument("--start", type=date.fromisoformat, default=date(2024, 10, 20))
+    parser.add_argument("--end", type=date.fromisoformat, default=date(2024, 10, 21))
+    parser.add_argument("--pages", type=int, default=None)
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        count = record_pages(args.directory, args.start, args.end, args.page_size, args.pages)
+    else:
+        count = synthesize_pages(args.directory, args.pages or 4, args.page_size)
+    print(f"Wrote {count} pages to {args.directory}")
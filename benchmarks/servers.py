@@ -0,0 +1,208 @@
+"""Local HTTP servers standing in for external APIs in tests and benchmarks."""
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        self._send_body(status, json.dumps(payload).encode("utf-8"), headers)
+
+    def _send_body(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _BackloggedHTTPServer(ThreadingHTTPServer):
+    # The default backlog of 5 resets connections when many clients connect at once
+    request_queue_size = 256
+
+
+class BackgroundServer:
+    """Runs a ThreadingHTTPServer on a free local port, usable as a context manager."""
+
+    def __init__(self, handler_class):
+        self.server = _BackloggedHTTPServer(("127.0.0.1", 0), handler_class)
+        self.server.owner = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _OpenAIHandler(_QuietHandler):
+    def do_POST(self):
+        owner = self.server.owner
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        owner.record(self.client_address)
+        if owner.latency:
+            time.sleep(owner.latency)
+        if owner.should_throttle():
+            self._send_json(429, {"error": {
+                "message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"
+            }}, headers={"retry-after-ms": str(owner.retry_after_ms)})
+            return
+        self._send_json(200, {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o-mini"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": owner.answer},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 50, "completion_tokens": 5, "total_tokens": 55},
+        }, headers={
+            "x-ratelimit-limit-requests": str(owner.requests_per_minute),
+            "x-ratelimit-remaining-requests": str(owner.requests_per_minute - 1),
+            "x-ratelimit-reset-requests": "120ms",
+        })
+
+
+class MockOpenAIServer(BackgroundServer):
+    """
+    Minimal /v1/chat/completions endpoint.
+
+    The first `throttle_first` requests get a 429, the following ones answer `answer`. Requests and
+    distinct client connections are counted so connection reuse can be measured.
+    """
+
+    def __init__(self, answer="asthma", throttle_first=0, retry_after_ms=10, latency=0.0, requests_per_minute=500):
+        super().__init__(_OpenAIHandler)
+        self.answer = answer
+        self.throttle_first = throttle_first
+        self.retry_after_ms = retry_after_ms
+        self.latency = latency
+        self.requests_per_minute = requests_per_minute
+        self.requests = 0
+        self.throttled = 0
+        self.connections = set()
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"{self.url}/v1"
+
+    def record(self, client_address):
+        with self._lock:
+            self.requests += 1
+            self.connections.add(client_address)
+
+    def should_throttle(self):
+        with self._lock:
+            if self.throttled < self.throttle_first:
+                self.throttled += 1
+                return True
+            return False
+
+
+class _ReplayHandler(_QuietHandler):
+    def do_GET(self):
+        owner = self.server.owner
+        query = parse_qs(urlparse(self.path).query)
+        owner.record(self.client_address)
+        if owner.latency:
+            time.sleep(owner.latency)
+        if owner.should_fail():
+            self._send_json(503, {"message": "Service unavailable"}, headers={"Retry-After": "0"})
+            return
+        if query.get("countTotal") == ["true"]:
+            self._send_json(200, {"totalCount": owner.total_count, "studies": []})
+            return
+        token = query.get("pageToken", ["0"])[0]
+        if not token.isdigit() or int(token) >= len(owner.pages):
+            self._send_json(400, {"message": f"Unknown page token {token}"})
+            return
+        raw, compressed = owner.page(int(token), query.get("query.term", [""])[0])
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            self._send_body(200, compressed, {"Content-Encoding": "gzip"})
+        else:
+            self._send_body(200, raw)
+
+
+class ReplayServer(BackgroundServer):
+    """
+    Serves ClinicalTrials.gov v2 pages recorded by benchmarks.recordings.
+
+    Page files are `page_0000.json`, `page_0001.json`... whose nextPageToken is the index of the
+    next file. Bodies are gzipped when the client accepts it, and `countTotal=true` queries get the
+    number of recorded studies.
+
+    The same studies answer every query unless distinct_queries is set: the NCT ids are then
+    suffixed with a digest of query.term, so each date range (shard) gets studies of its own.
+    The first `fail_first` requests get a 503.
+    """
+
+    def __init__(self, directory, latency=0.0, distinct_queries=False, fail_first=0):
+        super().__init__(_ReplayHandler)
+        self.latency = latency
+        self.distinct_queries = distinct_queries
+        self.fail_first = fail_first
+        self.failed = 0
+        self.pages = []
+        self.total_count = 0
+        for name in sorted(os.listdir(directory)):
+            if name.startswith("page_") and name.endswith(".json"):
+                with open(os.path.join(directory, name), "rb") as page_file:
+                    raw = page_file.read()
+                self.pages.append((raw, gzip.compress(raw, compresslevel=6)))
+                self.total_count += len(json.loads(raw).get("studies", []))
+        self.requests = 0
+        self.connections = set()
+        self._lock = threading.Lock()
+
+    def should_fail(self):
+        with self._lock:
+            if self.failed < self.fail_first:
+                self.failed += 1
+                return True
+            return False
+
+    def page(self, index, query_term):
+        """Raw and gzipped body of page `index` for a query."""
+        if not self.distinct_queries:
+            return self.pages[index]
+        payload = json.loads(self.pages[index][0])
+        suffix = hashlib.sha1(query_term.encode("utf-8")).hexdigest()[:6].upper()
+        for study in payload.get("studies", []):
+            identification = study["protocolSection"]["identificationModule"]
+            identification["nctId"] = f"{identification['nctId']}-{suffix}"
+        raw = json.dumps(payload).encode("utf-8")
+        return raw, gzip.compress(raw, compresslevel=6)
+
+    def record(self, client_address):
+        with self._lock:
+            self.requests += 1
+            self.connections.add(client_address)
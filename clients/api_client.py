@@ -1,31 +1,270 @@
+import asyncio
 import requests
-from datetime import date
+from datetime import date, timedelta
 import json
-import logging
-import sys
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from clients.bootstrap import get_logger
+from clients.json_stream import StreamingPageParser
+from clients.metrics import REGISTRY
+from clients.rate_limiter import TokenBucket
+
+CLINICAL_TRIALS_URL = "https://clinicaltrials.gov/api/v2/studies"
+STREAM_CHUNK_SIZE = 64 * 1024
+# Retry policy of the page requests, shared by the sync session and the async client
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF_FACTOR = 0.5
+
+PAGE_FETCH_SECONDS = REGISTRY.histogram(
+    "clinical_trials_page_fetch_seconds", "Time spent requesting and downloading one API page"
+)
+PAGES_FETCHED = REGISTRY.counter("clinical_trials_pages_fetched_total", "API pages fetched")
+FETCH_ERRORS = REGISTRY.counter("clinical_trials_fetch_errors_total", "Crawls interrupted by an API error")
+
+
+def _timed_chunks(chunks, elapsed):
+    """Pass the chunks through, adding the time spent waiting for each one to elapsed[0]"""
+    iterator = iter(chunks)
+    while True:
+        started = time.perf_counter()
+        chunk = next(iterator, None)
+        elapsed[0] += time.perf_counter() - started
+        if chunk is None:
+            return
+        yield chunk
+
 
 class APIClient:
     def fetch_trials(self, start_date: date, end_date: date):
         raise NotImplementedError("Subclasses should implement this method")
 
 class ClinicalTrialsAPIClient(APIClient):
-    def __init__(self):
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
-            handlers=[
-                logging.FileHandler('clinical_trials_processing.log'),
-                logging.StreamHandler(sys.stdout)
-            ]
+    def __init__(self, base_url=CLINICAL_TRIALS_URL, pool_size=16, max_retries=5, timeout=(10, 60)):
+        self.logger = get_logger(self.__class__.__name__)
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = self._build_session(pool_size, max_retries)
+
+    @staticmethod
+    def _build_session(pool_size, max_retries):
+        """Keep-alive connection pool shared by every page request (and every shard thread)"""
+        session = requests.Session()
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=list(RETRY_STATUSES),
+            allowed_methods=["GET"],
+            respect_retry_after_header=True,
         )
-        self.logger = logging.getLogger(self.__class__.__name__)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip, deflate"})
+        return session
 
     def fetch_trials(self, start_date: date, end_date: date, page_size: int = 500):
-        url = f"https://clinicaltrials.gov/api/v2/studies"
-        studies = []
-        page_token = None  # Token to handle pagination
-        params = {
+        # Lets callers tell a complete crawl from one interrupted by an error
+        self.last_error = None
+        try:
+            yield from self._fetch_pages(start_date, end_date, page_size)
+        # ValueError covers truncated or malformed page bodies
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.logger.warning(f"Error streaming studies: {str(e)}")
+            self.last_error = e
+            FETCH_ERRORS.inc()
+            return []
+
+    def fetch_trials_sharded(self, start_date: date, end_date: date, page_size: int = 500,
+                             max_workers: int = 4, requests_per_second: float = 5.0,
+                             target_shard_size: int = 5000, skip_shards=(), on_shard_done=None):
+        """
+        Crawl a large date range as parallel sub-ranges.
+
+        Pagination tokens chain the pages of one query, so the range is split into LastUpdatePostDate
+        shards of about `target_shard_size` studies (sized from countTotal) that are paginated
+        concurrently. All shards share one politeness limit of `requests_per_second`, and the merged
+        pages are de-duplicated by NCTId (a trial updated during the crawl can move between shards).
+
+        Shards whose (start, end) dates are in `skip_shards` are not crawled, and
+        `on_shard_done(start, end)` is called once every page of a shard was yielded without error,
+        so a resumed crawl can leave out the shards already processed.
+        """
+        self.last_error = None
+        try:
+            shards = self.shard_date_range(start_date, end_date, target_shard_size)
+        except requests.exceptions.RequestException as e:
+            self.logger.warning(f"Error counting studies: {str(e)}")
+            self.last_error = e
+            FETCH_ERRORS.inc()
+            return
+        skipped = set(skip_shards)
+        shards = [shard for shard in shards if (shard[0], shard[1]) not in skipped]
+        self.logger.warning(f'Crawling {len(shards)} shards with {max_workers} threads')
+        politeness = TokenBucket(capacity=requests_per_second, refill_per_second=requests_per_second)
+        pages = queue.Queue(maxsize=max_workers * 2)
+        stop = threading.Event()
+        shard_done = object()
+
+        def put(item):
+            # Give up when the consumer stopped iterating, instead of blocking forever
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def crawl(shard_start, shard_end):
+            completed = False
+            try:
+                for studies in self._fetch_pages(shard_start, shard_end, page_size, politeness):
+                    if stop.is_set():
+                        return
+                    put(studies)
+                completed = True
+            except (requests.exceptions.RequestException, ValueError) as e:
+                self.logger.warning(f"Error streaming studies of shard {shard_start}..{shard_end}: {str(e)}")
+                self.last_error = e
+                FETCH_ERRORS.inc()
+            finally:
+                put((shard_done, shard_start, shard_end, completed))
+
+        seen_ids = set()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for shard_start, shard_end, _ in shards:
+                executor.submit(crawl, shard_start, shard_end)
+            try:
+                remaining = len(shards)
+                while remaining:
+                    studies = pages.get()
+                    if isinstance(studies, tuple) and studies[0] is shard_done:
+                        remaining -= 1
+                        _, shard_start, shard_end, completed = studies
+                        if completed and on_shard_done is not None:
+                            on_shard_done(shard_start, shard_end)
+                        continue
+                    unique_studies = []
+                    for study in studies:
+                        nct_id = study.get('protocolSection', {}).get('identificationModule', {}).get('nctId')
+                        if nct_id in seen_ids:
+                            continue
+                        seen_ids.add(nct_id)
+                        unique_studies.append(study)
+                    if unique_studies:
+                        yield unique_studies
+            finally:
+                stop.set()
+
+    def count_trials(self, start_date: date, end_date: date):
+        params = self._build_params(start_date, end_date, page_size=1)
+        params.update({"countTotal": "true", "fields": "NCTId"})
+        response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json().get("totalCount", 0)
+
+    def shard_date_range(self, start_date: date, end_date: date, target_shard_size: int = 5000):
+        """Split [start_date, end_date] in halves until each shard holds at most target_shard_size studies."""
+        count = self.count_trials(start_date, end_date)
+        if count == 0:
+            return []
+        if count <= target_shard_size or start_date >= end_date:
+            return [(start_date, end_date, count)]
+        middle = start_date + (end_date - start_date) // 2
+        return (self.shard_date_range(start_date, middle, target_shard_size)
+                + self.shard_date_range(middle + timedelta(days=1), end_date, target_shard_size))
+
+    def stream_studies(self, start_date: date, end_date: date, page_size: int = 500):
+        """Yield studies one at a time as they are parsed off the wire, page after page."""
+        self.last_error = None
+        try:
+            for _, page in self._iter_page_streams(start_date, end_date, page_size):
+                yield from page
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.logger.warning(f"Error streaming studies: {str(e)}")
+            self.last_error = e
+            FETCH_ERRORS.inc()
+
+    def stream_pages(self, start_date: date, end_date: date, page_size: int = 500, page_token=None):
+        """
+        Yield (page_token, studies) per page: the token that fetched the page (None for the first
+        one) and a generator of its studies parsed while the page downloads. Passing a yielded
+        token back resumes the crawl at that page.
+        """
+        self.last_error = None
+        try:
+            for token, studies in self._iter_page_streams(start_date, end_date, page_size, page_token=page_token):
+                yield token, self._guard_page_body(studies)
+                # The crawl stops at a page whose body could not be read
+                if self.last_error is not None:
+                    return
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.logger.warning(f"Error streaming studies: {str(e)}")
+            self.last_error = e
+            FETCH_ERRORS.inc()
+
+    def _guard_page_body(self, studies):
+        """
+        The studies of a streamed page. The caller consumes them outside stream_pages, so errors
+        reading the body (truncated or malformed JSON, a broken chunked transfer) end the page
+        here and are recorded like in fetch_trials.
+        """
+        try:
+            yield from studies
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.logger.warning(f"Error streaming studies: {str(e)}")
+            self.last_error = e
+            FETCH_ERRORS.inc()
+
+    def _fetch_pages(self, start_date: date, end_date: date, page_size: int = 500, politeness=None):
+        for _, page in self._iter_page_streams(start_date, end_date, page_size, politeness):
+            yield list(page)
+
+    def _iter_page_streams(self, start_date: date, end_date: date, page_size: int = 500, politeness=None,
+                           page_token=None):
+        """Yield (page_token, studies) per page, the studies generator parses the page while it downloads."""
+        url = self.base_url
+        params = self._build_params(start_date, end_date, page_size)
+
+        while True:
+            # Add page token to params if it's available for the next page
+            if page_token:
+                params['pageToken'] = page_token
+
+            if politeness is not None:
+                time.sleep(politeness.reserve())
+
+            # Make the API request, the body is decompressed and parsed as it arrives
+            parser = StreamingPageParser("studies")
+            # Network time only: the time the caller spends on the studies of the page is left out
+            started = time.perf_counter()
+            with self.session.get(url, params=params, stream=True, timeout=self.timeout) as response:
+                elapsed = [time.perf_counter() - started]
+                response.raise_for_status()  # Raise an error for bad status codes
+                studies = parser.parse(_timed_chunks(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), elapsed))
+                yield page_token, studies
+                # The next page token comes after the studies, finish the page if the caller did not
+                for _ in studies:
+                    pass
+            PAGE_FETCH_SECONDS.observe(elapsed[0])
+            PAGES_FETCHED.inc()
+
+            page_token = parser.metadata.get("nextPageToken")
+            if not page_token:
+                self.logger.warning('no more page token')
+                break  # Exit the loop if there is no next page
+            if politeness is None:
+                time.sleep(0.1)  # Rate limiting
+
+    def _build_params(self, start_date: date, end_date: date, page_size: int = 500):
+        return {
             "format": "json",
             'query.term': f"AREA[LastUpdatePostDate]RANGE[{start_date},{end_date}]",            
             "pageSize": page_size,
@@ -46,88 +285,62 @@ class ClinicalTrialsAPIClient(APIClient):
                 "LocationFacility",
                 "LocationCity",
                 "LocationCountry",
-                "EligibilityCriteria"
+                "EligibilityCriteria",
+                "LastUpdatePostDate"
             ])
         }
 
-        try:
-            while True:
-                # Add page token to params if it's available for the next page
-                if page_token:
-                    params['pageToken'] = page_token
 
-                # Make the API request
-                response = requests.get(url, params=params)
-                response.raise_for_status()  # Raise an error for bad status codes
+class AsyncClinicalTrialsAPIClient(ClinicalTrialsAPIClient):
+    """Same queries as ClinicalTrialsAPIClient, pages are fetched with a pooled httpx.AsyncClient"""
 
-                # Parse the JSON response
-                data = response.json()
-                studies = data.get("studies", [])
-                yield studies
-
-                page_token = data.get("nextPageToken")
-                if not page_token:
-                    self.logger.warning('no more page token')
-                    break  # Exit the loop if there is no next page
-                # if len(studies) < page_size:
-                #     self.logger.warn('no more studies')
-                #     break
-                time.sleep(0.1)  # Rate limiting
+    async def afetch_trials(self, start_date: date, end_date: date, page_size: int = 500):
+        params = self._build_params(start_date, end_date, page_size)
+        self.last_error = None
+        async with httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0)) as client:
+            try:
+                while True:
+                    started = time.perf_counter()
+                    response = await self._aget(client, params)
+                    data = response.json()
+                    PAGE_FETCH_SECONDS.observe(time.perf_counter() - started)
+                    PAGES_FETCHED.inc()
+                    yield data.get("studies", [])
+
+                    page_token = data.get("nextPageToken")
+                    if not page_token:
+                        self.logger.warning('no more page token')
+                        break
+                    params['pageToken'] = page_token
+                    await asyncio.sleep(0.1)  # Rate limiting
+            # ValueError covers truncated or malformed page bodies
+            except (httpx.HTTPError, ValueError) as e:
+                self.logger.warning(f"Error streaming studies: {str(e)}")
+                self.last_error = e
+                FETCH_ERRORS.inc()
+
+    async def _aget(self, client, params):
+        """
+        GET a page with the retry policy of the sync session: transport errors and RETRY_STATUSES
+        are retried max_retries times with exponential backoff, or after the server's Retry-After.
+        """
+        for attempt in range(self.max_retries + 1):
+            delay = RETRY_BACKOFF_FACTOR * 2 ** attempt
+            try:
+                response = await client.get(self.base_url, params=params)
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    response.raise_for_status()
+                    return response
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+            self.logger.warning(f"Retrying page request in {delay:.1f}s (attempt {attempt + 1}/{self.max_retries})")
+            await asyncio.sleep(delay)
 
-        except requests.exceptions.RequestException as e:
-            self.logger.warning(f"Error streaming studies: {str(e)}")
-            return []
-        
-    def _structure_studies(self, raw_studies):
-        structured_studies = []
-        for study in raw_studies:
-            protocol_section = study.get('protocolSection', {})
-            
-            # Extract modules safely
-            identification_module = protocol_section.get('identificationModule', {})
-            status_module = protocol_section.get('statusModule', {})
-            design_module = protocol_section.get('designModule', {})
-            contacts_locations_module = protocol_section.get('contactsLocationsModule', {})
-            eligibility_module = protocol_section.get('eligibilityModule', {})
-
-            # Extract principal investigator info
-            overall_officials = contacts_locations_module.get('overallOfficials', [])
-            pi_info = next((
-                official for official in overall_officials 
-                if official.get('role', '').upper() == 'PRINCIPAL_INVESTIGATOR'
-            ), {})
-
-            structured_study = {
-                "trialId": identification_module.get('nctId', 'Unknown'),
-                "title": identification_module.get('briefTitle', 'Unknown'),
-                "startDate": self._get_date(status_module.get('startDateStruct')),
-                "endDate": self._get_date(status_module.get('completionDateStruct')),
-                "phase": design_module.get('phases', ['Unknown']),
-                "principalInvestigator": {
-                    "name": pi_info.get('name', 'Unknown'),
-                    "affiliation": pi_info.get('affiliation', 'Unknown'),
-                },
-                "locations": self._extract_locations(contacts_locations_module),
-                "eligibilityCriteria": eligibility_module.get('eligibilityCriteria', 'Unknown')
-            }
-            structured_studies.append(structured_study)
-        return structured_studies
-    
-    def _get_date(self, date_struct):
-        if not date_struct:
-            return 'Unknown'
-        return date_struct.get('date', 'Unknown')
-
-    def _extract_locations(self, contacts_locations_module):
-        locations = contacts_locations_module.get('locations', [])
-        return [
-            {
-                "facility": location.get('facility', 'Unknown'),
-                "city": location.get('city', 'Unknown'),
-                "country": location.get('country', 'Unknown'),
-            } for location in locations
-        ] if locations else [{"facility": "Unknown", "city": "Unknown", "country": "Unknown"}]
-    
 
 class MockedDataSourceClient(APIClient):
     def fetch_trials(self, start_date: date, end_date: date, page_size: int = 500):
@@ -144,6 +357,8 @@ class APIClientFactory:
     def get_api_client(source_name):
         if source_name == "clinical_trials":
             return ClinicalTrialsAPIClient()
+        elif source_name == "clinical_trials_async":
+            return AsyncClinicalTrialsAPIClient()
         elif source_name == "mocked_api":
             return MockedDataSourceClient()
         else:
@@ -152,7 +367,6 @@ class APIClientFactory:
 if __name__ == "__main__":
     result = []
     crawler = APIClientFactory.get_api_client("clinical_trials")
-    ## to be parallelized
-    for studies in crawler.fetch_trials(date(2024, 10, 20), date(2024, 10, 21)):
+    for studies in crawler.fetch_trials_sharded(date(2024, 10, 20), date(2024, 10, 21)):
         pass
         
\ No newline at end of file
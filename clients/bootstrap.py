@@ -0,0 +1,40 @@
+"""
+Process-wide setup shared by every client, transformation and pipeline: environment variables
+from `.env` and the logging handlers. Runs once, on the first get_logger call.
+"""
+import logging
+import sys
+import threading
+
+from dotenv import load_dotenv
+
+LOG_FILE = 'clinical_trials_processing.log'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+
+_bootstrapped = False
+_bootstrap_lock = threading.Lock()
+
+
+def bootstrap():
+    """Load `.env` and install the file and stdout log handlers, once per process."""
+    global _bootstrapped
+    if _bootstrapped:
+        return
+    with _bootstrap_lock:
+        if _bootstrapped:
+            return
+        load_dotenv(override=True)
+        logging.basicConfig(
+            level=logging.INFO,
+            format=LOG_FORMAT,
+            handlers=[
+                logging.FileHandler(LOG_FILE),
+                logging.StreamHandler(sys.stdout)
+            ]
+        )
+        _bootstrapped = True
+
+
+def get_logger(name):
+    bootstrap()
+    return logging.getLogger(name)
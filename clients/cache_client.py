@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo import MongoClient
+
+from clients.bootstrap import get_logger
+from clients.metrics import REGISTRY
+
+
+def make_cache_key(text, model, prompt_version):
+    """Content address of an extraction: normalized criteria text + model + prompt version."""
+    normalized = " ".join(text.split()).lower()
+    payload = "\x1f".join([model, prompt_version, normalized])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+CACHE_HITS = REGISTRY.counter("extraction_cache_lookups_total", "Extraction cache lookups", result="hit")
+CACHE_MISSES = REGISTRY.counter("extraction_cache_lookups_total", "Extraction cache lookups", result="miss")
+
+
+class ExtractionCache:
+    """Base class for the LLM extraction cache, counts hits and misses for every backend."""
+
+    def __init__(self, max_entries=None, ttl_seconds=None, evict_every=100):
+        self.logger = get_logger(self.__class__.__name__)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._counter_lock = threading.Lock()
+
+    def get(self, key):
+        value = self._get(key)
+        with self._counter_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        (CACHE_MISSES if value is None else CACHE_HITS).inc()
+        return value
+
+    def set(self, key, value):
+        self._set(key, value)
+        with self._counter_lock:
+            self._writes += 1
+            should_evict = self._writes % self.evict_every == 0
+        if should_evict:
+            self.evict()
+
+    def stats(self):
+        with self._counter_lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def evict(self):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def _get(self, key):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def _set(self, key, value):
+        raise NotImplementedError("Subclasses should implement this method")
+
+
+class SQLiteExtractionCache(ExtractionCache):
+    """Local on-disk cache, LRU on size and expiry on TTL."""
+
+    def __init__(self, path=None, max_entries=100_000, ttl_seconds=None, evict_every=100):
+        super().__init__(max_entries=max_entries, ttl_seconds=ttl_seconds, evict_every=evict_every)
+        self.path = path or os.getenv('EXTRACTION_CACHE_PATH', 'extraction_cache.sqlite3')
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS extractions ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS extractions_accessed_at ON extractions (accessed_at)"
+            )
+            self.connection.commit()
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT value, created_at FROM extractions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                self.connection.execute("DELETE FROM extractions WHERE key = ?", (key,))
+                self.connection.commit()
+                return None
+            self.connection.execute(
+                "UPDATE extractions SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self.connection.commit()
+        return json.loads(value)
+
+    def _set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO extractions (key, value, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now)
+            )
+            self.connection.commit()
+
+    def evict(self):
+        with self._lock:
+            if self.ttl_seconds is not None:
+                self.connection.execute(
+                    "DELETE FROM extractions WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+                )
+            if self.max_entries is not None:
+                # Least recently used entries go first
+                self.connection.execute(
+                    "DELETE FROM extractions WHERE key IN ("
+                    "SELECT key FROM extractions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            self.connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self.connection.execute("SELECT COUNT(*) FROM extractions").fetchone()[0]
+
+
+class MongoExtractionCache(ExtractionCache):
+    """Cache shared by every pipeline instance through a collection next to `studies`."""
+
+    def __init__(self, collection=None, max_entries=1_000_000, ttl_seconds=None, evict_every=1000):
+        super().__init__(max_entries=max_entries, ttl_seconds=ttl_seconds, evict_every=evict_every)
+        if collection is None:
+            url = os.getenv('MONGO_URI', "mongodb://mongo:27017")
+            collection = MongoClient(url)["clinical_trials"]["llm_cache"]
+        self.collection = collection
+        self.collection.create_index("key", unique=True)
+        self.collection.create_index("accessedAt")
+        if ttl_seconds is not None:
+            # Let the server expire old entries on its own
+            self.collection.create_index("createdAt", expireAfterSeconds=int(ttl_seconds))
+
+    def _get(self, key):
+        now = datetime.now(timezone.utc)
+        document = self.collection.find_one_and_update(
+            {"key": key},
+            {"$set": {"accessedAt": now}},
+            projection={"value": 1, "createdAt": 1}
+        )
+        if document is None:
+            return None
+        if self.ttl_seconds is not None:
+            created_at = document["createdAt"]
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            if now - created_at > timedelta(seconds=self.ttl_seconds):
+                return None
+        return document["value"]
+
+    def _set(self, key, value):
+        now = datetime.now(timezone.utc)
+        self.collection.update_one(
+            {"key": key},
+            {"$set": {"value": value, "createdAt": now, "accessedAt": now}},
+            upsert=True
+        )
+
+    def evict(self):
+        if self.max_entries is None:
+            return
+        overflow = self.collection.estimated_document_count() - self.max_entries
+        if overflow <= 0:
+            return
+        stale = self.collection.find({}, {"_id": 1}).sort("accessedAt", 1).limit(overflow)
+        result = self.collection.delete_many({"_id": {"$in": [doc["_id"] for doc in stale]}})
+        self.logger.warning(f'Evicted {result.deleted_count} cached extractions')
+
+    def __len__(self):
+        return self.collection.count_documents({})
+
+
+class CacheClientFactory:
+    @staticmethod
+    def get_cache_client(cache_type):
+        if cache_type is None or cache_type == "none":
+            return None
+        if cache_type == "sqlite":
+            return SQLiteExtractionCache()
+        if cache_type == "mongo":
+            return MongoExtractionCache()
+        raise ValueError(f"Unknown cache type: {cache_type}")
@@ -0,0 +1,159 @@
+import json
+import os
+import re
+import threading
+from datetime import datetime, timezone
+
+from pymongo import MongoClient, UpdateOne
+
+from clients.bootstrap import get_logger
+
+
+class CheckpointStore:
+    """
+    Durable progress of a pipeline run, keyed by run id: the run state (page token, completed
+    shards...) and the enrichment results already paid for, per trialId.
+    """
+
+    def __init__(self):
+        self.logger = get_logger(self.__class__.__name__)
+
+    def load(self, run_id):
+        """State of an interrupted run, None when there is nothing to resume."""
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def save(self, run_id, **state):
+        """Merge `state` into the stored state of the run."""
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def load_results(self, run_id):
+        """{trialId: {"contentHash", "inclusion_criteria", "diseases"}} of the studies enriched by the run."""
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def save_results(self, run_id, results):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def delete(self, run_id):
+        """Forget a finished run."""
+        raise NotImplementedError("Subclasses should implement this method")
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+    One directory per deployment: `<run>.json` holds the state (atomically replaced) and
+    `<run>.results.jsonl` the enrichment results (appended and fsynced batch by batch).
+    """
+
+    def __init__(self, directory=None):
+        super().__init__()
+        self.directory = directory or os.getenv('CHECKPOINT_DIR', 'checkpoints')
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, run_id, suffix):
+        return os.path.join(self.directory, re.sub(r"[^\w.-]", "_", run_id) + suffix)
+
+    def load(self, run_id):
+        try:
+            with open(self._path(run_id, ".json"), encoding="utf-8") as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return None
+
+    def save(self, run_id, **state):
+        with self._lock:
+            current = self.load(run_id) or {"runId": run_id}
+            current.update(state, updatedAt=datetime.now(timezone.utc).isoformat())
+            path = self._path(run_id, ".json")
+            with open(f"{path}.tmp", "w", encoding="utf-8") as state_file:
+                json.dump(current, state_file)
+                state_file.flush()
+                os.fsync(state_file.fileno())
+            # A crash leaves either the previous or the new state, never half of one
+            os.replace(f"{path}.tmp", path)
+
+    def load_results(self, run_id):
+        results = {}
+        try:
+            with open(self._path(run_id, ".results.jsonl"), encoding="utf-8") as results_file:
+                for line in results_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line cut by a crash
+                        continue
+                    results[entry.pop("trialId")] = entry
+        except FileNotFoundError:
+            pass
+        return results
+
+    def save_results(self, run_id, results):
+        if not results:
+            return
+        with self._lock, open(self._path(run_id, ".results.jsonl"), "a", encoding="utf-8") as results_file:
+            for trial_id, result in results.items():
+                results_file.write(json.dumps({"trialId": trial_id, **result}) + "\n")
+            results_file.flush()
+            os.fsync(results_file.fileno())
+
+    def delete(self, run_id):
+        with self._lock:
+            for suffix in (".json", ".results.jsonl"):
+                try:
+                    os.remove(self._path(run_id, suffix))
+                except FileNotFoundError:
+                    pass
+
+
+class MongoCheckpointStore(CheckpointStore):
+    """Checkpoints next to `studies`, so any worker pointing at the same database can resume a run."""
+
+    def __init__(self, db=None):
+        super().__init__()
+        if db is None:
+            url = os.getenv('MONGO_URI', "mongodb://mongo:27017")
+            db = MongoClient(url)["clinical_trials"]
+        self.runs = db["run_checkpoints"]
+        self.results = db["run_checkpoint_results"]
+        self.runs.create_index("runId", unique=True)
+        self.results.create_index([("runId", 1), ("trialId", 1)], unique=True)
+
+    def load(self, run_id):
+        return self.runs.find_one({"runId": run_id}, {"_id": 0})
+
+    def save(self, run_id, **state):
+        self.runs.update_one(
+            {"runId": run_id},
+            {"$set": {**state, "updatedAt": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    def load_results(self, run_id):
+        return {
+            document.pop("trialId"): document
+            for document in self.results.find({"runId": run_id}, {"_id": 0, "runId": 0})
+        }
+
+    def save_results(self, run_id, results):
+        if not results:
+            return
+        self.results.bulk_write([
+            UpdateOne({"runId": run_id, "trialId": trial_id}, {"$set": result}, upsert=True)
+            for trial_id, result in results.items()
+        ], ordered=False)
+
+    def delete(self, run_id):
+        self.results.delete_many({"runId": run_id})
+        self.runs.delete_one({"runId": run_id})
+
+
+class CheckpointClientFactory:
+    @staticmethod
+    def get_checkpoint_client(checkpoint_type):
+        if checkpoint_type is None or checkpoint_type == "none":
+            return None
+        if checkpoint_type == "file":
+            return FileCheckpointStore()
+        if checkpoint_type == "mongo":
+            return MongoCheckpointStore()
+        raise ValueError(f"Unknown checkpoint type: {checkpoint_type}")
@@ -1,26 +1,302 @@
-from pymongo import MongoClient, ReplaceOne
-import logging
-import sys
-from dotenv import load_dotenv
+from pymongo import ASCENDING, TEXT, AsyncMongoClient, IndexModel, MongoClient, ReplaceOne, UpdateOne
+import bson
+from datetime import datetime, timezone
+import queue
+import threading
+import time
+from clients.bootstrap import get_logger
+from clients.metrics import REGISTRY, SIZE_BUCKETS
 import json
-import os 
-load_dotenv(override=True)
+import os
+
+
+def build_upsert_operations(documents):
+    return [
+        ReplaceOne(
+            {"trialId": doc["trialId"]},
+            doc,
+            upsert=True
+        ) for doc in documents
+    ]
+
+# Declared index set of the studies collection. The compound keys end with trialId so the
+# trialId-paginated queries below are served in index order
+STUDY_INDEXES = [
+    IndexModel([("trialId", ASCENDING)], unique=True, name="trialId_unique"),
+    IndexModel([("diseases", ASCENDING), ("trialId", ASCENDING)], name="diseases_trialId"),
+    IndexModel(
+        [("locations.country", ASCENDING), ("locations.city", ASCENDING), ("trialId", ASCENDING)],
+        name="country_city_trialId"
+    ),
+    IndexModel([("phase", ASCENDING), ("trialId", ASCENDING)], name="phase_trialId"),
+    IndexModel([("startDate", ASCENDING), ("trialId", ASCENDING)], name="startDate_trialId"),
+    IndexModel([("title", TEXT)], name="title_text"),
+]
+# Indexes created by earlier versions that conflict with STUDY_INDEXES
+LEGACY_INDEXES = ("trialId_1",)
+
+SUMMARY_PROJECTION = {"_id": 0, "trialId": 1, "title": 1, "phase": 1, "startDate": 1, "endDate": 1, "diseases": 1}
+
+
+def disease_filter(disease):
+    return {"diseases": disease}
+
+def location_filter(country, city=None):
+    if city is None:
+        return {"locations.country": country}
+    # $elemMatch so country and city come from the same site
+    return {"locations": {"$elemMatch": {"country": country, "city": city}}}
+
+def phase_filter(phase):
+    return {"phase": phase}
+
+def start_date_filter(start_date, end_date):
+    """Studies starting in [start_date, end_date), dates as ISO strings ('2024-10' or '2024-10-20')"""
+    return {"startDate": {"$gte": start_date, "$lt": end_date}}
+
+def title_filter(text):
+    return {"$text": {"$search": text}}
+
+# One instance of every supported query, explained by MongoDBClient.check_query_plans
+SAMPLE_QUERIES = {
+    "by_disease": disease_filter("asthma"),
+    "by_country": location_filter("France"),
+    "by_city": location_filter("France", "Paris"),
+    "by_phase": phase_filter("PHASE2"),
+    "by_start_date": start_date_filter("2024-01-01", "2025-01-01"),
+    "by_title": title_filter("asthma"),
+}
+
+def find_plan_stages(plan):
+    """All stage names of an explain() query plan, nested input stages included"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(find_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(find_plan_stages(value))
+    return stages
+
+BULK_WRITE_SECONDS = REGISTRY.histogram("mongo_bulk_write_seconds", "Latency of one bulk write of studies")
+BULK_WRITE_DOCUMENTS = REGISTRY.histogram(
+    "mongo_bulk_write_documents", "Studies per bulk write", buckets=SIZE_BUCKETS
+)
+BULK_WRITE_BYTES = REGISTRY.histogram(
+    "mongo_bulk_write_bytes", "BSON bytes per write-behind flush", buckets=SIZE_BUCKETS
+)
+BULK_WRITE_ERRORS = REGISTRY.counter("mongo_bulk_write_errors_total", "Failed bulk writes of studies")
+
+# Stored fields not covered by contentHash, they can change while the hash does not
+UNHASHED_FIELDS = ("lastUpdateDate", "inclusion_criteria", "diseases")
+_MISSING = object()
+_STOP = object()
+
+class BulkWriter:
+    """
+    Write-behind buffer in front of the studies collection.
+
+    Documents are queued by `submit` and written by a background thread, one bulk_write per
+    flush, triggered by operation count, BSON byte size or age of the oldest pending document.
+    New trials are upserted whole. Stored trials only get an UpdateOne with a $set of the fields
+    that changed and an $unset of the fields the new version lacks: source fields are diffed when
+    the stored contentHash differs, otherwise only the fields outside the hash are compared.
+    Unchanged trials are not written at all.
+    """
+
+    def __init__(self, collection, max_operations=1000, max_bytes=8 * 1024 * 1024, max_interval=2.0,
+                 max_pending=10_000):
+        self.logger = get_logger(self.__class__.__name__)
+        self.collection = collection
+        self.max_operations = max_operations
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+        # Bounded so a slow database pushes back on the pipeline instead of growing memory
+        self._queue = queue.Queue(maxsize=max_pending)
+        self.flush_stats = []
+        self.errors = 0
+        # Set by the first failed flush and never cleared: progress committed by a later callback
+        # would move past the documents that were lost
+        self._failed = False
+        self._thread = threading.Thread(target=self._run, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def submit(self, documents):
+        for document in documents:
+            self._queue.put(document)
+
+    def after_writes(self, callback):
+        """
+        Call `callback` from the writer thread once every document submitted so far is written.
+        Once a bulk write failed, every callback is dropped until the writer is closed.
+        """
+        self._queue.put(callback)
+
+    def flush(self):
+        """Block until every document submitted so far is written."""
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        flushed.wait()
+
+    def close(self):
+        """Drain the queue and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        pending, pending_bytes, oldest = [], 0, None
+        while True:
+            timeout = None if oldest is None else max(0.0, oldest + self.max_interval - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            try:
+                if item is None or item is _STOP or isinstance(item, threading.Event) or callable(item):
+                    documents, size = pending, pending_bytes
+                    pending, pending_bytes, oldest = [], 0, None
+                    self._flush(documents, size)
+                    if item is _STOP:
+                        return
+                    if isinstance(item, threading.Event):
+                        item.set()
+                    elif item is not None:
+                        self._run_callback(item)
+                    continue
+                # Encoded first, a document BSON cannot encode is dropped alone
+                document_bytes = len(bson.encode(item))
+                pending.append(item)
+                pending_bytes += document_bytes
+                if oldest is None:
+                    oldest = time.monotonic()
+                if len(pending) >= self.max_operations or pending_bytes >= self.max_bytes:
+                    documents, size = pending, pending_bytes
+                    pending, pending_bytes, oldest = [], 0, None
+                    self._flush(documents, size)
+            except Exception as e:
+                # The thread must survive: flush() would wait forever and submit() block on a full queue.
+                # The callbacks are dropped from now on, as after a failed bulk write
+                self._record_error(f"Bulk writer failed on a queued item: {str(e)}")
+                if item is _STOP:
+                    return
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _flush(self, documents, size):
+        if not documents:
+            return
+        started = time.perf_counter()
+        try:
+            operations = self._build_operations(documents)
+            if operations:
+                self.collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            self._record_error(f"Bulk write of {len(documents)} documents failed: {str(e)}")
+            return
+        latency = time.perf_counter() - started
+        BULK_WRITE_SECONDS.observe(latency)
+        BULK_WRITE_DOCUMENTS.observe(len(documents))
+        BULK_WRITE_BYTES.observe(size)
+        stats = {
+            "documents": len(documents),
+            "operations": len(operations),
+            "bytes": size,
+            "latency": latency,
+            "documents_per_second": len(documents) / latency if latency else float("inf"),
+        }
+        self.flush_stats.append(stats)
+        self.logger.warning(
+            f"Flushed {stats['documents']} documents as {stats['operations']} operations "
+            f"({size / 1024:.0f} KiB) in {latency * 1000:.0f} ms, {stats['documents_per_second']:.0f} docs/s"
+        )
+
+    def _record_error(self, message):
+        self.errors += 1
+        self._failed = True
+        BULK_WRITE_ERRORS.inc()
+        self.logger.error(message)
+
+    def _run_callback(self, callback):
+        if self._failed:
+            self.logger.warning("Skipping an after-write callback, a bulk write failed before it")
+            return
+        try:
+            callback()
+        except Exception as e:
+            self.logger.error(f"After-write callback failed: {str(e)}")
+
+    def _build_operations(self, documents):
+        # The last version of a trial submitted in the batch wins
+        by_id = {document["trialId"]: document for document in documents}
+        projection = {"_id": 0, "trialId": 1, "contentHash": 1, **{field: 1 for field in UNHASHED_FIELDS}}
+        stored = {doc["trialId"]: doc for doc in self.collection.find({"trialId": {"$in": list(by_id)}}, projection)}
+        # Full stored documents are only read back for trials whose source content changed
+        changed_ids = [
+            trial_id for trial_id, document in by_id.items()
+            if trial_id in stored and stored[trial_id].get("contentHash") != document.get("contentHash")
+        ]
+        if changed_ids:
+            for doc in self.collection.find({"trialId": {"$in": changed_ids}}, {"_id": 0}):
+                stored[doc["trialId"]] = doc
+        changed_ids = set(changed_ids)
+
+        operations = []
+        for trial_id, document in by_id.items():
+            stored_document = stored.get(trial_id)
+            if stored_document is None:
+                operations.append(ReplaceOne({"trialId": trial_id}, document, upsert=True))
+                continue
+            if trial_id in changed_ids:
+                fields = document.keys()
+                removed = [field for field in stored_document if field != "_id" and field not in document]
+            else:
+                fields = [field for field in UNHASHED_FIELDS if field in document]
+                removed = [field for field in UNHASHED_FIELDS if field in stored_document and field not in document]
+            changes = {
+                field: document[field] for field in fields
+                if stored_document.get(field, _MISSING) != document[field]
+            }
+            update = {}
+            if changes:
+                update["$set"] = changes
+            # Fields the new version no longer has, e.g. inclusion_criteria of a trial without criteria now
+            if removed:
+                update["$unset"] = {field: "" for field in removed}
+            if update:
+                operations.append(UpdateOne({"trialId": trial_id}, update))
+        return operations
 
 class DBClient:
     def save_document(self, document):
         raise NotImplementedError("Subclasses should implement this method")
 
+    def find_by_disease(self, disease, after=None, page_size=50, projection=None):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def find_by_location(self, country, city=None, after=None, page_size=50, projection=None):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def find_by_phase(self, phase, after=None, page_size=50, projection=None):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def find_by_start_date(self, start_date, end_date, after=None, page_size=50, projection=None):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def search_titles(self, text, after=None, page_size=50, projection=None):
+        raise NotImplementedError("Subclasses should implement this method")
+
 class MongoDBClient(DBClient):
     def __init__(self):
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
-            handlers=[
-                logging.FileHandler('clinical_trials_processing.log'),
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
-        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger = get_logger(self.__class__.__name__)
         url = os.getenv('MONGO_URI', "mongodb://mongo:27017")
         self.client = MongoClient(url)
         # Send a ping to confirm a successful connection
@@ -33,31 +309,123 @@ class MongoDBClient(DBClient):
 
         self.db = self.client["clinical_trials"]
         self.collection = self.db["studies"]
+        self.dead_letters = self.db["dead_letters"]
+        self.state = self.db["pipeline_state"]
 
         self.logger.warning(f'Collections in my database are : {self.db.list_collection_names()}')
-        self.logger.warning(f'Length of collection studies is : {(self.collection.count_documents({}))}')
+        # From the collection metadata, count_documents({}) would scan the whole collection
+        self.logger.warning(f'Length of collection studies is : {self.collection.estimated_document_count()}')
+        self.ensure_indexes()
 
-        result = self.collection.create_index("trialId")
-        self.logger.warning(f'Index created: {result}')
+    def ensure_indexes(self):
+        existing = self.collection.index_information()
+        for name in LEGACY_INDEXES:
+            if name in existing:
+                self.collection.drop_index(name)
+                self.logger.warning(f'Index dropped: {name}')
+        result = self.collection.create_indexes(STUDY_INDEXES)
+        self.logger.warning(f'Indexes created: {result}')
 
     def insert_many_documents(self, documents):
+        if not documents:
+            return
         ## to be check the update date before updating if many datasources
-        operations = [
-            ReplaceOne(
-                {"trialId": doc["trialId"]},
-                doc,
-                upsert=True
-            ) for doc in documents
-        ]
+        operations = build_upsert_operations(documents)
         
         # Execute the bulk write operation
-        result = self.collection.bulk_write(operations, ordered=False)
+        with BULK_WRITE_SECONDS.time():
+            result = self.collection.bulk_write(operations, ordered=False)
+        BULK_WRITE_DOCUMENTS.observe(len(documents))
         
         self.logger.warning(f"Inserted/Updated {result.upserted_count + result.modified_count} documents")
         self.logger.warning(f"Inserted {result.upserted_count} documents")
         self.logger.warning(f"Updated  {result.modified_count} documents")
         # we can also check updating a few fields from other data sources
 
+    def get_watermark(self, source):
+        """Latest LastUpdatePostDate (ISO string) fully processed for a source, None before the first run"""
+        state = self.state.find_one({"source": source})
+        return state.get("watermark") if state else None
+
+    def set_watermark(self, source, watermark):
+        self.state.update_one(
+            {"source": source},
+            {"$set": {"watermark": watermark, "updatedAt": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        self.logger.warning(f"Watermark of {source} set to {watermark}")
+
+    def find_content_hashes(self, trial_ids):
+        cursor = self.collection.find({"trialId": {"$in": list(trial_ids)}}, {"trialId": 1, "contentHash": 1, "_id": 0})
+        return {doc["trialId"]: doc.get("contentHash") for doc in cursor}
+
+    def start_bulk_writer(self, **kwargs):
+        return BulkWriter(self.collection, **kwargs)
+
+    def find_studies(self, trial_ids):
+        return list(self.collection.find({"trialId": {"$in": list(trial_ids)}}))
+
+    def find_by_disease(self, disease, after=None, page_size=50, projection=None):
+        return self._find_page(disease_filter(disease), after, page_size, projection)
+
+    def find_by_location(self, country, city=None, after=None, page_size=50, projection=None):
+        return self._find_page(location_filter(country, city), after, page_size, projection)
+
+    def find_by_phase(self, phase, after=None, page_size=50, projection=None):
+        return self._find_page(phase_filter(phase), after, page_size, projection)
+
+    def find_by_start_date(self, start_date, end_date, after=None, page_size=50, projection=None):
+        return self._find_page(start_date_filter(start_date, end_date), after, page_size, projection)
+
+    def search_titles(self, text, after=None, page_size=50, projection=None):
+        return self._find_page(title_filter(text), after, page_size, projection)
+
+    def _find_page(self, query, after, page_size, projection):
+        """
+        One page of matching studies ordered by trialId, and the `after` value of the next page
+        (None on the last page). Keyset pagination: pages cost the same however deep they are.
+        Custom projections must be inclusion projections, trialId is always added and _id left out
+        unless asked for.
+        """
+        if after is not None:
+            query = {**query, "trialId": {"$gt": after}}
+        projection = {"_id": 0, **(projection or SUMMARY_PROJECTION), "trialId": 1}
+        studies = list(self.collection.find(query, projection).sort("trialId", ASCENDING).limit(page_size))
+        next_after = studies[-1]["trialId"] if len(studies) == page_size else None
+        return studies, next_after
+
+    def check_query_plans(self):
+        """Explain every supported query and raise if one of them scans the whole collection"""
+        collscans = []
+        for name, query in SAMPLE_QUERIES.items():
+            plan = self.collection.find(query, SUMMARY_PROJECTION).sort("trialId", ASCENDING).limit(50).explain()
+            stages = find_plan_stages(plan.get("queryPlanner", {}).get("winningPlan", {}))
+            self.logger.warning(f'Query plan of {name}: {" <- ".join(stages)}')
+            if "COLLSCAN" in stages:
+                collscans.append(name)
+        if collscans:
+            raise RuntimeError(f"Queries without a supporting index (COLLSCAN): {', '.join(collscans)}")
+
+    def save_dead_letters(self, dead_letters):
+        """Record studies whose enrichment failed (trialId -> error) so a later run re-processes them"""
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne(
+                {"trialId": trial_id},
+                {"$set": {"error": error, "updatedAt": now}, "$inc": {"attempts": 1}},
+                upsert=True
+            ) for trial_id, error in dead_letters.items()
+        ]
+        self.dead_letters.bulk_write(operations, ordered=False)
+        self.logger.warning(f"Dead-lettered {len(operations)} studies")
+
+    def fetch_dead_letters(self):
+        return [doc["trialId"] for doc in self.dead_letters.find({}, {"trialId": 1})]
+
+    def delete_dead_letters(self, trial_ids):
+        if trial_ids:
+            self.dead_letters.delete_many({"trialId": {"$in": list(trial_ids)}})
+
     def find_document(self):
         document = self.collection.find_one()
         # Convert ObjectId to string representation
@@ -66,14 +434,64 @@ class MongoDBClient(DBClient):
         document = json.dumps([document], indent=2)
         self.logger.warning(f'{document}')
 
+class AsyncMongoDBClient(DBClient):
+    """asyncio counterpart of MongoDBClient, used by the async pipeline so writes overlap with fetching."""
+
+    def __init__(self):
+        self.logger = get_logger(self.__class__.__name__)
+        url = os.getenv('MONGO_URI', "mongodb://mongo:27017")
+        # The client connects lazily, the first round-trip happens in connect()
+        self.client = AsyncMongoClient(url)
+        self.db = self.client["clinical_trials"]
+        self.collection = self.db["studies"]
+
+    async def connect(self):
+        try:
+            await self.client.admin.command('ping')
+            self.logger.warning("Pinged your deployment. You successfully connected to MongoDB!")
+        except Exception as e:
+            self.logger.warning(f'Error connecting to MongoDB {str(e)}')
+            raise e
+        existing = await self.collection.index_information()
+        for name in LEGACY_INDEXES:
+            if name in existing:
+                await self.collection.drop_index(name)
+        result = await self.collection.create_indexes(STUDY_INDEXES)
+        self.logger.warning(f'Indexes created: {result}')
+
+    async def insert_many_documents(self, documents):
+        if not documents:
+            return
+        result = await self.collection.bulk_write(build_upsert_operations(documents), ordered=False)
+        self.logger.warning(f"Inserted {result.upserted_count} documents")
+        self.logger.warning(f"Updated  {result.modified_count} documents")
+
+    async def save_dead_letters(self, dead_letters):
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne(
+                {"trialId": trial_id},
+                {"$set": {"error": error, "updatedAt": now}, "$inc": {"attempts": 1}},
+                upsert=True
+            ) for trial_id, error in dead_letters.items()
+        ]
+        await self.db["dead_letters"].bulk_write(operations, ordered=False)
+        self.logger.warning(f"Dead-lettered {len(operations)} studies")
+
+    async def close(self):
+        await self.client.close()
+
 class DBClientFactory:
     @staticmethod
     def get_db_client(db_type):
         if db_type == "mongo":
             return MongoDBClient()
+        if db_type == "mongo_async":
+            return AsyncMongoDBClient()
         raise ValueError(f"Unknown database type: {db_type}")
 
 
 if __name__ == "__main__":
     db_client = MongoDBClient()
+    db_client.check_query_plans()
     # db_client.find_document()
\ No newline at end of file
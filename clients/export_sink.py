@@ -0,0 +1,403 @@
+"""
+Columnar export of the enriched studies for analytics, written next to the Mongo `studies`
+collection by the same runs (ClinicalTrialPipeline(export_sinks=["parquet"])).
+
+Three Parquet tables, one directory each under PARQUET_EXPORT_DIR (`exports` by default):
+
+    studies/exportDate=2024-10-22/part-<run>-00000.parquet    one row per study
+    locations/exportDate=2024-10-22/part-<run>-00000.parquet  trialId, facility, city, country
+    diseases/exportDate=2024-10-22/part-<run>-00000.parquet   trialId, disease
+
+Every run appends new files, nothing is rewritten. Each set of files written together has its
+own exportId, shared by the study rows and their child rows. A study exported several times has
+one version per exportId, the one with the latest exportedAt is current. Child rows are sorted
+by country / disease so the row group statistics let scans skip most of a file.
+
+    python -m clients.export_sink  # export the whole Mongo studies collection once
+"""
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from clients.bootstrap import get_logger
+from clients.db_client import SUMMARY_PROJECTION
+from clients.metrics import REGISTRY, SIZE_BUCKETS
+
+PARQUET_WRITE_SECONDS = REGISTRY.histogram("parquet_write_seconds", "Time to write one set of Parquet files")
+PARQUET_WRITE_STUDIES = REGISTRY.histogram(
+    "parquet_write_studies", "Studies per set of Parquet files", buckets=SIZE_BUCKETS
+)
+PARQUET_WRITE_ERRORS = REGISTRY.counter("parquet_write_errors_total", "Failed writes of Parquet files")
+
+TABLES = ("studies", "locations", "diseases")
+# Placeholder of the missing values in the stored documents (see StudyRecord.to_bson)
+_UNKNOWN = "Unknown"
+
+_pyarrow = None
+_pyarrow_lock = threading.Lock()
+
+
+def _load_pyarrow():
+    """(pyarrow, pyarrow.parquet, pyarrow.dataset), imported on first use, pyarrow is optional."""
+    global _pyarrow
+    with _pyarrow_lock:
+        if _pyarrow is None:
+            try:
+                import pyarrow
+                import pyarrow.dataset
+                import pyarrow.parquet
+            except ImportError as e:
+                raise ImportError("The Parquet export needs pyarrow: pip install pyarrow") from e
+            _pyarrow = pyarrow, pyarrow.parquet, pyarrow.dataset
+        return _pyarrow
+
+
+def _schemas(pa):
+    return {
+        "studies": pa.schema([
+            ("trialId", pa.string()),
+            ("title", pa.string()),
+            ("startDate", pa.string()),
+            ("endDate", pa.string()),
+            ("phase", pa.list_(pa.string())),
+            ("piName", pa.string()),
+            ("piAffiliation", pa.string()),
+            ("eligibilityCriteria", pa.string()),
+            ("inclusionCriteria", pa.string()),
+            ("lastUpdateDate", pa.string()),
+            ("contentHash", pa.string()),
+            # False for dead-lettered studies, their diseases are unknown rather than empty
+            ("diseasesExtracted", pa.bool_()),
+            ("exportRun", pa.string()),
+            ("exportId", pa.string()),
+            ("exportedAt", pa.timestamp("us", tz="UTC")),
+        ]),
+        "locations": pa.schema([
+            ("trialId", pa.string()),
+            ("facility", pa.string()),
+            ("city", pa.string()),
+            ("country", pa.string()),
+            ("exportId", pa.string()),
+        ]),
+        "diseases": pa.schema([
+            ("trialId", pa.string()),
+            ("disease", pa.string()),
+            ("exportId", pa.string()),
+        ]),
+    }
+
+
+# Sort order of each table inside a file
+_SORT_KEYS = {
+    "studies": [("trialId", "ascending")],
+    "locations": [("country", "ascending"), ("city", "ascending"), ("trialId", "ascending")],
+    "diseases": [("disease", "ascending"), ("trialId", "ascending")],
+}
+
+
+def _known(value):
+    return None if value == _UNKNOWN else value
+
+
+def flatten_study(document, export_run, export_id, exported_at):
+    """Rows of a stored study document: (study row, location rows, disease rows)."""
+    trial_id = document["trialId"]
+    principal_investigator = document.get("principalInvestigator") or {}
+    diseases = document.get("diseases")
+    study = {
+        "trialId": trial_id,
+        "title": _known(document.get("title")),
+        "startDate": _known(document.get("startDate")),
+        "endDate": _known(document.get("endDate")),
+        "phase": [phase for phase in document.get("phase") or () if phase != _UNKNOWN],
+        "piName": _known(principal_investigator.get("name")),
+        "piAffiliation": _known(principal_investigator.get("affiliation")),
+        "eligibilityCriteria": _known(document.get("eligibilityCriteria")),
+        "inclusionCriteria": document.get("inclusion_criteria"),
+        "lastUpdateDate": _known(document.get("lastUpdateDate")),
+        "contentHash": document.get("contentHash"),
+        "diseasesExtracted": diseases is not None,
+        "exportRun": export_run,
+        "exportId": export_id,
+        "exportedAt": exported_at,
+    }
+    locations = [
+        {
+            "trialId": trial_id,
+            "facility": _known(location.get("facility")),
+            "city": _known(location.get("city")),
+            "country": _known(location.get("country")),
+            "exportId": export_id,
+        }
+        for location in document.get("locations") or ()
+        if any(_known(value) for value in location.values())
+    ]
+    diseases = [{"trialId": trial_id, "disease": disease, "exportId": export_id} for disease in diseases or ()]
+    return study, locations, diseases
+
+
+class ParquetWriter:
+    """
+    Write-behind buffer of the Parquet export, the counterpart of BulkWriter: documents are
+    buffered until max_rows studies are pending, then written as one file per table. An
+    after_writes callback runs once the documents submitted before it are in a file, and none
+    runs anymore once a write failed.
+    """
+
+    def __init__(self, directory, export_run=None, max_rows=50_000, compression="zstd"):
+        self.logger = get_logger(self.__class__.__name__)
+        self.directory = directory
+        # Part of every file name, so the runs append next to each other
+        self.export_run = export_run or f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        self.max_rows = max_rows
+        self.compression = compression
+        self.flush_stats = []
+        self.errors = 0
+        self._pending = []
+        self._callbacks = []
+        self._files = 0
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def submit(self, documents):
+        with self._lock:
+            self._pending.extend(documents)
+            if len(self._pending) >= self.max_rows:
+                self._flush()
+
+    def after_writes(self, callback):
+        with self._lock:
+            if self._pending:
+                self._callbacks.append(callback)
+                return
+        self._run_callback(callback)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _flush(self):
+        documents, self._pending = self._pending, []
+        callbacks, self._callbacks = self._callbacks, []
+        if not documents:
+            return
+        started = time.perf_counter()
+        try:
+            size = self._write(documents)
+        except Exception as e:
+            self.errors += 1
+            self._failed = True
+            PARQUET_WRITE_ERRORS.inc()
+            self.logger.error(f"Parquet export of {len(documents)} documents failed: {str(e)}")
+            if callbacks:
+                self.logger.warning(f"Skipping {len(callbacks)} after-write callbacks, a Parquet write failed")
+            return
+        latency = time.perf_counter() - started
+        PARQUET_WRITE_SECONDS.observe(latency)
+        PARQUET_WRITE_STUDIES.observe(len(documents))
+        stats = {
+            "documents": len(documents),
+            "bytes": size,
+            "latency": latency,
+            "documents_per_second": len(documents) / latency if latency else float("inf"),
+        }
+        self.flush_stats.append(stats)
+        self.logger.warning(
+            f"Exported {len(documents)} studies to Parquet ({size / 1024:.0f} KiB) in {latency * 1000:.0f} ms"
+        )
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def _write(self, documents):
+        pa, pq, _ = _load_pyarrow()
+        exported_at = datetime.now(timezone.utc)
+        export_id = f"{self.export_run}-{self._files:05d}"
+        # The last version of a trial in the batch wins, like the Mongo upserts
+        by_id = {document["trialId"]: document for document in documents}
+        rows = {table: [] for table in TABLES}
+        for document in by_id.values():
+            study, locations, diseases = flatten_study(document, self.export_run, export_id, exported_at)
+            rows["studies"].append(study)
+            rows["locations"].extend(locations)
+            rows["diseases"].extend(diseases)
+
+        schemas = _schemas(pa)
+        partition = f"exportDate={exported_at:%Y-%m-%d}"
+        file_name = f"part-{export_id}.parquet"
+        size = 0
+        for table_name in TABLES:
+            if not rows[table_name]:
+                continue
+            table = pa.Table.from_pylist(rows[table_name], schema=schemas[table_name]).sort_by(_SORT_KEYS[table_name])
+            directory = os.path.join(self.directory, table_name, partition)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, file_name)
+            # Dot files are ignored by dataset readers until the rename makes the file visible
+            temporary_path = os.path.join(directory, f".{file_name}.tmp")
+            pq.write_table(table, temporary_path, compression=self.compression)
+            os.replace(temporary_path, path)
+            size += os.path.getsize(path)
+        self._files += 1
+        return size
+
+    def _run_callback(self, callback):
+        if self._failed:
+            self.logger.warning("Skipping an after-write callback, a Parquet write failed before it")
+            return
+        try:
+            callback()
+        except Exception as e:
+            self.logger.error(f"After-write callback failed: {str(e)}")
+
+
+class ExportSink:
+    """
+    Secondary output of the pipeline, fed with the same documents as the studies collection
+    (see ClinicalTrialPipeline.export_sinks). Mongo stays the source of truth: watermarks, dead
+    letters and checkpoints live there.
+    """
+
+    def __init__(self):
+        self.logger = get_logger(self.__class__.__name__)
+
+    def start_writer(self, **kwargs):
+        """Writer of one run, with the BulkWriter interface (submit, after_writes, flush, close)."""
+        raise NotImplementedError("Subclasses should implement this method")
+
+
+class ParquetExportSink(ExportSink):
+    """
+    Parquet files under PARQUET_EXPORT_DIR, one ParquetWriter (and so one exportRun) per run.
+    find_by_disease / find_by_location scan the latest version of every study with pyarrow.dataset
+    filters, the analytics counterpart of the Mongo queries.
+    """
+
+    def __init__(self, directory=None, max_rows=50_000):
+        super().__init__()
+        self.directory = directory or os.getenv('PARQUET_EXPORT_DIR', 'exports')
+        self.max_rows = max_rows
+        os.makedirs(self.directory, exist_ok=True)
+        self.logger.warning(f'Exporting studies as Parquet files to {os.path.abspath(self.directory)}')
+
+    def start_writer(self, **kwargs):
+        kwargs.setdefault("max_rows", self.max_rows)
+        return ParquetWriter(self.directory, **kwargs)
+
+    def dataset(self, table_name):
+        """pyarrow dataset of one table, None before the first export."""
+        _, _, ds = _load_pyarrow()
+        path = os.path.join(self.directory, table_name)
+        if not os.path.isdir(path):
+            return None
+        return ds.dataset(path, format="parquet", partitioning="hive")
+
+    def _latest_exports(self, trial_ids, columns=("exportId",)):
+        """{trialId: row of its latest export} of the studies table, for the given trials."""
+        studies = self.dataset("studies")
+        if studies is None or not trial_ids:
+            return {}
+        _, _, ds = _load_pyarrow()
+        columns = list(dict.fromkeys([*columns, "trialId", "exportId", "exportedAt"]))
+        rows = studies.to_table(columns=columns, filter=ds.field("trialId").isin(list(trial_ids))).to_pylist()
+        latest = {}
+        for row in rows:
+            current = latest.get(row["trialId"])
+            if current is None or row["exportedAt"] > current["exportedAt"]:
+                latest[row["trialId"]] = row
+        return latest
+
+    def _current_rows(self, table_name, latest):
+        """{trialId: child rows} of the latest export of each trial of `latest`."""
+        dataset = self.dataset(table_name)
+        if dataset is None or not latest:
+            return {}
+        _, _, ds = _load_pyarrow()
+        rows = dataset.to_table(filter=ds.field("trialId").isin(list(latest))).to_pylist()
+        current = {}
+        for row in rows:
+            if row["exportId"] == latest[row["trialId"]]["exportId"]:
+                current.setdefault(row["trialId"], []).append(row)
+        return current
+
+    def find_by_disease(self, disease, after=None, page_size=50):
+        _, _, ds = _load_pyarrow()
+        return self._find_page("diseases", ds.field("disease") == disease, after, page_size)
+
+    def find_by_location(self, country, city=None, after=None, page_size=50):
+        _, _, ds = _load_pyarrow()
+        condition = ds.field("country") == country
+        if city is not None:
+            # Same site, as with the $elemMatch of the Mongo query
+            condition = condition & (ds.field("city") == city)
+        return self._find_page("locations", condition, after, page_size)
+
+    def _find_page(self, table_name, condition, after, page_size):
+        """
+        Same contract as MongoDBClient._find_page with the summary projection (missing values are
+        None): studies ordered by trialId and the `after` value of the next page. The child table
+        is filtered with `condition`, only the rows of the latest export of each trial count.
+        """
+        dataset = self.dataset(table_name)
+        if dataset is None:
+            return [], None
+        _, _, ds = _load_pyarrow()
+        if after is not None:
+            condition = condition & (ds.field("trialId") > after)
+        matches = dataset.to_table(columns=["trialId", "exportId"], filter=condition).to_pylist()
+        current = {(match["trialId"], match["exportId"]) for match in matches}
+        candidates = sorted({match["trialId"] for match in matches})
+        fields = [field for field in SUMMARY_PROJECTION if field not in ("_id", "diseases")]
+        studies = []
+        # Stale versions of a trial may match, read a few more trials than the page needs
+        while candidates and len(studies) < page_size:
+            chunk, candidates = candidates[:page_size * 2], candidates[page_size * 2:]
+            latest = self._latest_exports(chunk, fields)
+            for trial_id in chunk:
+                row = latest.get(trial_id)
+                if row is not None and (trial_id, row["exportId"]) in current:
+                    studies.append(row)
+        studies = studies[:page_size]
+        diseases = self._current_rows("diseases", {study["trialId"]: study for study in studies})
+        studies = [
+            {
+                **{field: study[field] for field in fields},
+                "diseases": [disease["disease"] for disease in diseases.get(study["trialId"], [])],
+            }
+            for study in studies
+        ]
+        next_after = studies[-1]["trialId"] if len(studies) == page_size else None
+        return studies, next_after
+
+
+class ExportSinkFactory:
+    @staticmethod
+    def get_export_sink(sink_type):
+        if sink_type == "parquet":
+            return ParquetExportSink()
+        raise ValueError(f"Unknown export sink type: {sink_type}")
+
+
+if __name__ == "__main__":
+    from clients.db_client import MongoDBClient
+
+    mongo_client = MongoDBClient()
+    export_sink = ParquetExportSink()
+    with export_sink.start_writer() as writer:
+        batch = []
+        for document in mongo_client.collection.find({}, {"_id": 0}).sort("trialId", 1):
+            batch.append(document)
+            if len(batch) == 1000:
+                writer.submit(batch)
+                batch = []
+        writer.submit(batch)
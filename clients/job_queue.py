@@ -0,0 +1,171 @@
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, MongoClient, ReturnDocument, UpdateOne
+
+from clients.bootstrap import get_logger
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue:
+    """
+    Shard jobs shared by several pipeline processes. A job is a date range of a source, claimed by
+    one worker at a time under a lease the worker keeps extending while it runs.
+    """
+
+    def __init__(self):
+        self.logger = get_logger(self.__class__.__name__)
+
+    def enqueue(self, source, shards):
+        """Add one job per (start_date, end_date) shard, jobs already known are left as they are."""
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def claim(self, worker_id, lease_seconds):
+        """Lease the oldest pending (or expired) job to worker_id, None when there is none."""
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def heartbeat(self, job_id, worker_id, lease_seconds):
+        """Extend the lease, False when the job was reclaimed by another worker."""
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def complete(self, job_id, worker_id, **result):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def fail(self, job_id, worker_id, error):
+        """Release the job for a retry, or mark it failed once max_attempts is reached."""
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def reclaim_expired(self):
+        """Release the running jobs whose lease expired, returns how many were released."""
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def counts(self):
+        """{status: number of jobs}"""
+        raise NotImplementedError("Subclasses should implement this method")
+
+
+class MongoJobQueue(JobQueue):
+    """
+    `jobs` collection next to `studies`. Claims are a single find_one_and_update, so two workers
+    never get the same job, and a running job whose lease expired (its worker died or hangs) is
+    claimable again.
+    """
+
+    def __init__(self, db=None, max_attempts=3):
+        super().__init__()
+        if db is None:
+            url = os.getenv('MONGO_URI', "mongodb://mongo:27017")
+            db = MongoClient(url)["clinical_trials"]
+        self.jobs = db["jobs"]
+        self.max_attempts = max_attempts
+        self.jobs.create_index([("status", ASCENDING), ("leaseExpiresAt", ASCENDING), ("startDate", ASCENDING)])
+
+    @staticmethod
+    def job_id(source, start_date, end_date):
+        return f"{source}:{start_date}:{end_date}"
+
+    def enqueue(self, source, shards):
+        if not shards:
+            return 0
+        now = datetime.now(timezone.utc)
+        result = self.jobs.bulk_write([
+            UpdateOne(
+                {"_id": self.job_id(source, start_date, end_date)},
+                {"$setOnInsert": {
+                    "source": source,
+                    "startDate": start_date.isoformat(),
+                    "endDate": end_date.isoformat(),
+                    "status": PENDING,
+                    "attempts": 0,
+                    "createdAt": now,
+                }},
+                upsert=True
+            ) for start_date, end_date in shards
+        ], ordered=False)
+        self.logger.warning(f'Enqueued {result.upserted_count} new jobs out of {len(shards)} shards')
+        return result.upserted_count
+
+    def claim(self, worker_id, lease_seconds):
+        now = datetime.now(timezone.utc)
+        job = self.jobs.find_one_and_update(
+            {
+                "$or": [
+                    {"status": PENDING},
+                    {"status": RUNNING, "leaseExpiresAt": {"$lt": now}},
+                ],
+                "attempts": {"$lt": self.max_attempts},
+            },
+            {
+                "$set": {
+                    "status": RUNNING,
+                    "worker": worker_id,
+                    "leaseExpiresAt": now + timedelta(seconds=lease_seconds),
+                    "heartbeatAt": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("startDate", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+        if job is not None and job["attempts"] > 1:
+            self.logger.warning(f'{worker_id} reclaimed job {job["_id"]} (attempt {job["attempts"]})')
+        return job
+
+    def heartbeat(self, job_id, worker_id, lease_seconds):
+        now = datetime.now(timezone.utc)
+        result = self.jobs.update_one(
+            {"_id": job_id, "worker": worker_id, "status": RUNNING},
+            {"$set": {"leaseExpiresAt": now + timedelta(seconds=lease_seconds), "heartbeatAt": now}}
+        )
+        return result.matched_count == 1
+
+    def complete(self, job_id, worker_id, **result):
+        self.jobs.update_one(
+            {"_id": job_id, "worker": worker_id},
+            {"$set": {**result, "status": DONE, "finishedAt": datetime.now(timezone.utc)}, "$unset": {"leaseExpiresAt": ""}}
+        )
+
+    def fail(self, job_id, worker_id, error):
+        job = self.jobs.find_one({"_id": job_id, "worker": worker_id}, {"attempts": 1})
+        if job is None:
+            return
+        status = FAILED if job["attempts"] >= self.max_attempts else PENDING
+        self.jobs.update_one(
+            {"_id": job_id, "worker": worker_id},
+            {"$set": {"status": status, "error": str(error)}, "$unset": {"leaseExpiresAt": ""}}
+        )
+
+    def reclaim_expired(self):
+        now = datetime.now(timezone.utc)
+        expired = {"status": RUNNING, "leaseExpiresAt": {"$lt": now}}
+        # Out of attempts: a job that keeps killing its workers is not handed out forever
+        self.jobs.update_many(
+            {**expired, "attempts": {"$gte": self.max_attempts}},
+            {"$set": {"status": FAILED, "error": "lease expired"}, "$unset": {"leaseExpiresAt": ""}}
+        )
+        released = self.jobs.update_many(
+            expired, {"$set": {"status": PENDING}, "$unset": {"leaseExpiresAt": ""}}
+        ).modified_count
+        if released:
+            self.logger.warning(f'Released {released} jobs whose lease expired')
+        return released
+
+    def counts(self):
+        counts = {status: 0 for status in (PENDING, RUNNING, DONE, FAILED)}
+        for row in self.jobs.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            counts[row["_id"]] = row["count"]
+        return counts
+
+
+class JobQueueClientFactory:
+    @staticmethod
+    def get_job_queue_client(queue_type):
+        if queue_type == "mongo":
+            return MongoJobQueue()
+        raise ValueError(f"Unknown job queue type: {queue_type}")
@@ -0,0 +1,94 @@
+import codecs
+import json
+
+
+class StreamingPageParser:
+    """
+    Incremental parser for API pages shaped like {"studies": [...], "nextPageToken": "..."}.
+
+    `parse` consumes the response body chunk by chunk and yields the items of `array_key` one at a
+    time, so only one study (plus the current chunk) is held as text. The other top-level keys end
+    up in `metadata` once the generator is exhausted.
+    """
+
+    def __init__(self, array_key="studies"):
+        self.array_key = array_key
+        self.metadata = {}
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._chunks = None
+        self._buffer = ""
+        self._pos = 0
+        self._exhausted = False
+
+    def parse(self, chunks):
+        self._chunks = iter(chunks)
+        self._expect("{")
+        while True:
+            char = self._peek()
+            if char == "}":
+                self._pos += 1
+                return
+            if char == ",":
+                self._pos += 1
+                continue
+            key = self._decode_value()
+            self._expect(":")
+            if key == self.array_key:
+                yield from self._parse_array()
+            else:
+                self.metadata[key] = self._decode_value()
+
+    def _parse_array(self):
+        self._expect("[")
+        while True:
+            char = self._peek()
+            if char == "]":
+                self._pos += 1
+                return
+            if char == ",":
+                self._pos += 1
+                continue
+            yield self._decode_value()
+
+    def _fill(self):
+        """Append the next chunk to the buffer, dropping what was already consumed."""
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            text = self._text_decoder.decode(b"", final=True)
+            self._exhausted = True
+        else:
+            text = self._text_decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        self._buffer = self._buffer[self._pos:] + text
+        self._pos = 0
+
+    def _peek(self):
+        """Next non-whitespace character, without consuming it."""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\r\n":
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if self._exhausted:
+                raise ValueError("Unexpected end of JSON stream")
+            self._fill()
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} at offset {self._pos} of the JSON stream, found {found!r}")
+        self._pos += 1
+
+    def _decode_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A number ending with the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._exhausted:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._exhausted:
+                    raise
+            self._fill()
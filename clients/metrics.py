@@ -0,0 +1,207 @@
+"""
+In-process metrics: counters and fixed-bucket histograms, rendered in the Prometheus text format
+by a local `/metrics` endpoint and summarized at the end of a pipeline run.
+
+Recording is a dict lookup, a bisect and one short lock, cheap enough for the enrichment threads.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, from a cache lookup to a slow LLM answer
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10_000, 50_000, 100_000, 1_000_000, 10_000_000)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One slot per bucket upper bound, plus +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+def _quantile(buckets, counts, count, quantile):
+    """Estimate a quantile from bucket counts, interpolating inside the bucket like Prometheus does."""
+    if not count:
+        return 0.0
+    rank = quantile * count
+    seen = 0
+    for index, bucket_count in enumerate(counts):
+        if seen + bucket_count >= rank and bucket_count:
+            lower = buckets[index - 1] if index else 0.0
+            if index == len(buckets):
+                # Beyond the last bound, the best estimate is that bound
+                return buckets[-1]
+            return lower + (buckets[index] - lower) * (rank - seen) / bucket_count
+        seen += bucket_count
+    return buckets[-1]
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class MetricsRegistry:
+    """Families of metrics by name, each family holding one metric per label set."""
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text, **labels):
+        return self._get(name, "counter", help_text, labels, Counter)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+        return self._get(name, "histogram", help_text, labels, lambda: Histogram(buckets))
+
+    def _get(self, name, kind, help_text, labels, factory):
+        key = tuple(sorted(labels.items()))
+        family = self._families.get(name)
+        if family is None or key not in family[2]:
+            with self._lock:
+                family = self._families.setdefault(name, (kind, help_text, {}))
+                family[2].setdefault(key, factory())
+        return family[2][key]
+
+    def snapshot(self):
+        """Current values, to summarize what happened since (see summary)."""
+        with self._lock:
+            families = {name: (kind, dict(metrics)) for name, (kind, _, metrics) in self._families.items()}
+        return {
+            (name, key): metric.snapshot()
+            for name, (kind, metrics) in families.items()
+            for key, metric in metrics.items()
+        }
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            families = sorted((name, kind, help_text, dict(metrics)) for name, (kind, help_text, metrics) in self._families.items())
+        for name, kind, help_text, metrics in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, metric in sorted(metrics.items()):
+                if kind == "counter":
+                    lines.append(f"{name}{_format_labels(key)} {metric.snapshot()}")
+                    continue
+                counts, total, count = metric.snapshot()
+                cumulative = 0
+                for bound, bucket_count in zip(list(metric.buckets) + ["+Inf"], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def histogram_stats(self, since=None):
+        """{(name, labels): {"count", "mean", "p50", "p99"}} of the histograms observed since a snapshot."""
+        since = since or {}
+        stats = {}
+        with self._lock:
+            families = sorted((name, dict(metrics)) for name, (kind, _, metrics) in self._families.items() if kind == "histogram")
+        for name, metrics in families:
+            for key, metric in sorted(metrics.items()):
+                counts, total, count = metric.snapshot()
+                previous = since.get((name, key))
+                if previous is not None:
+                    counts = [now - before for now, before in zip(counts, previous[0])]
+                    total, count = total - previous[1], count - previous[2]
+                if not count:
+                    continue
+                stats[(name, key)] = {
+                    "count": count,
+                    "mean": total / count,
+                    "p50": _quantile(metric.buckets, counts, count, 0.5),
+                    "p99": _quantile(metric.buckets, counts, count, 0.99),
+                }
+        return stats
+
+    def summary(self, since=None):
+        """
+        Human readable totals since a snapshot: one line per counter, and count, mean, p50 and p99
+        per histogram. Metrics that did not move are left out.
+        """
+        since = since or {}
+        lines = []
+        with self._lock:
+            counters = sorted((name, dict(metrics)) for name, (kind, _, metrics) in self._families.items() if kind == "counter")
+        for name, metrics in counters:
+            for key, metric in sorted(metrics.items()):
+                value = metric.snapshot() - since.get((name, key), 0)
+                if value:
+                    lines.append(f"{name}{_format_labels(key)}: {value}")
+        for (name, key), stats in self.histogram_stats(since).items():
+            lines.append(
+                f"{name}{_format_labels(key)}: count={stats['count']} mean={stats['mean']:.4g} "
+                f"p50={stats['p50']:.4g} p99={stats['p99']:.4g}"
+            )
+        return "\n".join(lines)
+
+
+# Shared by every client, transformation and pipeline of the process
+REGISTRY = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=9100, host="0.0.0.0", registry=REGISTRY):
+    """Serve `registry` on http://host:port/metrics from a daemon thread, returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
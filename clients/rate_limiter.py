@@ -0,0 +1,165 @@
+import asyncio
+import random
+import re
+import sys
+import threading
+import time
+
+from clients.bootstrap import get_logger
+
+
+def parse_reset_duration(value):
+    """Turn OpenAI reset headers such as '1s', '6m0s', '20ms' or '0.5' into seconds."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    `reserve` never blocks: it takes the tokens (the level may go negative) and returns how long
+    the caller has to wait, so the same bucket serves threads (time.sleep) and coroutines
+    (asyncio.sleep).
+    """
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.level = float(capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def reserve(self, amount=1):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # A single request larger than the bucket must still go through eventually
+            self.level -= min(float(amount), self.capacity)
+            if self.level >= 0:
+                return 0.0
+            return -self.level / self.refill_per_second
+
+    def sync(self, limit=None, remaining=None, reset_seconds=None):
+        """Align the bucket with what the server reports."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if limit:
+                self.capacity = float(limit)
+                self.refill_per_second = float(limit) / 60.0
+            if remaining is not None:
+                if remaining <= 0 and reset_seconds:
+                    # Nothing left until the server resets the window
+                    self.level = min(self.level, -reset_seconds * self.refill_per_second)
+                else:
+                    self.level = min(self.level, float(remaining))
+
+
+class OpenAIRateLimiter:
+    """Shared requests-per-minute and tokens-per-minute limiter, tuned by the x-ratelimit-* headers."""
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200_000):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+
+    def reserve(self, tokens):
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def acquire(self, tokens):
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens):
+        wait = self.reserve(tokens)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+        if not headers:
+            return
+        headers = {key.lower(): value for key, value in headers.items()}
+        for kind, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            bucket.sync(
+                limit=float(limit) if limit is not None else None,
+                remaining=float(remaining) if remaining is not None else None,
+                reset_seconds=parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}")),
+            )
+
+
+class RetryScheduler:
+    """Exponential backoff with full jitter for transient OpenAI errors (429, 5xx, timeouts)."""
+
+    # Exception classes of the openai package, looked up once the LLM stack is loaded
+    RETRYABLE_ERRORS = ("RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError")
+
+    def __init__(self, max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.logger = get_logger(self.__class__.__name__)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, error):
+        openai = sys.modules.get("openai")
+        if openai is None:
+            # The LLM stack was never imported, the error cannot come from the OpenAI client
+            return False
+        if isinstance(error, openai.RateLimitError) and getattr(error, "code", None) == "insufficient_quota":
+            # Quota errors do not go away by waiting
+            return False
+        return isinstance(error, tuple(getattr(openai, name) for name in self.RETRYABLE_ERRORS))
+
+    def delay(self, attempt, error=None):
+        retry_after = self._retry_after(error)
+        if retry_after is not None:
+            return min(self.max_delay, retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, function, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not self.is_retryable(e):
+                    raise
+                delay = self.delay(attempt, e)
+                self.logger.warning(f'{type(e).__name__}, retrying in {delay:.2f}s (attempt {attempt + 1}/{self.max_retries})')
+                time.sleep(delay)
+
+    async def acall(self, function, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await function(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not self.is_retryable(e):
+                    raise
+                delay = self.delay(attempt, e)
+                self.logger.warning(f'{type(e).__name__}, retrying in {delay:.2f}s (attempt {attempt + 1}/{self.max_retries})')
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _retry_after(error):
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        headers = response.headers
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        return parse_reset_duration(headers.get("retry-after"))
@@ -1,12 +1,67 @@
+import argparse
 from datetime import date
+from clients.api_client import APIClientFactory
+from clients.bootstrap import bootstrap
+from clients.job_queue import JobQueueClientFactory
+from clients.metrics import start_metrics_server
 from pipelines.trial_pipeline import ClinicalTrialPipeline
+from pipelines.async_trial_pipeline import AsyncClinicalTrialPipeline
+from pipelines.job_worker import JobCoordinator, JobWorker
 
-from dotenv import load_dotenv
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch, enrich and store clinical trials")
+    parser.add_argument("--async-mode", action="store_true",
+                        help="overlap fetching, LLM extraction and DB writes with the asyncio pipeline")
+    parser.add_argument("--incremental", action="store_true",
+                        help="resume from the stored LastUpdatePostDate watermark and skip unchanged studies")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="crawl the date range as parallel LastUpdatePostDate shards with that many threads")
+    parser.add_argument("--run-id", default=None,
+                        help="checkpoint name, an interrupted run started with the same id is resumed")
+    parser.add_argument("--start", type=date.fromisoformat, default=date(2024, 10, 20))
+    parser.add_argument("--end", type=date.fromisoformat, default=date(2024, 10, 22))
+    parser.add_argument("--coordinator", action="store_true",
+                        help="split --start..--end into shard jobs of the Mongo job queue (add --wait to follow them "
+                             "and then re-process the dead letters)")
+    parser.add_argument("--wait", action="store_true", help="with --coordinator, block until every job is done")
+    parser.add_argument("--worker", action="store_true",
+                        help="claim and run shard jobs from the Mongo job queue until it is drained")
+    parser.add_argument("--worker-id", default=None, help="defaults to hostname:pid")
+    parser.add_argument("--export", action="append", choices=["parquet"], default=[],
+                        help="also append the studies to columnar files under PARQUET_EXPORT_DIR, next to Mongo")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on http://0.0.0.0:PORT/metrics while the run lasts")
+    args = parser.parse_args()
+    bootstrap()
 
-load_dotenv(override=True)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
 
-if __name__ == "__main__":
-    start_date = date(2024, 10, 20)
-    end_date = date(2024, 10, 22)
-    pipeline = ClinicalTrialPipeline()
-    pipeline.run(start_date, end_date)
+    start_date = args.start
+    end_date = args.end
+    if args.coordinator:
+        coordinator = JobCoordinator(
+            APIClientFactory.get_api_client("clinical_trials"), "clinical_trials",
+            JobQueueClientFactory.get_job_queue_client("mongo")
+        )
+        coordinator.plan(start_date, end_date)
+        if args.wait:
+            coordinator.wait()
+            # Once for the whole backfill, the workers skip them
+            pipeline = ClinicalTrialPipeline(export_sinks=args.export)
+            pipeline.reprocess_dead_letters()
+            pipeline.close()
+    elif args.worker:
+        # Checkpoints in Mongo, so a job reclaimed from a dead worker resumes where it stopped
+        worker = JobWorker(
+            ClinicalTrialPipeline(checkpoint_type="mongo", export_sinks=args.export), JobQueueClientFactory.get_job_queue_client("mongo"),
+            worker_id=args.worker_id
+        )
+        worker.run()
+    elif args.incremental:
+        ClinicalTrialPipeline(shard_workers=args.shards, export_sinks=args.export).run_incremental(initial_start_date=start_date, run_id=args.run_id)
+    else:
+        if args.async_mode:
+            AsyncClinicalTrialPipeline(export_sinks=args.export).run(start_date, end_date)
+        else:
+            ClinicalTrialPipeline(shard_workers=args.shards, export_sinks=args.export).run(start_date, end_date, run_id=args.run_id)
@@ -0,0 +1,162 @@
+import asyncio
+from datetime import date
+
+from clients.metrics import REGISTRY
+from pipelines.trial_pipeline import EXTRACTIONS, PAGE_ENRICH_SECONDS, ClinicalTrialPipeline
+from transformations.trial_transformation import ClinicalTrialTransformationMapping
+from transformations.llm_extraction import DiseaseExtractionTransformation
+
+
+class AsyncClinicalTrialPipeline(ClinicalTrialPipeline):
+    """
+    asyncio version of ClinicalTrialPipeline.run.
+
+    Fetching, LLM enrichment and bulk writes run as concurrent stages connected by bounded
+    queues: the API, OpenAI and MongoDB are all busy at the same time, and a slow stage makes
+    the previous ones wait instead of piling pages up in memory.
+    """
+
+    def __init__(self, api_source="clinical_trials_async", db_type="mongo_async", cache_type="sqlite",
+                 llm=None, llm_concurrency=64, enrich_workers=2, queue_size=2, match_min_coverage=0.8,
+                 export_sinks=()):
+        # Checkpoints are not supported by the asyncio stages yet
+        super().__init__(api_source=api_source, db_type=db_type, cache_type=cache_type, llm=llm,
+                         match_min_coverage=match_min_coverage, checkpoint_type=None,
+                         export_sinks=export_sinks)
+        self.llm_concurrency = llm_concurrency
+        self.enrich_workers = enrich_workers
+        self.queue_size = queue_size
+
+    def run(self, start_date, end_date):
+        return asyncio.run(self.arun(start_date, end_date))
+
+    async def arun(self, start_date, end_date):
+        """Returns True when every page was fetched and written, like ClinicalTrialPipeline.run."""
+        pages = asyncio.Queue(maxsize=self.queue_size)
+        enriched_pages = asyncio.Queue(maxsize=self.queue_size)
+        # Shared by every in-flight study so the number of open LLM requests stays bounded
+        llm_semaphore = asyncio.Semaphore(self.llm_concurrency)
+        # One extractor per run rather than the shared llm_facade: its async connection pool is
+        # bound to the event loop of this run, and closed when the run ends
+        llm_facade = DiseaseExtractionTransformation(
+            llm=self.llm, rate_limiter=self.rate_limiter,
+            max_connections=self.llm_max_connections, keepalive_expiry=self.llm_keepalive_expiry,
+            max_prompt_tokens=self.max_prompt_tokens
+        )
+        metrics_snapshot = REGISTRY.snapshot()
+        completed = False
+
+        await self.db_client.connect()
+        tasks = [
+            asyncio.create_task(self._fetch_stage(start_date, end_date, pages)),
+            *[
+                asyncio.create_task(self._enrich_stage(pages, enriched_pages, llm_facade, llm_semaphore))
+                for _ in range(self.enrich_workers)
+            ],
+            asyncio.create_task(self._write_stage(enriched_pages)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+            completed = getattr(self.crawler, 'last_error', None) is None
+        finally:
+            # A failing stage must not leave the others blocked on a queue forever
+            for task in tasks:
+                task.cancel()
+            write_errors = self.close()
+            completed = completed and not write_errors
+            await llm_facade.aclose()
+            if hasattr(self.db_client, 'close'):
+                await self.db_client.close()
+            self._log_metrics_summary(metrics_snapshot)
+        if self.cache is not None:
+            self.logger.warning(f'Extraction cache stats: {self.cache.stats()}')
+        return completed
+
+    async def _fetch_stage(self, start_date, end_date, pages):
+        async for studies in self.crawler.afetch_trials(start_date, end_date, page_size=500):
+            await pages.put(studies)
+        for _ in range(self.enrich_workers):
+            await pages.put(None)
+
+    async def _enrich_stage(self, pages, enriched_pages, llm_facade, llm_semaphore):
+        loop = asyncio.get_running_loop()
+        while True:
+            studies = await pages.get()
+            if studies is None:
+                await enriched_pages.put(None)
+                return
+            parsed_studies = ClinicalTrialTransformationMapping().transform(studies)
+            started = loop.time()
+            # Off the event loop, the CPU stage may wait for the process pool
+            await loop.run_in_executor(None, self.prepare_criteria, parsed_studies)
+            await asyncio.gather(*[
+                self._aprocess_single_study(study, llm_facade, llm_semaphore) for study in parsed_studies
+            ])
+            PAGE_ENRICH_SECONDS.observe(loop.time() - started)
+            self.logger.info(f'Enriched {len(parsed_studies)} studies')
+            await enriched_pages.put(parsed_studies)
+
+    async def _aprocess_single_study(self, study, llm_facade, llm_semaphore):
+        if not study.trialId or study.inclusion_criteria is None:
+            return study
+        inclusion_criteria = study.inclusion_criteria
+        if not inclusion_criteria.strip():
+            study.diseases = []
+            return study
+        loop = asyncio.get_running_loop()
+        # The matcher and the SQLite/Mongo cache are blocking, they would stall the fetch and write stages
+        diseases, source, prompt_text = await loop.run_in_executor(None, self._serve_locally, inclusion_criteria)
+        if source is not None:
+            EXTRACTIONS[source].inc()
+            study.diseases = diseases
+            return study
+        async with llm_semaphore:
+            try:
+                diseases = await self.retry_scheduler.acall(llm_facade.aextract, prompt_text)
+            except Exception as e:
+                await loop.run_in_executor(None, self._dead_letter, study.trialId, e)
+                study.diseases = None
+                return study
+        EXTRACTIONS["llm"].inc()
+        await loop.run_in_executor(None, self._set_cached_diseases, inclusion_criteria, diseases)
+        study.diseases = diseases
+        return study
+
+    def _serve_locally(self, inclusion_criteria):
+        """
+        (diseases, source, None) when the matcher or the cache answers, else (None, None, prompt text).
+        A prompt left empty by the boilerplate stripping needs no LLM call either.
+        """
+        matched_diseases = self._match_diseases(inclusion_criteria)
+        if matched_diseases is not None:
+            return matched_diseases, "matcher", None
+        cached_diseases = self._get_cached_diseases(inclusion_criteria)
+        if cached_diseases is not None:
+            return cached_diseases, "cache", None
+        prompt_text = self._prompt_text(inclusion_criteria)
+        if not prompt_text:
+            return [], "matcher", None
+        return None, None, prompt_text
+
+    async def _write_stage(self, enriched_pages):
+        finished_workers = 0
+        while finished_workers < self.enrich_workers:
+            studies = await enriched_pages.get()
+            if studies is None:
+                finished_workers += 1
+                continue
+            documents = [study.to_bson() for study in studies]
+            await self.db_client.insert_many_documents(documents)
+            if self.export_sinks:
+                # A Parquet file may be written by this call, off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, self.export, documents)
+            with self._dead_letters_lock:
+                dead_letters, self.dead_letters = self.dead_letters, {}
+            if dead_letters:
+                # Re-processed by the next ClinicalTrialPipeline.run
+                await self.db_client.save_dead_letters(dead_letters)
+
+
+if __name__ == "__main__":
+    pipeline = AsyncClinicalTrialPipeline()
+    pipeline.run(date(2024, 10, 20), date(2024, 10, 21))
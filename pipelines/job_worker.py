@@ -0,0 +1,123 @@
+"""
+Distributed backfill: a coordinator splits a date range into shard jobs of the job queue, and any
+number of worker processes (or containers) claim them and run ClinicalTrialPipeline.run on each.
+
+    python main.py --coordinator --start 2024-01-01 --end 2024-10-22
+    docker-compose --profile backfill up --scale worker=4 worker
+"""
+import threading
+import time
+from datetime import date, timedelta
+
+from clients.bootstrap import get_logger
+from clients.job_queue import PENDING, RUNNING, default_worker_id
+from clients.metrics import REGISTRY
+
+JOBS_DONE = REGISTRY.counter("jobs_total", "Shard jobs processed by this worker", outcome="done")
+JOBS_FAILED = REGISTRY.counter("jobs_total", "Shard jobs processed by this worker", outcome="failed")
+
+
+def daily_shards(start_date, end_date):
+    """One shard per day, for sources that cannot count studies."""
+    days = (end_date - start_date).days
+    return [(start_date + timedelta(days=day), start_date + timedelta(days=day)) for day in range(days + 1)]
+
+
+class JobCoordinator:
+    def __init__(self, crawler, api_source, job_queue):
+        self.logger = get_logger(self.__class__.__name__)
+        self.crawler = crawler
+        self.api_source = api_source
+        self.job_queue = job_queue
+
+    def plan(self, start_date, end_date, target_shard_size=5000):
+        """Enqueue the shards of [start_date, end_date], sized with the study counts of the API when available."""
+        if hasattr(self.crawler, 'shard_date_range'):
+            shards = [(shard_start, shard_end) for shard_start, shard_end, _ in
+                      self.crawler.shard_date_range(start_date, end_date, target_shard_size)]
+        else:
+            shards = daily_shards(start_date, end_date)
+        self.logger.warning(f'Planned {len(shards)} shard jobs from {start_date} to {end_date}')
+        return self.job_queue.enqueue(self.api_source, shards)
+
+    def wait(self, poll_interval=10.0):
+        """Block until no job is pending or running, returns the final counts."""
+        while True:
+            self.job_queue.reclaim_expired()
+            counts = self.job_queue.counts()
+            self.logger.warning(f'Jobs: {counts}')
+            if not counts[PENDING] and not counts[RUNNING]:
+                return counts
+            time.sleep(poll_interval)
+
+
+class JobWorker:
+    """
+    Claims jobs until the queue is drained. While a job runs, a heartbeat thread extends its lease
+    every heartbeat_interval seconds. A job whose lease expired is reclaimed by another worker,
+    which resumes it from its checkpoint (the run id is the job id) when checkpoints live in Mongo.
+    """
+
+    def __init__(self, pipeline, job_queue, worker_id=None, lease_seconds=300, heartbeat_interval=60,
+                 poll_interval=5.0):
+        self.logger = get_logger(self.__class__.__name__)
+        self.pipeline = pipeline
+        self.job_queue = job_queue
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+
+    def run(self, max_jobs=None):
+        """Process jobs until none is pending or running (or max_jobs are done), returns the jobs processed."""
+        processed = 0
+        while max_jobs is None or processed < max_jobs:
+            job = self.job_queue.claim(self.worker_id, self.lease_seconds)
+            if job is None:
+                self.job_queue.reclaim_expired()
+                counts = self.job_queue.counts()
+                if not counts[PENDING] and not counts[RUNNING]:
+                    break
+                # Jobs still running elsewhere may expire and need a new owner
+                time.sleep(self.poll_interval)
+                continue
+            self.run_job(job)
+            processed += 1
+        self.logger.warning(f'Worker {self.worker_id} stops after {processed} jobs')
+        return processed
+
+    def run_job(self, job):
+        job_id = job["_id"]
+        self.logger.warning(f'Worker {self.worker_id} runs job {job_id} (attempt {job["attempts"]})')
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, stop), daemon=True)
+        heartbeat.start()
+        started = time.perf_counter()
+        try:
+            # Dead letters are re-processed once by the coordinator, not by every job of every worker
+            completed = self.pipeline.run(
+                date.fromisoformat(job["startDate"]), date.fromisoformat(job["endDate"]), run_id=job_id,
+                reprocess_dead_letters=False
+            )
+        except Exception as e:
+            self.logger.error(f'Job {job_id} failed: {str(e)}')
+            self.job_queue.fail(job_id, self.worker_id, e)
+            JOBS_FAILED.inc()
+            return False
+        finally:
+            stop.set()
+            heartbeat.join()
+        if not completed:
+            self.job_queue.fail(job_id, self.worker_id, "crawl or writes interrupted")
+            JOBS_FAILED.inc()
+            return False
+        self.job_queue.complete(job_id, self.worker_id, seconds=time.perf_counter() - started)
+        JOBS_DONE.inc()
+        return True
+
+    def _heartbeat(self, job_id, stop):
+        while not stop.wait(self.heartbeat_interval):
+            if not self.job_queue.heartbeat(job_id, self.worker_id, self.lease_seconds):
+                # The writes are idempotent, finishing the job is harmless, complete() is then a no-op
+                self.logger.warning(f'Lost the lease of job {job_id} to another worker')
+                return
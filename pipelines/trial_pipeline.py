@@ -1,44 +1,113 @@
-import sys
-
-import re
-import logging
+import os
 import json
+import threading
 
 from datetime import date
 from clients.api_client import APIClientFactory
+from clients.bootstrap import get_logger
 from clients.db_client import DBClientFactory
-from transformations.trial_transformation import ClinicalTrialTransformationMapping
-from transformations.llm_extraction import DiseaseExtractionTransformation
-from concurrent.futures import ThreadPoolExecutor
+from clients.cache_client import CacheClientFactory, make_cache_key
+from clients.checkpoint_client import CheckpointClientFactory
+from clients.export_sink import ExportSinkFactory
+from clients.metrics import REGISTRY
+from clients.rate_limiter import OpenAIRateLimiter, RetryScheduler
+from transformations.trial_transformation import ClinicalTrialTransformationMapping, StudyRecord
+from transformations.llm_extraction import DiseaseExtractionTransformation, batch_by_token_budget
+from transformations.disease_matcher import DiseaseMatcher
+from transformations.eligibility import split_eligibility_batch, strip_boilerplate
+from transformations.tokens import count_tokens
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+
+# Where each disease list came from, the matcher and cache shares are what keeps LLM spend down
+EXTRACTIONS = {
+    source: REGISTRY.counter("disease_extractions_total", "Disease lists produced, by source", source=source)
+    for source in ("matcher", "cache", "llm")
+}
+DEAD_LETTERS = REGISTRY.counter("dead_letters_total", "Studies whose disease extraction failed")
+STRIPPED_PROMPT_TOKENS = REGISTRY.counter("prompt_tokens_stripped_total", "Boilerplate tokens kept out of LLM prompts")
+PAGE_ENRICH_SECONDS = REGISTRY.histogram("page_enrich_seconds", "Enrichment time of one page of studies")
+PAGE_WRITE_SECONDS = REGISTRY.histogram("page_write_seconds", "Time to hand one page of studies to the database")
 
 class ClinicalTrialPipeline:
-    def __init__(self, api_source="clinical_trials", db_type="mongo"):
+    def __init__(self, api_source="clinical_trials", db_type="mongo", cache_type="sqlite",
+                 batch_token_budget=None, llm=None, requests_per_minute=500, tokens_per_minute=200_000,
+                 shard_workers=None, write_behind=True, match_min_coverage=0.8,
+                 cpu_workers=min(4, os.cpu_count() or 1), cpu_chunk_size=64, checkpoint_type="file",
+                 llm_max_connections=None, llm_keepalive_expiry=None, max_prompt_tokens=None, compact_prompts=True,
+                 export_sinks=()):
+        self.api_source = api_source
         self.crawler = APIClientFactory.get_api_client(api_source)
         self.db_client = DBClientFactory.get_db_client(db_type)
-        # self.llm_facade = DiseaseExtractionTransformation()
+        self.cache = CacheClientFactory.get_cache_client(cache_type)
+        # Progress of the current run (page token, completed shards, enrichment results) so an
+        # interrupted run resumes where it stopped instead of paying the LLM calls again
+        self.checkpoints = CheckpointClientFactory.get_checkpoint_client(checkpoint_type)
+        self.run_id = None
+        self._checkpoint = {}
+        self._checkpointed_results = {}
+        self._completed_shards = []
+        # When set, inclusion criteria are packed into multi-study prompts of at most this many tokens
+        self.batch_token_budget = batch_token_budget
+        # None means ChatOpenAI, a FakeDiseaseLLM can be passed for offline runs
+        self.llm = llm
+        # One extractor for every thread, page and run, built on first use (see llm_facade). The
+        # OpenAI connection pool is capped at llm_max_connections (LLM_MAX_CONNECTIONS by default)
+        self.llm_max_connections = llm_max_connections
+        self.llm_keepalive_expiry = llm_keepalive_expiry
+        self._llm_facade = None
+        self._llm_facade_lock = threading.Lock()
+        # Prompt size control: boilerplate criteria (age, consent, contraception...) are left out of
+        # the prompts, and texts over max_prompt_tokens (LLM_MAX_PROMPT_TOKENS by default) are chunked
+        self.max_prompt_tokens = max_prompt_tokens
+        self.compact_prompts = compact_prompts
+        # Dictionary pre-match, the LLM is only called when it explains less than match_min_coverage
+        # of the condition words of a text. None always calls the LLM
+        self.disease_matcher = DiseaseMatcher()
+        self.match_min_coverage = match_min_coverage
+        # When set, the date range is split into shards crawled by that many threads
+        self.shard_workers = shard_workers
+        # Writes go through a background BulkWriter instead of blocking after every page
+        self.write_behind = write_behind
+        self.bulk_writer = None
+        # Secondary outputs (e.g. "parquet") fed with the same documents as Mongo, one writer per run
+        self.export_sinks = [
+            ExportSinkFactory.get_export_sink(sink) if isinstance(sink, str) else sink for sink in export_sinks
+        ]
+        self.export_writers = []
+        # Eligibility texts are split by a process pool so the regex work does not hold the GIL
+        # the LLM threads need. Texts are sent cpu_chunk_size at a time, 1 worker splits in-process
+        self.cpu_workers = cpu_workers
+        self.cpu_chunk_size = cpu_chunk_size
+        self._cpu_pool = None
+        # The two enrichment stages of the async pipeline prepare criteria concurrently
+        self._cpu_pool_lock = threading.Lock()
+        # Shared by every enrichment thread, refined by the rate limit headers OpenAI sends back
+        self.rate_limiter = OpenAIRateLimiter(requests_per_minute, tokens_per_minute)
+        self.retry_scheduler = RetryScheduler()
+        # trialId -> error of the extractions that failed after all retries, re-processed by the next run
+        self.dead_letters = {}
+        self._dead_letters_lock = threading.Lock()
         
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
-            handlers=[
-                logging.FileHandler('clinical_trials_processing.log'),
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
-        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger = get_logger(self.__class__.__name__)
     
     def enrich(self, parsed_studies):
         """
         Extract eligibility criteria from multiple parsed studies in parallel using threads.
         
         Args:
-            parsed_studies (list): A list of dictionaries containing parsed study data.
+            parsed_studies (list): A list of StudyRecord.
         
         Returns:
-            list: A list of dictionaries containing study IDs and their eligibility criteria.
+            list: The same records, with their inclusion criteria and diseases set.
         """
-        from concurrent.futures import ThreadPoolExecutor
-        
+        if not parsed_studies:
+            return parsed_studies
+        self.prepare_criteria(parsed_studies)
+        if self.batch_token_budget:
+            return self.enrich_batched(parsed_studies)
+
         # Use more threads since they're lighter than processes
         num_workers = min(500, len(parsed_studies))  # Cap at 32 threads
         self.logger.warning(f'Starting parallel processing with {num_workers} threads')
@@ -48,36 +117,516 @@ class ClinicalTrialPipeline:
         
         self.logger.info(f'Enriched {len(enriched_studies)} studies in parallel')
         return enriched_studies
-          
-    @staticmethod
-    def _process_single_study(study):
+
+    def enrich_batched(self, parsed_studies, max_workers=16):
+        """
+        Extract diseases with multi-study prompts sized by `batch_token_budget`.
+
+        Cache hits are served first, the remaining inclusion criteria are packed into batches sent
+        in parallel, and any study missing from a batch answer falls back to a single-study call.
+        """
+        self.prepare_criteria(parsed_studies)
+        # A list, not keyed by trialId: a page can hold the same trial twice
+        pending = []
+        for study in parsed_studies:
+            if study.trialId and study.inclusion_criteria is not None:
+                inclusion_criteria = study.inclusion_criteria
+                if not inclusion_criteria.strip():
+                    # No inclusion section, nothing to extract
+                    study.diseases = []
+                    continue
+                matched_diseases = self._match_diseases(inclusion_criteria)
+                cached_diseases = self._get_cached_diseases(inclusion_criteria) if matched_diseases is None else None
+                if matched_diseases is not None:
+                    EXTRACTIONS["matcher"].inc()
+                    study.diseases = matched_diseases
+                elif cached_diseases is not None:
+                    EXTRACTIONS["cache"].inc()
+                    study.diseases = cached_diseases
+                else:
+                    pending.append(study)
+        if not pending:
+            return parsed_studies
+
+        llm_facade = self.llm_facade
+        texts_by_id, batched_studies, fallback_studies = {}, {}, []
+        for study in pending:
+            prompt_text = self._prompt_text(study.inclusion_criteria)
+            # Empty or chunked texts, and the repeats of a trialId, go through the single-study fallback
+            if (study.trialId not in batched_studies and prompt_text
+                    and count_tokens(prompt_text) <= llm_facade.max_prompt_tokens):
+                texts_by_id[study.trialId] = prompt_text
+                batched_studies[study.trialId] = study
+            else:
+                fallback_studies.append(study)
+        batches = list(batch_by_token_budget(texts_by_id, self.batch_token_budget))
+        self.logger.warning(f'Extracting {len(texts_by_id)} studies in {len(batches)} batched prompts')
+
+        def extract_batch(batch):
+            try:
+                return self.retry_scheduler.call(llm_facade.extract_batch, batch)
+            except Exception as e:
+                self.logger.error(f"Error during batched disease extraction: {str(e)}")
+                return {}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+            for extracted in executor.map(extract_batch, batches):
+                for trial_id, diseases in extracted.items():
+                    study = batched_studies.pop(trial_id)
+                    EXTRACTIONS["llm"].inc()
+                    study.diseases = diseases
+                    self._set_cached_diseases(study.inclusion_criteria, diseases)
+
+        # Missing from the batch answers
+        fallback_studies.extend(batched_studies.values())
+        if fallback_studies:
+            self.logger.warning(f'Falling back to single extraction for {len(fallback_studies)} studies')
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(fallback_studies))) as executor:
+                fallback_diseases = executor.map(
+                    self._extract_diseases_or_dead_letter,
+                    fallback_studies,
+                    [study.inclusion_criteria for study in fallback_studies]
+                )
+                for study, diseases in zip(fallback_studies, fallback_diseases):
+                    study.diseases = diseases
+        return parsed_studies
+
+    def prepare_criteria(self, parsed_studies):
+        """
+        CPU stage: set the normalized inclusion criteria of the studies not prepared yet, so the
+        enrichment threads only get ready-to-send text.
+        """
+        studies = [
+            study for study in parsed_studies
+            if study.inclusion_criteria is None and study.trialId and study.eligibilityCriteria
+        ]
+        if not studies:
+            return parsed_studies
+        texts = [study.eligibilityCriteria for study in studies]
+        chunks = [texts[i:i + self.cpu_chunk_size] for i in range(0, len(texts), self.cpu_chunk_size)]
+        if self.cpu_workers > 1 and len(chunks) > 1:
+            sections = self._get_cpu_pool().map(split_eligibility_batch, chunks)
+        else:
+            sections = map(split_eligibility_batch, chunks)
+        for study, (inclusion_criteria, _) in zip(studies, chain.from_iterable(sections)):
+            study.inclusion_criteria = inclusion_criteria
+        return parsed_studies
+
+    def _get_cpu_pool(self):
+        """The process pool of prepare_criteria, started by its first use and shut down by close."""
+        with self._cpu_pool_lock:
+            if self._cpu_pool is None:
+                self._cpu_pool = ProcessPoolExecutor(max_workers=self.cpu_workers)
+            return self._cpu_pool
+
+    def _process_single_study(self, study):
         """Helper function for parallel processing of a single study"""
-        if study.get('trialId') and study.get('eligibilityCriteria'):
-            # Create helper function to avoid passing self
-            def get_inclusion_criteria(eligibility_criteria):
-                inclusion_pattern = r"Inclusion Criteria:(.+?)(?:Exclusion Criteria:|$)"
-                match = re.search(inclusion_pattern, eligibility_criteria, re.DOTALL | re.IGNORECASE)
-                return match.group(1) if match else ""
-
-            inclusion_criteria = get_inclusion_criteria(study['eligibilityCriteria'])
-            study['inclusion_criteria'] = inclusion_criteria.strip()
-            # Create a new LLM facade instance since we're in a different process
-            llm_facade = DiseaseExtractionTransformation()
-            study['diseases'] = llm_facade.transform(inclusion_criteria)
-            return study
+        if study.trialId and study.inclusion_criteria is not None:
+            study.diseases = self._extract_diseases_or_dead_letter(study, study.inclusion_criteria)
         return study
-        
-    def run(self, start_date, end_date):
-        
-        for studies in self.crawler.fetch_trials(start_date, end_date, page_size= 500):
+
+    def _extract_diseases_or_dead_letter(self, study, inclusion_criteria):
+        try:
+            return self._extract_diseases(inclusion_criteria)
+        except Exception as e:
+            self._dead_letter(study.trialId, e)
+            return None
+
+    def _dead_letter(self, trial_id, error):
+        self.logger.error(f"Disease extraction failed for {trial_id}, queued for the next run: {str(error)}")
+        DEAD_LETTERS.inc()
+        with self._dead_letters_lock:
+            self.dead_letters[trial_id] = str(error)
+
+    @property
+    def llm_facade(self):
+        """The shared, thread-safe extractor, rebuilt only when `llm` is replaced."""
+        llm_facade = self._llm_facade
+        if llm_facade is not None and llm_facade.source_llm is self.llm:
+            return llm_facade
+        with self._llm_facade_lock:
+            if self._llm_facade is None or self._llm_facade.source_llm is not self.llm:
+                self._llm_facade = DiseaseExtractionTransformation(
+                    llm=self.llm, rate_limiter=self.rate_limiter,
+                    max_connections=self.llm_max_connections, keepalive_expiry=self.llm_keepalive_expiry,
+                    max_prompt_tokens=self.max_prompt_tokens
+                )
+            return self._llm_facade
+
+    def _match_diseases(self, inclusion_criteria):
+        """
+        Diseases found by the dictionary matcher, None when its coverage is too low to skip the LLM.
+        A text without any vocabulary hit also goes to the LLM: a condition the matcher does not
+        know ("chronic low back pain") looks like no condition at all.
+        """
+        if self.match_min_coverage is None:
+            return None
+        match = self.disease_matcher.match(inclusion_criteria)
+        if not match.diseases:
+            return None
+        return match.diseases if match.coverage >= self.match_min_coverage else None
+
+    def _prompt_text(self, inclusion_criteria):
+        """Inclusion criteria as sent to the LLM, without the boilerplate lines that name no condition."""
+        if not self.compact_prompts:
+            return inclusion_criteria
+        prompt_text = strip_boilerplate(inclusion_criteria, keep=self.disease_matcher.mentions_condition)
+        if len(prompt_text) < len(inclusion_criteria):
+            STRIPPED_PROMPT_TOKENS.inc(count_tokens(inclusion_criteria) - count_tokens(prompt_text))
+        return prompt_text
+
+    def _cache_key(self, inclusion_criteria):
+        if self.cache is None or not inclusion_criteria.strip():
+            return None
+        return make_cache_key(
+            inclusion_criteria,
+            DiseaseExtractionTransformation.MODEL_NAME,
+            DiseaseExtractionTransformation.PROMPT_VERSION
+        )
+
+    def _get_cached_diseases(self, inclusion_criteria):
+        cache_key = self._cache_key(inclusion_criteria)
+        return self.cache.get(cache_key) if cache_key else None
+
+    def _set_cached_diseases(self, inclusion_criteria, diseases):
+        cache_key = self._cache_key(inclusion_criteria)
+        if cache_key:
+            self.cache.set(cache_key, diseases)
+
+    def _extract_diseases(self, inclusion_criteria):
+        """
+        Serve the extraction from the dictionary matcher or the cache when possible, the LLM is only
+        called when neither can answer.
+
+        Transient API errors are retried with backoff, the last error is raised once retries are exhausted.
+        """
+        if not inclusion_criteria.strip():
+            # No inclusion section, nothing to extract: the LLM stack is not even loaded
+            return []
+        matched_diseases = self._match_diseases(inclusion_criteria)
+        if matched_diseases is not None:
+            EXTRACTIONS["matcher"].inc()
+            return matched_diseases
+        cache_key = self._cache_key(inclusion_criteria)
+        if cache_key:
+            cached_diseases = self.cache.get(cache_key)
+            if cached_diseases is not None:
+                EXTRACTIONS["cache"].inc()
+                return cached_diseases
+
+        llm_facade = self.llm_facade
+        prompt_text = self._prompt_text(inclusion_criteria)
+        if not prompt_text:
+            # Only boilerplate, no condition to look for
+            EXTRACTIONS["matcher"].inc()
+            return []
+        diseases = self.retry_scheduler.call(llm_facade.extract, prompt_text)
+        EXTRACTIONS["llm"].inc()
+        # Only successful extractions are cached
+        if cache_key:
+            self.cache.set(cache_key, diseases)
+        return diseases
+
+    def reprocess_dead_letters(self):
+        """Enrich again the stored studies whose extraction failed during a previous run."""
+        trial_ids = self.db_client.fetch_dead_letters()
+        if not trial_ids:
+            return
+        self.logger.warning(f'Re-processing {len(trial_ids)} dead-lettered studies')
+        studies = [StudyRecord.from_bson(document) for document in self.db_client.find_studies(trial_ids)]
+        if len(studies) < len(trial_ids):
+            # Kept until their study is stored, e.g. by a later run of the failed job
+            self.logger.warning(f'{len(trial_ids) - len(studies)} dead-lettered studies are not stored, keeping them')
+        enriched_studies = self.enrich(studies)
+        self.save_to_db(enriched_studies)
+        with self._dead_letters_lock:
+            recovered = [
+                study.trialId for study in enriched_studies
+                if study.diseases is not None and study.trialId not in self.dead_letters
+            ]
+        # Only once the studies are written: after a failed write they stay dead-lettered
+        if recovered:
+            self._after_writes(partial(self.db_client.delete_dead_letters, recovered))
+        self._flush_dead_letters()
+
+    def _flush_dead_letters(self):
+        with self._dead_letters_lock:
+            dead_letters, self.dead_letters = self.dead_letters, {}
+        if dead_letters:
+            self.db_client.save_dead_letters(dead_letters)
+
+    def filter_changed(self, parsed_studies):
+        """Drop the studies whose stored content hash is unchanged, they need neither enrichment nor a write"""
+        stored_hashes = self.db_client.find_content_hashes([study.trialId for study in parsed_studies])
+        changed_studies = [
+            study for study in parsed_studies if stored_hashes.get(study.trialId) != study.contentHash
+        ]
+        self.logger.warning(f'Skipping {len(parsed_studies) - len(changed_studies)} unchanged studies out of {len(parsed_studies)}')
+        return changed_studies
+
+    def run(self, start_date, end_date, run_id=None, reprocess_dead_letters=True):
+        """
+        Fetch, enrich and store the studies updated between start_date and end_date. An interrupted
+        run with the same run id (by default derived from the source and the dates) is resumed.
+        Shard jobs pass reprocess_dead_letters=False, their coordinator re-processes them once.
+
+        Returns True when every page was fetched and written.
+        """
+        completed = False
+        metrics_snapshot = REGISTRY.snapshot()
+        try:
+            if reprocess_dead_letters:
+                self.reprocess_dead_letters()
+            self._start_checkpoint(run_id or self._default_run_id(start_date, end_date))
             # Apply all transformation steps
-            parsed_studies = ClinicalTrialTransformationMapping().transform(studies)
-            enriched_studied = self.enrich(parsed_studies)
-            self.save_to_db(enriched_studied)
+            for parsed_studies in self._iter_parsed_pages(start_date, end_date):
+                self._process_page(parsed_studies)
+            completed = getattr(self.crawler, 'last_error', None) is None
+        finally:
+            write_errors = self.close()
+            completed = completed and not write_errors
+            self._finish_checkpoint(completed)
+            self._log_metrics_summary(metrics_snapshot)
+        if self.cache is not None:
+            self.logger.warning(f'Extraction cache stats: {self.cache.stats()}')
+        return completed
+
+    def run_incremental(self, end_date=None, initial_start_date=date(2024, 10, 20), run_id=None):
+        """
+        Only process what changed since the previous run.
+
+        The crawl resumes from the stored LastUpdatePostDate watermark of the source (inclusive, as
+        trials can still be updated on that day), and studies whose content hash matches the stored
+        document skip both the LLM and the write. The watermark only moves after a complete crawl.
+        """
+        watermark = self.db_client.get_watermark(self.api_source)
+        start_date = date.fromisoformat(watermark) if watermark else initial_start_date
+        end_date = end_date or date.today()
+        self.logger.warning(f'Incremental run of {self.api_source} from {start_date} to {end_date}')
+
+        latest_update = watermark
+        completed = False
+        metrics_snapshot = REGISTRY.snapshot()
+        try:
+            self.reprocess_dead_letters()
+            self._start_checkpoint(run_id or self._default_run_id(start_date, end_date))
+            for parsed_studies in self._iter_parsed_pages(start_date, end_date):
+                update_dates = [study.lastUpdateDate for study in parsed_studies if study.lastUpdateDate]
+                latest_update = max([latest_update or '', *update_dates]) or None
+                changed_studies = self.filter_changed(parsed_studies)
+                if changed_studies:
+                    self._process_page(changed_studies)
+            completed = getattr(self.crawler, 'last_error', None) is None
+        finally:
+            # Everything is written before the watermark moves
+            write_errors = self.close()
+            completed = completed and not write_errors
+            self._finish_checkpoint(completed)
+            self._log_metrics_summary(metrics_snapshot)
+
+        if not completed:
+            self.logger.warning('Crawl interrupted, the watermark is left unchanged')
+        elif latest_update and latest_update != watermark:
+            self.db_client.set_watermark(self.api_source, latest_update)
+        if self.cache is not None:
+            self.logger.warning(f'Extraction cache stats: {self.cache.stats()}')
+
+    def _iter_parsed_pages(self, start_date, end_date, page_size=500):
+        """
+        Yield pages of StudyRecord. When the crawler can stream, studies are mapped as they are
+        parsed off the wire and the raw page is never held in memory.
+
+        During a checkpointed run, the page token (or the shard) is committed once the studies of
+        the page are written, and a resumed run starts from the last committed one.
+        """
+        mapping = ClinicalTrialTransformationMapping()
+        checkpointing = self.run_id is not None
+        if self.shard_workers and hasattr(self.crawler, 'fetch_trials_sharded'):
+            for studies in self.crawler.fetch_trials_sharded(
+                start_date, end_date, page_size=page_size, max_workers=self.shard_workers,
+                skip_shards=self._completed_shards, on_shard_done=self._on_shard_done if checkpointing else None
+            ):
+                yield mapping.transform(studies)
+        elif hasattr(self.crawler, 'stream_pages'):
+            pages = self.crawler.stream_pages(
+                start_date, end_date, page_size=page_size, page_token=self._checkpoint.get('pageToken')
+            )
+            for page_token, studies in pages:
+                parsed_studies = list(mapping.iter_transform(studies))
+                if parsed_studies:
+                    yield parsed_studies
+                if checkpointing:
+                    # A resumed run processes this page again, at the cost of a fetch: its
+                    # enrichment results are checkpointed and the writes are idempotent
+                    self._after_writes(partial(self._commit_progress, pageToken=page_token))
+        else:
+            for studies in self.crawler.fetch_trials(start_date, end_date, page_size=page_size):
+                yield mapping.transform(studies)
+
+    def _process_page(self, parsed_studies):
+        pending_studies = self._restore_checkpointed_results(parsed_studies)
+        with PAGE_ENRICH_SECONDS.time():
+            enriched_studied = self.enrich(pending_studies)
+        # Paid-for LLM results are durable before the page write starts
+        self._checkpoint_results(enriched_studied)
+        with PAGE_WRITE_SECONDS.time():
+            self.save_to_db(parsed_studies)
+        self._flush_dead_letters()
+
+    def _log_metrics_summary(self, since):
+        summary = REGISTRY.summary(since=since)
+        if summary:
+            self.logger.warning(f'Run metrics:\n{summary}')
+
+    def _default_run_id(self, start_date, end_date):
+        return f'{self.api_source}:{start_date}:{end_date}'
+
+    def _start_checkpoint(self, run_id):
+        if self.checkpoints is None:
+            return
+        self.run_id = run_id
+        self._checkpoint = self.checkpoints.load(run_id) or {}
+        self._checkpointed_results = self.checkpoints.load_results(run_id)
+        self._completed_shards = [
+            (date.fromisoformat(shard_start), date.fromisoformat(shard_end))
+            for shard_start, shard_end in self._checkpoint.get('completedShards', [])
+        ]
+        if self._checkpoint:
+            self.logger.warning(
+                f'Resuming run {run_id}: page token {self._checkpoint.get("pageToken")}, '
+                f'{len(self._completed_shards)} completed shards, {len(self._checkpointed_results)} enriched studies'
+            )
+        else:
+            self.checkpoints.save(run_id, source=self.api_source)
+
+    def _finish_checkpoint(self, completed):
+        if self.run_id is None:
+            return
+        if completed:
+            # Nothing left to resume, the next run with these dates starts over
+            self.checkpoints.delete(self.run_id)
+        else:
+            self.logger.warning(f'Run {self.run_id} interrupted, run it again to resume from its checkpoint')
+        self.run_id = None
+        self._checkpoint, self._checkpointed_results, self._completed_shards = {}, {}, []
+
+    def _commit_progress(self, **state):
+        self.checkpoints.save(self.run_id, **state)
+
+    def _on_shard_done(self, shard_start, shard_end):
+        self._after_writes(partial(self._commit_shard, shard_start, shard_end))
+
+    def _commit_shard(self, shard_start, shard_end):
+        self._completed_shards.append((shard_start, shard_end))
+        self._commit_progress(completedShards=[
+            [completed_start.isoformat(), completed_end.isoformat()]
+            for completed_start, completed_end in self._completed_shards
+        ])
+
+    def _restore_checkpointed_results(self, parsed_studies):
+        """Reuse the enrichment of the studies already processed by the run, return the others"""
+        if not self._checkpointed_results:
+            return parsed_studies
+        pending_studies = []
+        for study in parsed_studies:
+            result = self._checkpointed_results.get(study.trialId)
+            if result is not None and result.get('contentHash') == study.contentHash:
+                study.inclusion_criteria = result.get('inclusion_criteria')
+                study.diseases = result.get('diseases')
+            else:
+                pending_studies.append(study)
+        if len(pending_studies) < len(parsed_studies):
+            self.logger.warning(f'Reused {len(parsed_studies) - len(pending_studies)} checkpointed enrichments')
+        return pending_studies
+
+    def _checkpoint_results(self, enriched_studies):
+        if self.run_id is None:
+            return
+        self.checkpoints.save_results(self.run_id, {
+            study.trialId: {
+                "contentHash": study.contentHash,
+                "inclusion_criteria": study.inclusion_criteria,
+                "diseases": study.diseases,
+            }
+            # Dead-lettered studies are retried on resume
+            for study in enriched_studies if study.trialId and study.diseases is not None
+        })
             
     def save_to_db(self, parsed_studies):
-        # for study in parsed_studies:
-        self.db_client.insert_many_documents(parsed_studies)
+        documents = [study.to_bson() for study in parsed_studies]
+        if self.write_behind and hasattr(self.db_client, 'start_bulk_writer'):
+            if self.bulk_writer is None:
+                self.bulk_writer = self.db_client.start_bulk_writer()
+            self.bulk_writer.submit(documents)
+        else:
+            self.db_client.insert_many_documents(documents)
+        self.export(documents)
+
+    def export(self, documents):
+        """Hand documents to the export sinks, their writers are started by the first call of a run"""
+        if self.export_sinks and not self.export_writers:
+            self.export_writers = [sink.start_writer() for sink in self.export_sinks]
+        for writer in self.export_writers:
+            writer.submit(documents)
+
+    def _after_writes(self, callback):
+        """Run callback once every study handed to save_to_db so far is written, exports included"""
+        writers = [writer for writer in (self.bulk_writer, *self.export_writers) if writer is not None]
+        if not writers:
+            callback()
+            return
+        remaining = [len(writers)]
+        lock = threading.Lock()
+
+        def written():
+            # A writer with a failed write drops every later callback, so no progress is committed
+            # past the lost documents and a resumed run writes them again
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            callback()
+
+        for writer in writers:
+            writer.after_writes(written)
+
+    def flush_writes(self):
+        """Wait until every study handed to save_to_db is in the database and the exports"""
+        if self.bulk_writer is not None:
+            self.bulk_writer.flush()
+        for writer in self.export_writers:
+            writer.flush()
+
+    def close(self):
+        """
+        Flush pending writes and stop the background workers, called at the end of every run.
+        Returns the number of failed bulk writes.
+        """
+        write_errors = self.close_writer()
+        with self._cpu_pool_lock:
+            cpu_pool, self._cpu_pool = self._cpu_pool, None
+        if cpu_pool is not None:
+            cpu_pool.shutdown()
+        return write_errors
+
+    def close_writer(self):
+        """Close the writers of the run, returns the number of failed writes (Mongo and exports)."""
+        write_errors = 0
+        for writer in self.export_writers:
+            writer.close()
+            write_errors += writer.errors
+        self.export_writers = []
+        if self.bulk_writer is None:
+            return write_errors
+        self.bulk_writer.close()
+        write_errors += self.bulk_writer.errors
+        stats = self.bulk_writer.flush_stats
+        if stats:
+            documents = sum(flush['documents'] for flush in stats)
+            latency = sum(flush['latency'] for flush in stats)
+            self.logger.warning(f'Wrote {documents} documents in {len(stats)} flushes, {latency:.2f}s spent in bulk writes')
+        self.bulk_writer = None
+        return write_errors
 
 if __name__ == "__main__":
     pipeline = ClinicalTrialPipeline()
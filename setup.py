@@ -1,20 +1,28 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, find_namespace_packages
 
 setup(
     name="clinical_trial_pipeline",
     version="0.1.0",
-    packages=find_packages(),
+    # The source folders have no __init__.py
+    packages=find_packages() + find_namespace_packages(include=["clients", "pipelines", "transformations"]),
+    # Condition vocabulary of the dictionary disease matcher
+    package_data={"transformations": ["data/*.tsv"]},
     install_requires=[
         "requests",  
-        "pymongo",   
+        "pymongo>=4.9",
+        "httpx",
         "openai",
         "langchain",
         "python-dotenv",
         "langchain-openai",
+        "tiktoken",
         "openai",
         "pytest",
-        "pytest-mock"
+        "pytest-mock",
+        "mongomock"
     ],
+    # Parquet export (clients/export_sink.py)
+    extras_require={"parquet": ["pyarrow"]},
     author="Taoufik Bourgana",
     author_email="taoufik.bourgana@gmail.com",
     description="A pipeline for processing clinical trial data",
@@ -1,6 +1,19 @@
+import json
 import pytest
+import mongomock
 from datetime import date
-from clients.api_client import APIClientFactory, ClinicalTrialsAPIClient, MockedDataSourceClient
+from clients.api_client import APIClientFactory, AsyncClinicalTrialsAPIClient, ClinicalTrialsAPIClient, MockedDataSourceClient
+from clients.cache_client import make_cache_key, SQLiteExtractionCache, MongoExtractionCache
+from clients.checkpoint_client import FileCheckpointStore, MongoCheckpointStore
+from clients.rate_limiter import TokenBucket, OpenAIRateLimiter, RetryScheduler, parse_reset_duration
+from transformations.llm_extraction import DiseaseExtractionTransformation
+from clients.json_stream import StreamingPageParser
+from benchmarks.recordings import synthesize_pages
+from benchmarks.servers import MockOpenAIServer, ReplayServer
+from clients.db_client import BulkWriter, MongoDBClient, find_plan_stages
+from clients.job_queue import MongoJobQueue
+from clients.metrics import MetricsRegistry, start_metrics_server
+from clients.export_sink import ParquetExportSink, flatten_study
 
 def test_api_client_factory():
     # Test valid client creation
@@ -14,8 +27,397 @@ def test_api_client_factory():
     with pytest.raises(ValueError):
         APIClientFactory.get_api_client("invalid_source")
 
-def test_client_fetch():
-    client = ClinicalTrialsAPIClient()
-    studies = list(client.fetch_trials(date(2024, 10, 20), date(2024, 1, 21)))
+def test_client_fetch(tmp_path):
+    # Replayed offline, a single recorded page
+    synthesize_pages(str(tmp_path), pages=1, page_size=5)
+    with ReplayServer(str(tmp_path)) as server:
+        client = ClinicalTrialsAPIClient(base_url=server.url)
+        studies = list(client.fetch_trials(date(2024, 10, 20), date(2024, 1, 21)))
     assert isinstance(studies, list)
-    assert len(studies) == 1  
+    assert len(studies) == 1
+
+def test_stream_pages_records_a_truncated_body(tmp_path):
+    import gzip
+
+    synthesize_pages(str(tmp_path), pages=3, page_size=5)
+    with ReplayServer(str(tmp_path)) as server:
+        truncated = server.pages[1][0][:-200]
+        server.pages[1] = (truncated, gzip.compress(truncated))
+        client = ClinicalTrialsAPIClient(base_url=server.url)
+        # Consumed like ClinicalTrialPipeline does, outside the page generator
+        pages = [(token, list(studies)) for token, studies in client.stream_pages(date(2024, 10, 20), date(2024, 10, 21))]
+    assert [token for token, _ in pages] == [None, "1"]
+    assert len(pages[0][1]) == 5
+    assert isinstance(client.last_error, ValueError)
+    assert server.requests == 2
+
+def test_async_client_retries_and_records_body_errors(tmp_path):
+    import asyncio
+    import gzip
+
+    async def fetch(client):
+        return [studies async for studies in client.afetch_trials(date(2024, 10, 20), date(2024, 10, 21))]
+
+    synthesize_pages(str(tmp_path), pages=2, page_size=5)
+    with ReplayServer(str(tmp_path), fail_first=2) as server:
+        client = AsyncClinicalTrialsAPIClient(base_url=server.url)
+        pages = asyncio.run(fetch(client))
+        assert [len(studies) for studies in pages] == [5, 5]
+        assert client.last_error is None
+        assert server.requests == 4
+
+        truncated = server.pages[1][0][:-200]
+        server.pages[1] = (truncated, gzip.compress(truncated))
+        pages = asyncio.run(fetch(client))
+        assert [len(studies) for studies in pages] == [5]
+        assert isinstance(client.last_error, ValueError)
+
+def test_cache_key_normalizes_text():
+    key = make_cache_key("Adults with  Asthma\n", "gpt-4o-mini", "v1")
+    assert key == make_cache_key("adults with asthma", "gpt-4o-mini", "v1")
+    assert key != make_cache_key("adults with asthma", "gpt-4o-mini", "v2")
+
+def test_sqlite_cache_hits_and_eviction(tmp_path):
+    cache = SQLiteExtractionCache(path=str(tmp_path / "cache.sqlite3"), max_entries=2, evict_every=1)
+    assert cache.get("a") is None
+    cache.set("a", "asthma")
+    cache.set("b", "diabetes")
+    assert cache.get("a") == "asthma"
+    cache.set("c", "hypertension")
+    # "b" is the least recently used entry
+    assert cache.get("b") is None
+    assert len(cache) == 2
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+def test_mongo_cache_round_trip():
+    collection = mongomock.MongoClient()["clinical_trials"]["llm_cache"]
+    cache = MongoExtractionCache(collection=collection, max_entries=1, evict_every=1)
+    cache.set("a", "asthma")
+    assert cache.get("a") == "asthma"
+    cache.set("b", "diabetes")
+    assert len(cache) == 1
+
+def test_token_bucket_reserves_wait_time():
+    bucket = TokenBucket(capacity=2, refill_per_second=10)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+
+def test_rate_limiter_follows_headers():
+    limiter = OpenAIRateLimiter(requests_per_minute=600, tokens_per_minute=60_000)
+    limiter.update_from_headers({
+        "x-ratelimit-limit-requests": "60",
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "2s",
+    })
+    assert limiter.reserve(10) == pytest.approx(3.0, abs=0.05)
+    assert parse_reset_duration("6m0s") == 360
+    assert parse_reset_duration("20ms") == pytest.approx(0.02)
+
+def test_retry_scheduler_recovers_from_429(monkeypatch):
+    with MockOpenAIServer(answer="asthma", throttle_first=2) as server:
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+        limiter = OpenAIRateLimiter()
+        extractor = DiseaseExtractionTransformation(rate_limiter=limiter)
+        scheduler = RetryScheduler(base_delay=0.01)
+        assert scheduler.call(extractor.extract, "Adults with asthma") == ["asthma"]
+        assert server.requests == 3
+        # The successful answer carried x-ratelimit headers
+        assert limiter.requests.capacity == 500
+
+def test_shared_extractor_reuses_pooled_connections(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    with MockOpenAIServer(answer="asthma", latency=0.01) as server:
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+        extractor = DiseaseExtractionTransformation(max_connections=4)
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            for _ in range(2):
+                answers = list(executor.map(extractor.extract, ["Adults with asthma"] * 32))
+        assert answers == [["asthma"]] * 32
+        assert server.requests == 64
+        # Both pages went through the same capped pool
+        assert len(server.connections) <= 4
+
+def test_async_http_client_is_created_on_first_async_use(monkeypatch):
+    import asyncio
+
+    with MockOpenAIServer(answer="asthma") as server:
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+        extractor = DiseaseExtractionTransformation()
+        # The sync path never opens an async pool
+        assert extractor.extract("Adults with asthma") == ["asthma"]
+        assert extractor._http_async_client is None
+
+        async def extract_and_close():
+            answer = await extractor.aextract("Adults with asthma")
+            http_async_client = extractor._http_async_client
+            await extractor.aclose()
+            return answer, http_async_client
+
+        answer, http_async_client = asyncio.run(extract_and_close())
+        assert answer == ["asthma"]
+        assert http_async_client.is_closed
+        assert extractor._http_async_client is None
+        assert server.requests == 2
+
+def test_retry_scheduler_gives_up():
+    calls = []
+
+    def always_failing():
+        calls.append(1)
+        raise ValueError("not retryable")
+
+    with pytest.raises(ValueError):
+        RetryScheduler(base_delay=0).call(always_failing)
+    assert len(calls) == 1
+
+def raw_study(nct_id):
+    return {"protocolSection": {"identificationModule": {"nctId": nct_id}}}
+
+def test_shard_date_range_splits_on_count(mocker):
+    client = ClinicalTrialsAPIClient()
+    # 1000 studies per day
+    mocker.patch.object(client, "count_trials", side_effect=lambda start, end: 1000 * ((end - start).days + 1))
+    shards = client.shard_date_range(date(2024, 1, 1), date(2024, 1, 8), target_shard_size=2000)
+    assert [(start, end) for start, end, _ in shards] == [
+        (date(2024, 1, 1), date(2024, 1, 2)), (date(2024, 1, 3), date(2024, 1, 4)),
+        (date(2024, 1, 5), date(2024, 1, 6)), (date(2024, 1, 7), date(2024, 1, 8)),
+    ]
+
+def test_fetch_trials_sharded_merges_and_deduplicates(mocker):
+    client = ClinicalTrialsAPIClient()
+    mocker.patch.object(client, "shard_date_range", return_value=[
+        (date(2024, 1, 1), date(2024, 1, 1), 2), (date(2024, 1, 2), date(2024, 1, 2), 2),
+    ])
+    pages_by_shard = {
+        date(2024, 1, 1): [[raw_study("NCT1"), raw_study("NCT2")]],
+        date(2024, 1, 2): [[raw_study("NCT2")], [raw_study("NCT3")]],
+    }
+    mocker.patch.object(client, "_fetch_pages", side_effect=lambda start, end, page_size, politeness: iter(pages_by_shard[start]))
+    pages = list(client.fetch_trials_sharded(date(2024, 1, 1), date(2024, 1, 2), max_workers=2))
+    nct_ids = sorted(study["protocolSection"]["identificationModule"]["nctId"] for page in pages for study in page)
+    assert nct_ids == ["NCT1", "NCT2", "NCT3"]
+    assert client.last_error is None
+
+def test_streaming_parser_handles_any_chunk_boundary():
+    page = {"studies": [{"nctId": "NCT1", "criteria": "Âge ≥ 18"}, {"nctId": "NCT2", "n": 12345}],
+            "nextPageToken": "abc", "totalCount": 98765}
+    raw = json.dumps(page, ensure_ascii=False).encode("utf-8")
+    for size in (1, 2, 3, 7, len(raw)):
+        parser = StreamingPageParser()
+        studies = list(parser.parse(raw[i:i + size] for i in range(0, len(raw), size)))
+        assert studies == page["studies"]
+        assert parser.metadata == {"nextPageToken": "abc", "totalCount": 98765}
+
+def test_fetch_trials_from_replay_server(tmp_path):
+    synthesize_pages(str(tmp_path), pages=3, page_size=20)
+    with ReplayServer(str(tmp_path)) as server:
+        client = ClinicalTrialsAPIClient(base_url=server.url)
+        pages = list(client.fetch_trials(date(2024, 10, 20), date(2024, 10, 22)))
+        assert [len(page) for page in pages] == [20, 20, 20]
+        assert client.last_error is None
+        # Keep-alive: every page went through the same pooled connection
+        assert len(server.connections) == 1
+        assert len(list(client.stream_studies(date(2024, 10, 20), date(2024, 10, 22)))) == 60
+
+
+def test_bulk_writer_sends_only_changed_fields():
+    collection = mongomock.MongoClient().db.studies
+    stored = {"trialId": "NCT1", "title": "Asthma", "contentHash": "h1", "diseases": None, "inclusion_criteria": "x"}
+    collection.insert_one(dict(stored))
+
+    writer = BulkWriter(collection, max_interval=60)
+    writer.submit([
+        {**stored, "diseases": "asthma"},
+        {"trialId": "NCT2", "title": "New", "contentHash": "h2"},
+    ])
+    writer.flush()
+    assert writer.flush_stats[-1]["operations"] == 2
+    assert collection.find_one({"trialId": "NCT1"})["diseases"] == "asthma"
+    assert collection.find_one({"trialId": "NCT2"})["title"] == "New"
+
+    # Nothing changed: nothing written
+    writer.submit([{**stored, "diseases": "asthma"}])
+    writer.close()
+    assert writer.flush_stats[-1]["operations"] == 0
+    assert collection.count_documents({}) == 2
+    assert writer.errors == 0
+
+
+def test_bulk_writer_unsets_removed_fields_and_survives_bad_documents():
+    collection = mongomock.MongoClient().db.studies
+    collection.insert_one({"trialId": "NCT1", "title": "Asthma", "endDate": "2025-01", "contentHash": "h1"})
+
+    writer = BulkWriter(collection, max_interval=60)
+    # BSON cannot encode a set: the document is dropped, the writer thread keeps running
+    writer.submit([{"trialId": "NCT2", "tags": {"a"}}])
+    committed = []
+    writer.after_writes(lambda: committed.append(True))
+    writer.submit([{"trialId": "NCT1", "title": "Asthma", "contentHash": "h2"}])
+    writer.flush()
+    writer.close()
+    assert writer.errors == 1 and committed == []
+    stored = collection.find_one({"trialId": "NCT1"}, {"_id": 0})
+    assert stored == {"trialId": "NCT1", "title": "Asthma", "contentHash": "h2"}
+    assert collection.count_documents({}) == 1
+
+
+def test_mongo_query_layer_paginates_by_trial_id(mocker):
+    mocker.patch("clients.db_client.MongoClient", mongomock.MongoClient)
+    db_client = MongoDBClient()
+    db_client.collection.create_index("trialId", name="trialId_1")
+    db_client.ensure_indexes()
+    assert "trialId_1" not in db_client.collection.index_information()
+    assert db_client.collection.index_information()["trialId_unique"]["unique"]
+
+    db_client.collection.insert_many([
+        {"trialId": f"NCT{i}", "diseases": ["asthma"], "phase": ["PHASE2"], "startDate": f"2024-0{i}",
+         "locations": [{"country": "France", "city": "Paris" if i % 2 else "Lyon"}]}
+        for i in range(1, 6)
+    ])
+    studies, after = db_client.find_by_disease("asthma", page_size=2)
+    assert [study["trialId"] for study in studies] == ["NCT1", "NCT2"]
+    studies, after = db_client.find_by_disease("asthma", after=after, page_size=3)
+    assert [study["trialId"] for study in studies] == ["NCT3", "NCT4", "NCT5"]
+    assert "_id" not in studies[0] and "locations" not in studies[0]
+
+    studies, _ = db_client.find_by_location("France", "Paris")
+    assert [study["trialId"] for study in studies] == ["NCT1", "NCT3", "NCT5"]
+    studies, after = db_client.find_by_start_date("2024-02", "2024-04", projection={"startDate": 1})
+    assert studies == [{"trialId": "NCT2", "startDate": "2024-02"}, {"trialId": "NCT3", "startDate": "2024-03"}]
+    assert after is None
+
+
+def test_check_query_plans_rejects_collscan(mocker):
+    mocker.patch("clients.db_client.MongoClient", mongomock.MongoClient)
+    db_client = MongoDBClient()
+    plan = {"queryPlanner": {"winningPlan": {"stage": "LIMIT", "inputStage": {"stage": "COLLSCAN"}}}}
+    assert find_plan_stages(plan) == ["LIMIT", "COLLSCAN"]
+
+    cursor = mocker.MagicMock()
+    cursor.sort.return_value.limit.return_value.explain.return_value = plan
+    mocker.patch.object(db_client, "collection", mocker.MagicMock(find=mocker.MagicMock(return_value=cursor)))
+    with pytest.raises(RuntimeError, match="COLLSCAN"):
+        db_client.check_query_plans()
+
+
+@pytest.mark.parametrize("backend", ["file", "mongo"])
+def test_checkpoint_store_round_trip(backend, tmp_path):
+    if backend == "file":
+        store = FileCheckpointStore(str(tmp_path))
+    else:
+        store = MongoCheckpointStore(mongomock.MongoClient().clinical_trials)
+    assert store.load("run") is None
+    store.save("run", pageToken="2")
+    store.save("run", completedShards=[["2024-10-20", "2024-10-21"]])
+    state = store.load("run")
+    assert (state["pageToken"], state["completedShards"]) == ("2", [["2024-10-20", "2024-10-21"]])
+
+    store.save_results("run", {"NCT1": {"contentHash": "h", "diseases": ["asthma"]}})
+    store.save_results("run", {"NCT1": {"contentHash": "h2", "diseases": []}})
+    assert store.load_results("run") == {"NCT1": {"contentHash": "h2", "diseases": []}}
+    store.delete("run")
+    assert store.load("run") is None and store.load_results("run") == {}
+
+
+def test_metrics_registry_render_and_summary():
+    registry = MetricsRegistry()
+    hits = registry.counter("lookups_total", "Lookups", result="hit")
+    latency = registry.histogram("request_seconds", "Latency", buckets=(0.1, 1, 10))
+    assert registry.counter("lookups_total", "Lookups", result="hit") is hits
+
+    hits.inc()
+    before = registry.snapshot()
+    hits.inc(2)
+    for value in (0.05, 0.5, 0.5, 5):
+        latency.observe(value)
+
+    rendered = registry.render()
+    assert 'lookups_total{result="hit"} 3' in rendered
+    assert 'request_seconds_bucket{le="1"} 3' in rendered
+    assert 'request_seconds_bucket{le="+Inf"} 4' in rendered
+    assert "request_seconds_count 4" in rendered
+
+    summary = registry.summary(since=before).splitlines()
+    assert summary[0] == 'lookups_total{result="hit"}: 2'
+    assert summary[1].startswith("request_seconds: count=4 mean=1.512 p50=0.55")
+
+
+def test_metrics_endpoint_serves_registry():
+    from urllib.request import urlopen
+
+    registry = MetricsRegistry()
+    registry.counter("pages_total", "Pages").inc()
+    server = start_metrics_server(0, host="127.0.0.1", registry=registry)
+    try:
+        with urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+            assert "pages_total 1" in response.read().decode("utf-8")
+    finally:
+        server.shutdown()
+
+
+def test_job_queue_leases_and_reclaims_expired_jobs():
+    job_queue = MongoJobQueue(mongomock.MongoClient().clinical_trials, max_attempts=2)
+    shards = [(date(2024, 10, 20), date(2024, 10, 20)), (date(2024, 10, 21), date(2024, 10, 21))]
+    assert job_queue.enqueue("clinical_trials", shards) == 2
+    # Planning again does not reset known jobs
+    assert job_queue.enqueue("clinical_trials", shards) == 0
+
+    first = job_queue.claim("worker-1", lease_seconds=60)
+    second = job_queue.claim("worker-2", lease_seconds=-1)
+    assert (first["startDate"], second["startDate"]) == ("2024-10-20", "2024-10-21")
+    assert job_queue.claim("worker-3", lease_seconds=60)["_id"] == second["_id"]
+    # worker-2 stopped heartbeating, its job went to worker-3 and its late completion is ignored
+    assert not job_queue.heartbeat(second["_id"], "worker-2", 60)
+    assert job_queue.heartbeat(second["_id"], "worker-3", 60)
+    job_queue.complete(second["_id"], "worker-2")
+    assert job_queue.counts()["running"] == 2
+
+    job_queue.complete(first["_id"], "worker-1")
+    job_queue.fail(second["_id"], "worker-3", "boom")
+    # Second attempt of the job, out of attempts
+    assert job_queue.counts() == {"pending": 0, "running": 0, "done": 1, "failed": 1}
+
+
+def make_document(trial_id, diseases, country="France", content_hash="h1"):
+    return {
+        "trialId": trial_id, "title": "Asthma study", "startDate": "2024-01", "endDate": "Unknown",
+        "phase": ["PHASE2"], "principalInvestigator": {"name": "Dr Who", "affiliation": "Unknown"},
+        "locations": [{"facility": "Hospital", "city": "Paris", "country": country},
+                      {"facility": "Unknown", "city": "Unknown", "country": "Unknown"}],
+        "eligibilityCriteria": "Inclusion Criteria:\n* asthma", "lastUpdateDate": "2024-10-21",
+        "contentHash": content_hash, "inclusion_criteria": "- asthma", "diseases": diseases,
+    }
+
+
+def test_flatten_study_splits_child_tables():
+    study, locations, diseases = flatten_study(make_document("NCT1", ["asthma", "obesity"]), "run", "run-00000", None)
+    assert study["endDate"] is None and study["piAffiliation"] is None
+    assert study["diseasesExtracted"]
+    assert locations == [{"trialId": "NCT1", "facility": "Hospital", "city": "Paris", "country": "France", "exportId": "run-00000"}]
+    assert [disease["disease"] for disease in diseases] == ["asthma", "obesity"]
+    # Dead-lettered study: no disease rows, and not mistaken for a study without diseases
+    study, _, diseases = flatten_study(make_document("NCT2", None), "run", "run-00000", None)
+    assert not study["diseasesExtracted"] and diseases == []
+
+
+def test_parquet_export_appends_runs_and_scans_latest_versions(tmp_path):
+    pytest.importorskip("pyarrow")
+    sink = ParquetExportSink(str(tmp_path))
+    with sink.start_writer(max_rows=2) as writer:
+        writer.submit([make_document("NCT1", ["asthma"]), make_document("NCT2", ["asthma"], country="Morocco")])
+        writer.submit([make_document("NCT3", ["melanoma"])])
+    assert writer.flush_stats[0]["documents"] == 2
+    # Next run: NCT1 no longer mentions asthma
+    with sink.start_writer() as writer:
+        writer.submit([make_document("NCT1", ["obesity"], content_hash="h2")])
+
+    studies, after = sink.find_by_disease("asthma")
+    assert [study["trialId"] for study in studies] == ["NCT2"] and after is None
+    assert [study["trialId"] for study in sink.find_by_location("France")[0]] == ["NCT1", "NCT3"]
+    assert sink.find_by_disease("obesity")[0][0]["diseases"] == ["obesity"]
@@ -0,0 +1,448 @@
+import asyncio
+import subprocess
+import sys
+import time
+from datetime import date
+
+import mongomock
+import pytest
+
+from pipelines.async_trial_pipeline import AsyncClinicalTrialPipeline
+from benchmarks.bench_pipeline import check_thresholds, run_benchmark
+from benchmarks.recordings import synthesize_pages
+from benchmarks.servers import ReplayServer
+from pipelines.trial_pipeline import EXTRACTIONS, ClinicalTrialPipeline
+from pipelines.job_worker import JobCoordinator, JobWorker
+from clients.export_sink import ParquetExportSink, ParquetWriter
+from clients.job_queue import MongoJobQueue
+from transformations.llm_extraction import DiseaseExtractionTransformation
+from transformations.trial_transformation import StudyRecord
+from transformations.fake_llm import FakeDiseaseLLM
+
+
+@pytest.fixture
+def pipeline_factory(mocker, tmp_path, monkeypatch):
+    monkeypatch.setenv("EXTRACTION_CACHE_PATH", str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setenv("CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+    mocker.patch("clients.db_client.MongoClient", mongomock.MongoClient)
+
+    def factory(**kwargs):
+        kwargs.setdefault("api_source", "mocked_api")
+        kwargs.setdefault("llm", FakeDiseaseLLM())
+        # Most tests exercise the LLM path, the dictionary matcher would answer them all
+        kwargs.setdefault("match_min_coverage", None)
+        return ClinicalTrialPipeline(**kwargs)
+    return factory
+
+
+def make_study(trial_id, inclusion):
+    return StudyRecord(
+        trialId=trial_id,
+        eligibilityCriteria=f"Inclusion Criteria:\n* {inclusion}\n\nExclusion Criteria:\n* pregnancy",
+    )
+
+
+def test_enrich_uses_cache_on_second_run(pipeline_factory):
+    pipeline = pipeline_factory()
+    studies = [make_study("NCT1", "Adults with asthma"), make_study("NCT2", "Adults with asthma")]
+    pipeline.enrich(studies)
+    assert [study.diseases for study in studies] == [["asthma"], ["asthma"]]
+
+    calls = pipeline.llm.calls
+    pipeline.enrich([make_study("NCT1", "adults  with ASTHMA")])
+    assert pipeline.llm.calls == calls
+    assert pipeline.cache.stats()["hits"] >= 1
+
+
+def test_extractor_is_shared_across_pages(pipeline_factory):
+    pipeline = pipeline_factory(cache_type=None)
+    llm_facade = pipeline.llm_facade
+    pipeline.enrich([make_study("NCT1", "Adults with asthma")])
+    pipeline.enrich([make_study("NCT2", "Adults with obesity")])
+    assert pipeline.llm_facade is llm_facade
+
+    pipeline.llm = FakeDiseaseLLM()
+    assert pipeline.llm_facade is not llm_facade
+    assert pipeline.llm_facade.llm is pipeline.llm
+
+
+def test_enrich_batched_packs_studies(pipeline_factory):
+    pipeline = pipeline_factory(cache_type=None, batch_token_budget=2000)
+    studies = [make_study(f"NCT{i}", "Patients with breast cancer") for i in range(10)]
+    pipeline.enrich_batched(studies)
+    assert all(study.diseases == ["breast cancer"] for study in studies)
+    assert pipeline.llm.calls == 1
+
+
+def test_enrich_batched_falls_back_to_single_calls(pipeline_factory, mocker):
+    pipeline = pipeline_factory(cache_type=None, batch_token_budget=2000)
+    studies = [make_study("NCT1", "Patients with melanoma"), make_study("NCT2", "Patients with obesity")]
+    # The batched answer only covers NCT1
+    mocker.patch.object(DiseaseExtractionTransformation, "extract_batch", return_value={"NCT1": ["melanoma"]})
+    pipeline.enrich_batched(studies)
+    assert [study.diseases for study in studies] == [["melanoma"], ["obesity"]]
+    assert pipeline.llm.calls == 1
+
+
+def test_enrich_batched_enriches_repeated_trial_ids(pipeline_factory):
+    pipeline = pipeline_factory(cache_type=None, batch_token_budget=2000)
+    studies = [make_study("NCT1", "Patients with melanoma"), make_study("NCT1", "Patients with obesity")]
+    pipeline.enrich_batched(studies)
+    assert [study.diseases for study in studies] == [["melanoma"], ["obesity"]]
+    # The repeat went through the single-study fallback
+    assert pipeline.llm.calls == 2
+
+
+def test_enrich_batched_counts_extractions_by_source(pipeline_factory):
+    pipeline = pipeline_factory(batch_token_budget=2000, match_min_coverage=0.8)
+    before = {source: counter.value for source, counter in EXTRACTIONS.items()}
+    studies = [
+        make_study("NCT1", "Adults with type 2 diabetes mellitus"),
+        make_study("NCT2", "Patients with asthma and Fabry disease"),
+        make_study("NCT3", "Patients with melanoma and Fabry disease"),
+    ]
+    pipeline.enrich_batched(studies)
+    pipeline.enrich_batched([make_study("NCT4", "Patients with asthma and Fabry disease")])
+    counts = {source: counter.value - before[source] for source, counter in EXTRACTIONS.items()}
+    assert counts == {"matcher": 1, "cache": 1, "llm": 2}
+
+
+def test_failed_extractions_are_dead_lettered_and_reprocessed(pipeline_factory):
+    pipeline = pipeline_factory(cache_type=None, llm=FakeDiseaseLLM(error_rate=1.0))
+    studies = pipeline.enrich([make_study("NCT1", "Adults with asthma")])
+    assert studies[0].diseases is None
+    pipeline.save_to_db(studies)
+    pipeline.flush_writes()
+    pipeline._flush_dead_letters()
+    assert pipeline.db_client.fetch_dead_letters() == ["NCT1"]
+
+    pipeline.llm = FakeDiseaseLLM()
+    pipeline.reprocess_dead_letters()
+    pipeline.flush_writes()
+    assert pipeline.db_client.fetch_dead_letters() == []
+    assert pipeline.db_client.find_studies(["NCT1"])[0]["diseases"] == ["asthma"]
+
+
+def test_dead_letters_are_deleted_once_their_studies_are_written(pipeline_factory, mocker):
+    pipeline = pipeline_factory(cache_type=None)
+    pipeline.save_to_db([make_study("NCT1", "Adults with asthma")])
+    pipeline.flush_writes()
+    # NCT2 has no stored study to re-process
+    pipeline.db_client.save_dead_letters({"NCT1": "timeout", "NCT2": "timeout"})
+
+    failing_write = mocker.patch.object(
+        pipeline.db_client.collection, "bulk_write", side_effect=RuntimeError("MongoDB went away")
+    )
+    pipeline.reprocess_dead_letters()
+    assert pipeline.close() == 1
+    assert sorted(pipeline.db_client.fetch_dead_letters()) == ["NCT1", "NCT2"]
+
+    mocker.stop(failing_write)
+    pipeline.reprocess_dead_letters()
+    assert pipeline.close() == 0
+    assert pipeline.db_client.fetch_dead_letters() == ["NCT2"]
+    assert pipeline.db_client.find_studies(["NCT1"])[0]["diseases"] == ["asthma"]
+
+
+def test_criteria_without_inclusion_section_skip_the_llm(pipeline_factory, monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    pipeline = pipeline_factory(llm=None)
+    exclusion_only = "Exclusion Criteria:\n* pregnancy"
+    studies = [StudyRecord(trialId="NCT1", eligibilityCriteria=exclusion_only)]
+    batched_studies = [StudyRecord(trialId="NCT2", eligibilityCriteria=exclusion_only)]
+    pipeline.enrich(studies)
+    pipeline.enrich_batched(batched_studies)
+    assert [study.diseases for study in studies + batched_studies] == [[], []]
+    assert pipeline.dead_letters == {}
+    # The extractor, and with it the LLM stack, was never built
+    assert pipeline._llm_facade is None
+
+
+def test_dictionary_matcher_skips_the_llm(pipeline_factory):
+    pipeline = pipeline_factory(cache_type=None, match_min_coverage=0.8)
+    studies = [
+        make_study("NCT1", "Adults with type 2 diabetes mellitus and heart failure"),
+        # Fabry disease is not in the vocabulary
+        make_study("NCT2", "Patients with asthma and Fabry disease"),
+    ]
+    pipeline.enrich(studies)
+    assert studies[0].diseases == ["type 2 diabetes", "heart failure"]
+    assert studies[1].diseases == ["asthma"]
+    assert pipeline.llm.calls == 1
+
+
+def test_conditions_unknown_to_the_matcher_go_to_the_llm(pipeline_factory, mocker):
+    pipeline = pipeline_factory(cache_type=None, match_min_coverage=0.8)
+    # Neither in the vocabulary nor condition-looking words
+    mocker.patch.object(DiseaseExtractionTransformation, "extract", return_value=["chronic low back pain"])
+    studies = pipeline.enrich([make_study("NCT1", "Adults with chronic low back pain")])
+    assert studies[0].diseases == ["chronic low back pain"]
+    assert DiseaseExtractionTransformation.extract.call_count == 1
+
+
+def test_long_criteria_are_compacted_and_chunked(pipeline_factory, mocker):
+    pipeline = pipeline_factory(cache_type=None, max_prompt_tokens=60)
+    filler = "\n* ".join(f"FEV1 measurement number {i} within the expected range" for i in range(20))
+    inclusion = f"Adults with asthma\n* Age 18 years or older\n* Signed informed consent\n* {filler}\n* Prior melanoma"
+    extract = mocker.spy(DiseaseExtractionTransformation, "_invoke")
+    studies = pipeline.enrich([make_study("NCT1", inclusion)])
+    assert studies[0].diseases == ["asthma", "melanoma"]
+    prompts = [call.args[2]["text"] for call in extract.call_args_list]
+    assert len(prompts) == pipeline.llm.calls > 1
+    assert not any("consent" in prompt or "Age 18" in prompt for prompt in prompts)
+
+
+def test_studies_are_exported_next_to_mongo(pipeline_factory, tmp_path, mocker):
+    exported = []
+    write = mocker.patch.object(ParquetWriter, "_write", side_effect=lambda documents: exported.extend(documents) or 0)
+    pipeline = pipeline_factory(cache_type=None, export_sinks=[ParquetExportSink(str(tmp_path / "exports"))])
+    studies = pipeline.enrich([make_study("NCT1", "Adults with asthma")])
+    committed = []
+    pipeline.save_to_db(studies)
+    pipeline._after_writes(lambda: committed.append(True))
+    pipeline.flush_writes()
+    assert committed == [True]
+    assert pipeline.db_client.find_studies(["NCT1"])[0]["diseases"] == ["asthma"]
+    assert [document["trialId"] for document in exported] == ["NCT1"]
+
+    # A failed export write holds the progress back and counts as a write error
+    write.side_effect = OSError("disk full")
+    pipeline.save_to_db(studies)
+    pipeline._after_writes(lambda: committed.append(True))
+    assert pipeline.close() == 1
+    assert committed == [True]
+
+
+def test_criteria_are_prepared_in_a_process_pool(pipeline_factory):
+    pipeline = pipeline_factory(cache_type=None, cpu_workers=2, cpu_chunk_size=2)
+    studies = [make_study(f"NCT{i}", "Adults  with asthma") for i in range(5)]
+    try:
+        pipeline.enrich(studies)
+    finally:
+        pipeline.close()
+    assert all(study.inclusion_criteria == "- Adults with asthma" for study in studies)
+    assert all(study.diseases == ["asthma"] for study in studies)
+
+
+def test_concurrent_stages_share_one_process_pool(pipeline_factory, mocker):
+    from concurrent.futures import ThreadPoolExecutor
+
+    pipeline = pipeline_factory(cache_type=None, cpu_workers=2, cpu_chunk_size=2)
+    pages = [[make_study(f"NCT{page}{i}", "Adults with asthma") for i in range(5)] for page in range(4)]
+    from concurrent.futures import ProcessPoolExecutor
+
+    def slow_pool(**kwargs):
+        # Widens the window between the None check and the assignment
+        time.sleep(0.05)
+        return ProcessPoolExecutor(**kwargs)
+
+    pool_class = mocker.patch("pipelines.trial_pipeline.ProcessPoolExecutor", side_effect=slow_pool)
+    try:
+        # Like the enrichment stages of the async pipeline
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(pipeline.prepare_criteria, pages))
+    finally:
+        pipeline.close()
+    assert pool_class.call_count == 1
+    assert all(study.inclusion_criteria == "- Adults with asthma" for page in pages for study in page)
+
+
+class FakeAsyncCrawler:
+    def __init__(self, pages):
+        self.pages = pages
+
+    async def afetch_trials(self, start_date, end_date, page_size=500):
+        for page in self.pages:
+            yield page
+
+
+class FakeAsyncDBClient:
+    def __init__(self):
+        self.documents = []
+        self.closed = False
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+    async def insert_many_documents(self, documents):
+        self.documents.extend(documents)
+
+
+def make_raw_study(trial_id, inclusion):
+    return {"protocolSection": {
+        "identificationModule": {"nctId": trial_id, "briefTitle": trial_id},
+        "eligibilityModule": {"eligibilityCriteria": make_study(trial_id, inclusion).eligibilityCriteria},
+    }}
+
+
+def test_async_pipeline_runs_all_stages(tmp_path, monkeypatch):
+    monkeypatch.setenv("EXTRACTION_CACHE_PATH", str(tmp_path / "cache.sqlite3"))
+    pipeline = AsyncClinicalTrialPipeline(llm=FakeDiseaseLLM(), llm_concurrency=4, match_min_coverage=None)
+    pages = [[make_raw_study(f"NCT{page}{i}", "Adults with psoriasis") for i in range(5)] for page in range(3)]
+    pipeline.crawler = FakeAsyncCrawler(pages)
+    pipeline.db_client = FakeAsyncDBClient()
+
+    assert asyncio.run(pipeline.arun(date(2024, 10, 20), date(2024, 10, 21)))
+    assert pipeline.db_client.closed
+
+    assert len(pipeline.db_client.documents) == 15
+    assert all(document["diseases"] == ["psoriasis"] for document in pipeline.db_client.documents)
+
+
+class FakeCrawler:
+    def __init__(self, pages):
+        self.pages = pages
+        self.last_error = None
+        self.requested_ranges = []
+
+    def fetch_trials(self, start_date, end_date, page_size=500):
+        self.requested_ranges.append((start_date, end_date))
+        yield from self.pages
+
+
+def test_incremental_run_skips_unchanged_studies(pipeline_factory):
+    pipeline = pipeline_factory(cache_type=None)
+    studies = [make_raw_study("NCT1", "Adults with asthma"), make_raw_study("NCT2", "Adults with obesity")]
+    studies[0]["protocolSection"]["statusModule"] = {"lastUpdatePostDateStruct": {"date": "2024-10-21"}}
+    pipeline.crawler = FakeCrawler([studies])
+
+    pipeline.run_incremental(end_date=date(2024, 10, 22))
+    assert pipeline.llm.calls == 2
+    assert pipeline.db_client.get_watermark("mocked_api") == "2024-10-21"
+
+    # Only NCT2 changed, and only its LastUpdatePostDate changed for NCT1
+    studies[0]["protocolSection"]["statusModule"]["lastUpdatePostDateStruct"]["date"] = "2024-10-23"
+    studies[1]["protocolSection"]["eligibilityModule"]["eligibilityCriteria"] += "\n* Adults with melanoma"
+    pipeline.run_incremental(end_date=date(2024, 10, 24))
+    assert pipeline.crawler.requested_ranges[-1] == (date(2024, 10, 21), date(2024, 10, 24))
+    assert pipeline.llm.calls == 3
+    assert pipeline.db_client.get_watermark("mocked_api") == "2024-10-23"
+
+
+def test_interrupted_run_resumes_from_checkpoint(pipeline_factory, tmp_path):
+    synthesize_pages(tmp_path / "pages", pages=3, page_size=10)
+    with ReplayServer(tmp_path / "pages") as server:
+        pipeline = pipeline_factory(cache_type=None, api_source="clinical_trials")
+        pipeline.crawler.base_url = server.url
+        save_to_db = pipeline.save_to_db
+        saves = []
+
+        def crash_on_third_page(studies):
+            saves.append(studies)
+            if len(saves) == 3:
+                raise RuntimeError("MongoDB went away")
+            save_to_db(studies)
+
+        pipeline.save_to_db = crash_on_third_page
+        with pytest.raises(RuntimeError):
+            pipeline.run(date(2024, 10, 20), date(2024, 10, 22))
+        assert pipeline.llm.calls == 30
+        assert server.requests == 3
+
+        resumed = pipeline_factory(cache_type=None, api_source="clinical_trials")
+        resumed.crawler.base_url = server.url
+        resumed.run(date(2024, 10, 20), date(2024, 10, 22))
+        # Restarted at the last committed page, and every enrichment came from the checkpoint
+        assert server.requests == 5
+        assert resumed.llm.calls == 0
+        assert resumed.db_client.collection.count_documents({"diseases": {"$ne": None}}) == 20
+        assert list((tmp_path / "checkpoints").iterdir()) == []
+
+
+def test_failed_write_stops_committing_progress(pipeline_factory, tmp_path, mocker):
+    synthesize_pages(tmp_path / "pages", pages=3, page_size=10)
+    with ReplayServer(tmp_path / "pages") as server:
+        pipeline = pipeline_factory(cache_type=None, api_source="clinical_trials")
+        pipeline.crawler.base_url = server.url
+        collection = pipeline.db_client.collection
+        bulk_write = collection.bulk_write
+        writes = []
+
+        def fail_first_write(*args, **kwargs):
+            # Only the write of the first page fails, the next ones succeed
+            writes.append(1)
+            if len(writes) == 1:
+                raise RuntimeError("MongoDB went away")
+            return bulk_write(*args, **kwargs)
+
+        mocker.patch.object(collection, "bulk_write", side_effect=fail_first_write)
+        assert pipeline.run(date(2024, 10, 20), date(2024, 10, 22)) is False
+        assert collection.count_documents({}) == 20
+        # Nothing was committed past the lost page
+        assert pipeline.checkpoints.load("clinical_trials:2024-10-20:2024-10-22").get("pageToken") is None
+
+        resumed = pipeline_factory(cache_type=None, api_source="clinical_trials")
+        resumed.crawler.base_url = server.url
+        assert resumed.run(date(2024, 10, 20), date(2024, 10, 22)) is True
+        assert resumed.llm.calls == 0
+        assert resumed.db_client.collection.count_documents({"diseases": {"$ne": None}}) == 30
+
+
+def test_pipeline_benchmark_reports_stages_and_thresholds(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+    synthesize_pages(tmp_path / "pages", pages=2, page_size=10)
+    result = run_benchmark(tmp_path / "pages", latency=0.0, match_min_coverage=None)
+    assert result["studies"] == 20
+    assert result["llm_calls"] == 20
+    assert {"fetch", "mapping", "llm", "enrich", "write", "bulk_write"} <= set(result["stages"])
+    assert result["stages"]["fetch"]["count"] == 2
+
+    assert check_thresholds(result, {"min_studies_per_second": 0, "max_p99_seconds": {"fetch": 60}}) == []
+    failures = check_thresholds(result, {"max_peak_rss_mib": 1, "max_p99_seconds": {"llm": 0, "bulk_write": 0}})
+    assert len(failures) == 3
+    assert check_thresholds(result, {"max_p99_seconds": {"shard": 60}}) == ["shard was not measured"]
+
+
+def test_workers_drain_the_job_queue(pipeline_factory, tmp_path, mocker):
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Every worker talks to the same server, like processes sharing one mongod
+    server_client = mongomock.MongoClient()
+    for module in ("db_client", "job_queue", "checkpoint_client"):
+        mocker.patch(f"clients.{module}.MongoClient", return_value=server_client)
+
+    synthesize_pages(tmp_path / "pages", pages=3, page_size=10)
+    # Each shard gets its own studies, so the workers never upsert the same trial at once
+    with ReplayServer(tmp_path / "pages", distinct_queries=True) as server:
+        def make_pipeline():
+            pipeline = pipeline_factory(cache_type=None, api_source="clinical_trials", checkpoint_type="mongo")
+            pipeline.crawler.base_url = server.url
+            return pipeline
+
+        coordinator = JobCoordinator(make_pipeline().crawler, "clinical_trials", MongoJobQueue())
+        # The replay server counts all 30 studies for any range, so the range splits down to days
+        assert coordinator.plan(date(2024, 10, 20), date(2024, 10, 22), target_shard_size=10) == 3
+
+        workers = [JobWorker(make_pipeline(), MongoJobQueue(), worker_id=f"worker-{i}", poll_interval=0.01) for i in range(2)]
+        reprocess_dead_letters = mocker.spy(ClinicalTrialPipeline, "reprocess_dead_letters")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(lambda worker: worker.run(), workers))
+
+        # Left to the coordinator, once
+        assert reprocess_dead_letters.call_count == 0
+        assert coordinator.wait(poll_interval=0.01) == {"pending": 0, "running": 0, "done": 3, "failed": 0}
+        assert {job["status"] for job in MongoJobQueue().jobs.find()} == {"done"}
+        # 30 studies in each of the 3 shards
+        assert workers[0].pipeline.db_client.collection.count_documents({"diseases": {"$ne": None}}) == 90
+
+
+# Cumulative import time allowed for pipelines.trial_pipeline, about 0.2s here against 1.1s when
+# the LLM stack was imported eagerly
+IMPORT_TIME_BUDGET_SECONDS = 0.75
+
+
+def test_pipeline_import_stays_light():
+    code = (
+        "import sys, pipelines.trial_pipeline; "
+        "print(','.join(m for m in ('langchain', 'langchain_core', 'langchain_openai', 'openai') if m in sys.modules))"
+    )
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True)
+    # The LLM stack is only imported when an extractor is built
+    assert result.stdout.strip() == ""
+    cumulative_us = next(
+        int(line.split("|")[1]) for line in result.stderr.splitlines() if line.rstrip().endswith("| pipelines.trial_pipeline")
+    )
+    assert cumulative_us / 1e6 < IMPORT_TIME_BUDGET_SECONDS
@@ -0,0 +1,110 @@
+from transformations.trial_transformation import ClinicalTrialTransformationMapping, StudyRecord
+from transformations.disease_matcher import DiseaseMatcher, parse_disease_list
+from transformations.eligibility import split_eligibility_criteria, strip_boilerplate
+from transformations.tokens import chunk_by_tokens, count_tokens
+
+RAW_STUDY = {"protocolSection": {
+    "identificationModule": {"nctId": "NCT00000001", "briefTitle": "Asthma study"},
+    "statusModule": {
+        "startDateStruct": {"date": "2024-01"},
+        "lastUpdatePostDateStruct": {"date": "2024-10-21"},
+    },
+    "designModule": {"phases": ["PHASE2"]},
+    "contactsLocationsModule": {
+        "overallOfficials": [
+            {"name": "Dr Sub", "role": "SUB_INVESTIGATOR"},
+            {"name": "Dr Who", "affiliation": "Gallifrey Hospital", "role": "PRINCIPAL_INVESTIGATOR"},
+        ],
+        "locations": [{"facility": "Hospital", "city": "Rabat", "country": "Morocco"}, {"city": "Paris"}],
+    },
+    "eligibilityModule": {"eligibilityCriteria": "Inclusion Criteria:\n* asthma"},
+}}
+
+
+def test_mapping_yields_compact_records():
+    records = list(ClinicalTrialTransformationMapping().iter_transform(iter([RAW_STUDY, {}])))
+    record = records[0]
+    assert record.trialId == "NCT00000001"
+    assert record.piName == "Dr Who"
+    assert record.locations == (("Hospital", "Rabat", "Morocco"), (None, "Paris", None))
+    assert record.endDate is None
+    assert record.contentHash
+    assert records[1].trialId is None
+
+
+def test_to_bson_keeps_stored_document_shape():
+    record = ClinicalTrialTransformationMapping().transform([RAW_STUDY])[0]
+    document = record.to_bson()
+    assert document["endDate"] == "Unknown"
+    assert document["phase"] == ["PHASE2"]
+    assert document["principalInvestigator"] == {"name": "Dr Who", "affiliation": "Gallifrey Hospital"}
+    assert document["locations"][1] == {"facility": "Unknown", "city": "Paris", "country": "Unknown"}
+    assert "diseases" not in document
+
+    record.inclusion_criteria = "* asthma"
+    record.diseases = "asthma"
+    restored = StudyRecord.from_bson(record.to_bson())
+    assert restored == record
+
+
+def test_content_hash_ignores_last_update_date():
+    mapping = ClinicalTrialTransformationMapping()
+    first = mapping.transform([RAW_STUDY])[0]
+    RAW_STUDY["protocolSection"]["statusModule"]["lastUpdatePostDateStruct"]["date"] = "2024-10-25"
+    try:
+        second = mapping.transform([RAW_STUDY])[0]
+    finally:
+        RAW_STUDY["protocolSection"]["statusModule"]["lastUpdatePostDateStruct"]["date"] = "2024-10-21"
+    assert first.contentHash == second.contentHash
+
+
+def test_disease_matcher_prefers_longest_names():
+    matcher = DiseaseMatcher()
+    match = matcher.match("Adults with Non-Small Cell Lung Cancer (NSCLC), history of\nheart failure")
+    assert match.diseases == ["lung cancer", "heart failure"]
+    assert match.coverage == 1.0
+    # Word boundaries: no "all" or "copd" inside other words
+    assert matcher.match("All patients, copdx").diseases == []
+    assert matcher.match("Patients with hepatitis").coverage == 0.0
+
+
+def test_parse_disease_list_normalizes_llm_answers():
+    assert parse_disease_list("Asthma, hypertension, and Diabetes.\n- COPD\nNone") == [
+        "asthma", "hypertension", "diabetes mellitus", "chronic obstructive pulmonary disease"
+    ]
+    assert parse_disease_list(["Head and neck cancer", "breast carcinoma", "Breast cancer"]) == [
+        "head and neck cancer", "breast cancer"
+    ]
+    assert parse_disease_list("") == []
+    assert parse_disease_list("There are no diseases mentioned in the text.") == []
+    assert parse_disease_list("The text does not mention any medical condition") == []
+
+
+def test_split_eligibility_criteria_handles_header_variants():
+    text = "KEY INCLUSION CRITERIA\n1. Age >= 18\n2)  Confirmed   COPD\n\nKey Exclusion Criteria:\n* smoker"
+    assert split_eligibility_criteria(text) == ("- Age >= 18\n- Confirmed COPD", "- smoker")
+    # No inclusion header: what comes before the exclusion header is the inclusion section
+    assert split_eligibility_criteria("Healthy volunteers\nExclusion: pregnancy") == ("- Healthy volunteers", "- pregnancy")
+    assert split_eligibility_criteria("Inclusion Criteria:\n* Inclusion in the registry") == ("- Inclusion in the registry", "")
+
+
+def test_strip_boilerplate_keeps_lines_naming_conditions():
+    criteria = ("- Age 18 years or older\n- Signed informed consent\n- Women of childbearing potential must use contraception"
+                "\n- Adults aged 18 or older with asthma\n- FEV1 below 80%")
+    assert strip_boilerplate(criteria, keep=DiseaseMatcher().mentions_condition) == (
+        "- Adults aged 18 or older with asthma\n- FEV1 below 80%"
+    )
+    # Conditions outside the vocabulary are kept with their age clause
+    criteria = "- Aged 50 or older with cataract\n- Patients aged 40+ with chronic low back pain\n- Age 18 or older"
+    assert strip_boilerplate(criteria, keep=DiseaseMatcher().mentions_condition) == (
+        "- Aged 50 or older with cataract\n- Patients aged 40+ with chronic low back pain"
+    )
+
+
+def test_chunk_by_tokens_splits_on_lines():
+    text = "\n".join(f"- criterion number {i} about asthma control" for i in range(50))
+    chunks = chunk_by_tokens(text, 40)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 40 for chunk in chunks)
+    assert "\n".join(chunks) == text
+    assert chunk_by_tokens("- asthma", 40) == ["- asthma"]
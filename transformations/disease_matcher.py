@@ -0,0 +1,188 @@
+from transformations.base_transformations import TransformationStrategy
+from clients.bootstrap import get_logger
+from collections import deque, namedtuple
+from functools import lru_cache
+import os
+import re
+
+VOCABULARY_PATH = os.path.join(os.path.dirname(__file__), "data", "conditions.tsv")
+
+# Words that name a condition even when it is not in the vocabulary, the coverage of a match is
+# the share of these words it explains
+_CONDITION_WORD = re.compile(
+    r"\b(?!(?:diagnosis|prognosis)\b)(?:\w+(?:itis|oma|omas|emia|aemia|osis|pathy|plasia|algia|iasis)"
+    r"|disease|diseases|disorder|disorders|syndrome|cancer|cancers|carcinoma|tumor|tumour|tumors|tumours"
+    r"|infection|infections|failure|deficiency|insufficiency|injury)\b"
+)
+# "... with X", "history of X": X is very likely a condition
+_CONDITION_CONTEXT = re.compile(
+    r"\b(?:diagnos(?:is|ed)\s+(?:of|with)|history\s+of|suffering\s+from"
+    r"|(?:patients?|subjects?|participants?|adults?|children|women|men)\s+with)\s+(?:an?\s+|the\s+)?([\w'-]+)"
+)
+# Words following those phrases that are qualifiers rather than a condition
+_CONTEXT_QUALIFIERS = {
+    "confirmed", "documented", "established", "known", "clinical", "clinically", "prior", "previous",
+    "current", "active", "newly", "histologically", "cytologically", "diagnosis", "history", "signs",
+    "symptoms", "evidence", "suspected", "any", "at", "no", "stable", "written", "ability",
+}
+_NOT_A_DISEASE = {"", "none", "n/a", "na", "no", "nil", "unknown"}
+# Sentences the LLM answers instead of an empty list: "There are no diseases mentioned in the text."
+_REFUSAL = re.compile(
+    r"\bno\s+(?:\w+\s+){0,2}(?:diseases?|medical|conditions?|disorders?)\b"
+    r"|\b(?:does|do|is|are)\s+not\s+(?:\w+\s+)?(?:mention|contain|include|identif|list|specif)"
+    r"|\bnot\s+(?:mentioned|found|identified|specified|present)\b"
+)
+_LIST_ITEM_PREFIX = re.compile(r"^(?:[-*•]+|\d+[.)])\s*|^(?:and|or)\s+")
+
+DiseaseMatch = namedtuple("DiseaseMatch", ["diseases", "coverage"])
+
+
+def normalize_disease(name):
+    """Lowercase, single-spaced form of a condition name, used for storage and lookups."""
+    name = name.lower().replace("’", "'")
+    return re.sub(r"\s+", " ", name).strip(" .;:\"'")
+
+
+@lru_cache(maxsize=None)
+def load_vocabulary(path=VOCABULARY_PATH):
+    """{normalized name or synonym: canonical name} of the bundled condition vocabulary, read once per process."""
+    vocabulary = {}
+    with open(path, encoding="utf-8") as vocabulary_file:
+        for line in vocabulary_file:
+            if not line.strip() or line.startswith("#"):
+                continue
+            canonical, _, synonyms = line.rstrip("\n").partition("\t")
+            canonical = normalize_disease(canonical)
+            vocabulary[canonical] = canonical
+            for synonym in filter(None, synonyms.split("|")):
+                vocabulary[normalize_disease(synonym)] = canonical
+    return vocabulary
+
+
+def parse_disease_list(content, vocabulary=None):
+    """
+    Normalize a free-text LLM answer ("Asthma, hypertension and diabetes", a bullet list...) into
+    a de-duplicated list of lowercase disease names, synonyms mapped to their canonical name.
+    """
+    vocabulary = load_vocabulary() if vocabulary is None else vocabulary
+    items = re.split(r"[,;\n]", content) if isinstance(content, str) else content or []
+    names = []
+    for item in items:
+        name = normalize_disease(_LIST_ITEM_PREFIX.sub("", item.strip()))
+        # "asthma and diabetes" is two diseases, "head and neck cancer" is one
+        names.extend([name] if name in vocabulary else name.split(" and "))
+    diseases = []
+    for name in names:
+        name = normalize_disease(name)
+        if name in _NOT_A_DISEASE or _REFUSAL.search(name):
+            continue
+        name = vocabulary.get(name, name)
+        if name not in diseases:
+            diseases.append(name)
+    return diseases
+
+
+class AhoCorasickAutomaton:
+    """Multi-pattern matcher: finds every occurrence of all patterns in a single pass over the text."""
+
+    def __init__(self, patterns):
+        # State 0 is the root, each state has its transitions, failure link and (length, value) outputs
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+        for pattern, value in patterns.items():
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._outputs.append([])
+                state = next_state
+            self._outputs[state].append((len(pattern), value))
+
+        # Breadth-first so failure links always point to already finished states
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, next_state in self._goto[state].items():
+                pending.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._outputs[next_state].extend(self._outputs[self._fail[next_state]])
+
+    def iter_matches(self, text):
+        """Yield (start, end, value) for every pattern occurrence, overlapping ones included."""
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, value in outputs[state]:
+                yield position + 1 - length, position + 1, value
+
+
+class DiseaseMatcher(TransformationStrategy):
+    """
+    Local first pass of the disease extraction: the bundled condition vocabulary is matched on
+    word boundaries, overlapping hits resolve to the longest one. `match` also reports how much
+    of the condition-looking words of the text the hits explain, so the caller can decide
+    whether the LLM is still needed.
+    """
+
+    def __init__(self, vocabulary_path=VOCABULARY_PATH):
+        self.logger = get_logger(self.__class__.__name__)
+        self.vocabulary = load_vocabulary(vocabulary_path)
+        self.automaton = AhoCorasickAutomaton(self.vocabulary)
+        self.logger.warning(f'Loaded {len(self.vocabulary)} condition names')
+
+    def transform(self, text):
+        return self.match(text).diseases
+
+    def match(self, text):
+        text = normalize_disease(text or "")
+        spans = self._longest_matches(text)
+
+        condition_words = [match.span() for match in _CONDITION_WORD.finditer(text)]
+        condition_words += [
+            match.span(1) for match in _CONDITION_CONTEXT.finditer(text) if match.group(1) not in _CONTEXT_QUALIFIERS
+        ]
+        condition_words = set(condition_words)
+        if not condition_words:
+            coverage = 1.0
+        else:
+            covered = sum(
+                any(start <= word_start and word_end <= end for start, end, _ in spans)
+                for word_start, word_end in condition_words
+            )
+            coverage = covered / len(condition_words)
+
+        diseases = []
+        for _, _, disease in spans:
+            if disease not in diseases:
+                diseases.append(disease)
+        return DiseaseMatch(diseases, coverage)
+
+    def mentions_condition(self, text):
+        """True when text names a known condition or has condition-looking words."""
+        match = self.match(text)
+        return bool(match.diseases) or match.coverage < 1.0
+
+    def _longest_matches(self, text):
+        candidates = [
+            (start, end, value) for start, end, value in self.automaton.iter_matches(text)
+            if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+        ]
+        # Leftmost-longest, non-overlapping
+        candidates.sort(key=lambda match: (match[0], match[0] - match[1]))
+        spans, last_end = [], 0
+        for start, end, value in candidates:
+            if start >= last_end:
+                spans.append((start, end, value))
+                last_end = end
+        return spans
@@ -0,0 +1,76 @@
+import re
+
+# Compiled once per process. Headers seen on ClinicalTrials.gov: "Inclusion Criteria:", "KEY INCLUSION
+# CRITERIA", "Inclusion criteria for patients:", "Inclusion:", "Criteria for inclusion", "Exclusion
+# Criteria", "Non-inclusion criteria"..., usually alone on their line, sometimes followed by the text
+_INCLUSION_HEADER = re.compile(
+    r"^[ \t*#_-]*(?:(?:key|main|general)\s+)?(?:inclusion\s+criteria|criteria\s+for\s+inclusion)\b[^:\n]{0,40}?(?::|$)"
+    r"|^[ \t*#_-]*inclusions?\s*:",
+    re.IGNORECASE | re.MULTILINE
+)
+_EXCLUSION_HEADER = re.compile(
+    r"^[ \t*#_-]*(?:(?:key|main|general)\s+)?(?:exclusion\s+criteria|non-inclusion\s+criteria|criteria\s+for\s+exclusion)"
+    r"\b[^:\n]{0,40}?(?::|$)"
+    r"|^[ \t*#_-]*exclusions?\s*:",
+    re.IGNORECASE | re.MULTILINE
+)
+_BULLET = re.compile(r"^(?:[*•·‣◦▪o-]|\d{1,2}[.)]|[a-z][.)]|\(\w{1,3}\))\s+", re.IGNORECASE)
+_SPACES = re.compile(r"[ \t ]+")
+
+
+def normalize_criteria(text):
+    """One criterion per line, each prefixed with '- ', inner whitespace collapsed and blank lines dropped."""
+    lines = []
+    for line in text.splitlines():
+        line = _SPACES.sub(" ", line).strip()
+        if not line:
+            continue
+        lines.append(f"- {_BULLET.sub('', line)}")
+    return "\n".join(lines)
+
+
+def split_eligibility_criteria(eligibility_criteria):
+    """
+    Split an eligibility criteria text into normalized (inclusion, exclusion) sections.
+
+    Without an inclusion header, everything before the exclusion header (or the whole text) is
+    taken as inclusion criteria.
+    """
+    if not eligibility_criteria:
+        return "", ""
+    exclusion = _EXCLUSION_HEADER.search(eligibility_criteria)
+    inclusion = _INCLUSION_HEADER.search(eligibility_criteria, 0, exclusion.start() if exclusion else len(eligibility_criteria))
+    inclusion_start = inclusion.end() if inclusion else 0
+    inclusion_end = exclusion.start() if exclusion else len(eligibility_criteria)
+    exclusion_text = eligibility_criteria[exclusion.end():] if exclusion else ""
+    return normalize_criteria(eligibility_criteria[inclusion_start:inclusion_end]), normalize_criteria(exclusion_text)
+
+
+def split_eligibility_batch(texts):
+    """Process pool entry point: a whole chunk per task, so pickling is paid once per chunk."""
+    return [split_eligibility_criteria(text) for text in texts]
+
+
+# Criteria found in most trials that never name a disease: age limits, consent and compliance,
+# contraception and pregnancy. Dropped from the text sent to the LLM (see strip_boilerplate)
+_BOILERPLATE = re.compile(
+    r"\b(?:age[ds]?|years?\s+(?:of\s+age|old)|or\s+older)\b"
+    r"|\b(?:informed\s+consent|consent\s+form|assent)\b"
+    r"|\b(?:willing(?:ness)?|able|ability)\s+(?:and\s+able\s+)?to\s+(?:comply|participate|understand|sign|provide|give|attend)\b"
+    r"|\b(?:contracepti\w*|birth\s+control|childbearing\s+potential|pregnancy\s+test|breast-?\s?feeding|lactating)\b",
+    re.IGNORECASE
+)
+# "Aged 50 or older with cataract": the line may name a condition the vocabulary does not know
+_CONDITION_HINT = re.compile(r"\b(?:with|history\s+of|diagnos\w*|suffer\w*)\b", re.IGNORECASE)
+
+
+def strip_boilerplate(criteria, keep=None):
+    """
+    Drop the boilerplate lines of normalized criteria. Lines that may name a condition ("with",
+    "history of", "diagnosed"...) stay, as do those for which keep(line) is true.
+    """
+    lines = [
+        line for line in criteria.splitlines()
+        if not _BOILERPLATE.search(line) or _CONDITION_HINT.search(line) or (keep is not None and keep(line))
+    ]
+    return "\n".join(lines)
@@ -0,0 +1,60 @@
+import json
+import random
+import re
+import threading
+import time
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+# Small vocabulary so the fake answers look like real extractions
+KNOWN_DISEASES = [
+    "asthma", "hypertension", "diabetes", "breast cancer", "lung cancer", "melanoma",
+    "chronic kidney disease", "heart failure", "atrial fibrillation", "hiv", "hepatitis c",
+    "covid-19", "alzheimer's disease", "parkinson's disease", "multiple sclerosis",
+    "rheumatoid arthritis", "psoriasis", "depression", "schizophrenia", "obesity",
+]
+
+BATCH_MARKER = "Trials (JSON):"
+
+
+class FakeDiseaseLLM(RunnableLambda):
+    """
+    Offline stand-in for ChatOpenAI, usable wherever the extractor expects an LLM.
+
+    Answers single prompts with a comma separated list and batched prompts with a JSON object,
+    after sleeping `latency` seconds (+ `per_item_latency` per batched trial). `error_rate` makes
+    a fraction of the calls raise, like a flaky API would.
+    """
+
+    def __init__(self, latency=0.0, per_item_latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.error_rate = error_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        super().__init__(self._answer)
+
+    def _answer(self, prompt):
+        text = prompt.to_string() if hasattr(prompt, "to_string") else str(prompt)
+        with self._lock:
+            self.calls += 1
+            failed = self._random.random() < self.error_rate
+        if BATCH_MARKER in text:
+            trials = json.loads(text.split(BATCH_MARKER, 1)[1])
+            time.sleep(self.latency + self.per_item_latency * len(trials))
+            if failed:
+                raise RuntimeError("Fake LLM error")
+            content = json.dumps({trial_id: self._find_diseases(criteria) for trial_id, criteria in trials.items()})
+        else:
+            time.sleep(self.latency)
+            if failed:
+                raise RuntimeError("Fake LLM error")
+            content = ", ".join(self._find_diseases(text.split("Text:", 1)[-1]))
+        return AIMessage(content=content)
+
+    @staticmethod
+    def _find_diseases(text):
+        lowered = text.lower()
+        return [disease for disease in KNOWN_DISEASES if re.search(rf"\b{re.escape(disease)}\b", lowered)]
@@ -1,50 +1,296 @@
-from dotenv import load_dotenv
-load_dotenv(override=True)
-from langchain import LLMChain
-from langchain_openai import ChatOpenAI
-from langchain.prompts import PromptTemplate
 from transformations.base_transformations import TransformationStrategy
-from langchain.globals import set_verbose, get_verbose
-set_verbose(False)  # new way
-import logging
-import sys
+from transformations.disease_matcher import parse_disease_list
+from transformations.tokens import chunk_by_tokens, count_tokens
+from clients.bootstrap import get_logger
+from clients.metrics import REGISTRY, SIZE_BUCKETS
+# The langchain/openai stack takes most of the import time of the pipeline, it is only
+# imported by the first DiseaseExtractionTransformation (see _load_llm_stack)
+import asyncio
+import httpx
+import json
+import os
+import re
+import threading
+import time
+
+
+# Prompt instructions + a typical answer, added to the criteria size when reserving rate limit tokens
+PROMPT_OVERHEAD_TOKENS = 150
+
+# Longer criteria are split into chunks extracted separately, default of LLM_MAX_PROMPT_TOKENS
+LLM_MAX_PROMPT_TOKENS = 2000
+
+# Single-study and batched prompts are tracked apart, their latency and size differ a lot
+LLM_SECONDS = {
+    kind: REGISTRY.histogram("llm_request_seconds", "Latency of one LLM call", kind=kind) for kind in ("single", "batch")
+}
+LLM_TOKENS = {
+    kind: REGISTRY.histogram("llm_tokens_per_call", "Tokens used by one LLM call (estimated when not reported)",
+                             buckets=SIZE_BUCKETS, kind=kind)
+    for kind in ("single", "batch")
+}
+# Whole study, over all its chunks, so the tokens-per-minute budget can be planned per study
+STUDY_PROMPT_TOKENS = REGISTRY.histogram("llm_prompt_tokens_per_study", "Prompt tokens sent for one study",
+                                         buckets=SIZE_BUCKETS)
+LLM_ERRORS = {
+    kind: REGISTRY.counter("llm_errors_total", "Failed LLM calls, before retries", kind=kind) for kind in ("single", "batch")
+}
+
+
+# Pool of the HTTP client shared by every ChatOpenAI built here, warm connections are reused
+# across studies, pages and runs instead of paying a TLS handshake per extractor. Defaults of the
+# LLM_MAX_CONNECTIONS / LLM_KEEPALIVE_EXPIRY environment variables, read when a client is built
+LLM_MAX_CONNECTIONS = 100
+LLM_KEEPALIVE_EXPIRY = 60.0
+
+# Threads beyond max_connections wait for a free connection instead of opening one
+LLM_HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0, pool=None)
+
+_http_clients = {}
+_http_clients_lock = threading.Lock()
+
+
+def _pool_limits(max_connections=None, keepalive_expiry=None):
+    max_connections = max_connections or int(os.getenv('LLM_MAX_CONNECTIONS', LLM_MAX_CONNECTIONS))
+    if keepalive_expiry is None:
+        keepalive_expiry = float(os.getenv('LLM_KEEPALIVE_EXPIRY', LLM_KEEPALIVE_EXPIRY))
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=keepalive_expiry
+    )
+
+
+def get_http_client(max_connections=None, keepalive_expiry=None):
+    """Process-wide pooled httpx.Client for the OpenAI API, one per pool configuration."""
+    key = (max_connections, keepalive_expiry)
+    with _http_clients_lock:
+        client = _http_clients.get(key)
+        if client is None:
+            client = httpx.Client(limits=_pool_limits(max_connections, keepalive_expiry), timeout=LLM_HTTP_TIMEOUT)
+            _http_clients[key] = client
+        return client
+
+
+_llm_stack = None
+_llm_stack_lock = threading.Lock()
+
+
+def _load_llm_stack():
+    """(ChatOpenAI, PromptTemplate), imported on first use."""
+    global _llm_stack
+    with _llm_stack_lock:
+        if _llm_stack is None:
+            from langchain.globals import set_verbose
+            from langchain_core.prompts import PromptTemplate
+            from langchain_openai import ChatOpenAI
+            set_verbose(False)
+            _llm_stack = ChatOpenAI, PromptTemplate
+        return _llm_stack
+
+
+def batch_by_token_budget(texts_by_id, max_tokens, max_batch_size=25):
+    """Group {trialId: text} into batches whose estimated prompt size stays under max_tokens."""
+    batch, batch_tokens = {}, 0
+    for trial_id, text in texts_by_id.items():
+        tokens = count_tokens(text) + count_tokens(trial_id) + 4
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_batch_size):
+            yield batch
+            batch, batch_tokens = {}, 0
+        batch[trial_id] = text
+        batch_tokens += tokens
+    if batch:
+        yield batch
 
 
 class DiseaseExtractionTransformation(TransformationStrategy):
-    def __init__(self):
-        # Set up logging similar to trial transformation
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(name)s - %(message)s - PID:%(process)d',
-            handlers=[
-                logging.FileHandler('disease_extraction_processing.log'),
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
-        self.logger = logging.getLogger(self.__class__.__name__)
-        
+    """
+    Thread-safe: the prompt chains are built once and the LLM client is shared, so a single
+    instance should serve every enrichment thread (see ClinicalTrialPipeline.llm_facade).
+    """
+
+    MODEL_NAME = "gpt-4o-mini"
+    # Bump whenever one of the prompts changes so cached extractions are not reused
+    PROMPT_VERSION = "v2"
+
+    def __init__(self, llm=None, rate_limiter=None, max_connections=None, keepalive_expiry=None,
+                 max_prompt_tokens=None):
+        self.logger = get_logger(self.__class__.__name__)
+        _, PromptTemplate = _load_llm_stack()
+        self.max_prompt_tokens = max_prompt_tokens or int(os.getenv('LLM_MAX_PROMPT_TOKENS', LLM_MAX_PROMPT_TOKENS))
+
         # Initialize LLM components
-        self.llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+        # Shared OpenAIRateLimiter, its owner (the pipeline) is then also in charge of retries
+        self.rate_limiter = rate_limiter
+        # Any runnable answering with a message works, e.g. FakeDiseaseLLM for offline runs
+        self.source_llm = llm
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.llm = llm if llm is not None else self._chat_model(
+            http_client=get_http_client(max_connections, keepalive_expiry)
+        )
+        # Async counterpart of llm_chain, only built by the async path (see _async_chain)
+        self._http_async_client = None
+        self._async_llm_chain = None
         self.prompt_template = PromptTemplate(
             input_variables=["text"],
-            template="Identify and list all diseases or medical conditions in the following text. Do not include any other text, if it does not incldue any disease return an empty string.\n\nText: {text}"
+            template="Identify and list all diseases or medical conditions in the following text, as a comma separated list. Do not include any other text, if it does not incldue any disease return an empty string.\n\nText: {text}"
         )
         self.llm_chain = self.prompt_template | self.llm
+        self.batch_prompt_template = PromptTemplate(
+            input_variables=["trials"],
+            template="For each trial in the following JSON object, identify and list all diseases or medical conditions in its text. "
+                     "Answer only with a JSON object mapping every trial id to a list of disease names, use an empty list if a text does not include any disease. "
+                     "Example: {{\"NCT00000000\": [\"asthma\"]}}\n\nTrials (JSON): {trials}"
+        )
+        self.batch_llm_chain = self.batch_prompt_template | self.llm
+
+    def _chat_model(self, **clients):
+        ChatOpenAI, _ = _load_llm_stack()
+        return ChatOpenAI(
+            model=self.MODEL_NAME,
+            temperature=0,
+            include_response_headers=True,
+            max_retries=0 if self.rate_limiter is not None else 2,
+            **clients
+        )
+
+    def _async_chain(self):
+        """
+        Chain used by aextract. With ChatOpenAI, its httpx.AsyncClient is bound to the event loop of
+        its first use, so it is created on the first async call and released by aclose.
+        """
+        if self._async_llm_chain is None:
+            if self.source_llm is not None:
+                self._async_llm_chain = self.llm_chain
+            else:
+                self._http_async_client = httpx.AsyncClient(
+                    limits=_pool_limits(self.max_connections, self.keepalive_expiry), timeout=LLM_HTTP_TIMEOUT
+                )
+                # Reuses the sync client of self.llm instead of building another one
+                async_llm = self._chat_model(client=self.llm.client, http_async_client=self._http_async_client)
+                self._async_llm_chain = self.prompt_template | async_llm
+        return self._async_llm_chain
+
+    async def aclose(self):
+        """Close the async connection pool, called at the end of AsyncClinicalTrialPipeline.arun."""
+        if self._http_async_client is not None:
+            await self._http_async_client.aclose()
+        self._http_async_client = None
+        self._async_llm_chain = None
 
     def transform(self, text):
         if not text:
             self.logger.warning("No text provided for disease extraction")
-            return 'No diseases found because no inclusion criteria was found'
+            return []
         
         try:
-            response = self.llm_chain.invoke({'text': text})
-            extracted_diseases = response.content  # Updated to access content
-            # self.logger.info(f"Successfully extracted {(extracted_diseases)} diseases")
-            return extracted_diseases
+            return self.extract(text)
         except Exception as e:
             self.logger.error(f"Error during disease extraction: {str(e)}")
-            return f'No diseases found because of {str(e)}'
-        
+            return []
+
+    def extract(self, text):
+        """
+        Call the LLM and return its answer as a normalized list of diseases, errors are raised to the caller.
+
+        Texts over max_prompt_tokens are sent in chunks and the lists of the chunks are merged.
+        """
+        chunks = self._chunks(text)
+        extracted = []
+        for chunk, prompt_tokens in chunks:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(prompt_tokens)
+            response = self._invoke(self.llm_chain, {'text': chunk}, "single", prompt_tokens)
+            extracted.extend(parse_disease_list(response.content))
+        STUDY_PROMPT_TOKENS.observe(sum(prompt_tokens for _, prompt_tokens in chunks))
+        return parse_disease_list(extracted)
+
+    async def aextract(self, text):
+        """Non-blocking extract, used by the async pipeline. The chunks of a long text are sent concurrently."""
+        chunks = self._chunks(text)
+        extracted = await asyncio.gather(*[self._aextract_chunk(chunk, prompt_tokens) for chunk, prompt_tokens in chunks])
+        STUDY_PROMPT_TOKENS.observe(sum(prompt_tokens for _, prompt_tokens in chunks))
+        return parse_disease_list([disease for diseases in extracted for disease in diseases])
+
+    async def _aextract_chunk(self, chunk, prompt_tokens):
+        if self.rate_limiter is not None:
+            await self.rate_limiter.aacquire(prompt_tokens)
+        started = time.perf_counter()
+        try:
+            response = await self._async_chain().ainvoke({'text': chunk})
+        except Exception:
+            LLM_ERRORS["single"].inc()
+            raise
+        self._record_call(response, "single", started, prompt_tokens)
+        return parse_disease_list(response.content)
+
+    def _chunks(self, text):
+        """[(chunk, prompt tokens)] of text, a single chunk unless it is over max_prompt_tokens."""
+        return [
+            (chunk, count_tokens(chunk) + PROMPT_OVERHEAD_TOKENS)
+            for chunk in chunk_by_tokens(text, self.max_prompt_tokens)
+        ]
+
+    def extract_batch(self, texts_by_id):
+        """
+        Extract diseases for several trials with a single LLM call.
+
+        Args:
+            texts_by_id (dict): trialId -> inclusion criteria text.
+
+        Returns:
+            dict: trialId -> normalized list of diseases, only for the entries the LLM answered properly.
+        """
+        trials = json.dumps(texts_by_id)
+        prompt_tokens = count_tokens(trials) + PROMPT_OVERHEAD_TOKENS * len(texts_by_id)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(prompt_tokens)
+        response = self._invoke(self.batch_llm_chain, {'trials': trials}, "batch", prompt_tokens)
+        for text in texts_by_id.values():
+            STUDY_PROMPT_TOKENS.observe(count_tokens(text) + PROMPT_OVERHEAD_TOKENS)
+        return self._parse_batch_response(response.content, texts_by_id)
+
+    def _invoke(self, chain, inputs, kind, estimated_tokens):
+        started = time.perf_counter()
+        try:
+            response = chain.invoke(inputs)
+        except Exception:
+            LLM_ERRORS[kind].inc()
+            raise
+        self._record_call(response, kind, started, estimated_tokens)
+        return response
+
+    def _record_call(self, response, kind, started, estimated_tokens):
+        LLM_SECONDS[kind].observe(time.perf_counter() - started)
+        usage = getattr(response, 'usage_metadata', None) or {}
+        LLM_TOKENS[kind].observe(usage.get('total_tokens') or estimated_tokens)
+        self._update_rate_limits(response)
+
+    def _update_rate_limits(self, response):
+        if self.rate_limiter is not None:
+            self.rate_limiter.update_from_headers(getattr(response, 'response_metadata', {}).get('headers'))
+
+    def _parse_batch_response(self, content, texts_by_id):
+        # Models like to wrap JSON answers in markdown fences
+        content = re.sub(r"^```(?:json)?\s*|\s*```$", "", content.strip())
+        try:
+            answer = json.loads(content)
+        except json.JSONDecodeError:
+            self.logger.warning('Could not parse batched extraction answer')
+            return {}
+        if not isinstance(answer, dict):
+            return {}
+        extracted = {}
+        for trial_id, diseases in answer.items():
+            if trial_id not in texts_by_id:
+                continue
+            if isinstance(diseases, list) and all(isinstance(disease, str) for disease in diseases):
+                extracted[trial_id] = parse_disease_list(diseases)
+            elif isinstance(diseases, str):
+                extracted[trial_id] = parse_disease_list(diseases)
+        return extracted
+
 if __name__ == "__main__":
     extractor = DiseaseExtractionTransformation()
     text = "The patient suffers from asthma, hypertension, and diabetes."
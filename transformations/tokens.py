@@ -0,0 +1,96 @@
+"""
+Token counting of the LLM prompts, used to size chunks and batches and to reserve rate limit tokens.
+
+The tiktoken encoding of the model is used when it can be loaded, it is downloaded once and then
+read from TIKTOKEN_CACHE_DIR (the Docker image bakes it in). Without it, e.g. on an offline host,
+tokens are approximated from the words, numbers and punctuation of the text.
+"""
+import re
+import threading
+
+from clients.bootstrap import get_logger
+
+ENCODING_NAME = "o200k_base"  # gpt-4o and gpt-4o-mini
+
+# Words, digit runs and single punctuation signs, roughly how the BPE pre-tokenizer splits text
+_PIECE = re.compile(r"[^\W\d_]+|\d+|[^\w\s]|_")
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """The tiktoken encoding, None when tiktoken or the encoding file is not available."""
+    global _encoding, _encoding_loaded
+    if _encoding_loaded:
+        return _encoding
+    with _encoding_lock:
+        if not _encoding_loaded:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(ENCODING_NAME)
+            except Exception as e:
+                get_logger(__name__).warning(f'tiktoken encoding unavailable, approximating token counts: {str(e)}')
+                _encoding = None
+            _encoding_loaded = True
+        return _encoding
+
+
+def approximate_tokens(text):
+    """Offline token estimate: ~4 letters per word token, 3 digits per number token, 1 per sign."""
+    tokens = 0
+    for piece in _PIECE.findall(text):
+        if piece[0].isdigit():
+            tokens += (len(piece) + 2) // 3
+        elif piece[0].isalpha():
+            tokens += (len(piece) + 3) // 4
+        else:
+            tokens += 1
+    return tokens
+
+
+def count_tokens(text):
+    """Tokens of text for the extraction model."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return approximate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def chunk_by_tokens(text, max_tokens):
+    """
+    Split text into chunks of at most max_tokens, on line boundaries so a criterion is not cut
+    in the middle. A single line longer than max_tokens is split between words.
+    """
+    if count_tokens(text) <= max_tokens:
+        return [text]
+    chunks, chunk, chunk_tokens = [], [], 0
+    for line in text.splitlines():
+        line_tokens = count_tokens(line) + 1
+        pieces = [(line, line_tokens)] if line_tokens <= max_tokens else _split_words(line, max_tokens)
+        for piece, piece_tokens in pieces:
+            if chunk and chunk_tokens + piece_tokens > max_tokens:
+                chunks.append("\n".join(chunk))
+                chunk, chunk_tokens = [], 0
+            chunk.append(piece)
+            chunk_tokens += piece_tokens
+    if chunk:
+        chunks.append("\n".join(chunk))
+    return chunks
+
+
+def _split_words(line, max_tokens):
+    pieces, words, piece_tokens = [], [], 0
+    for word in line.split(" "):
+        word_tokens = count_tokens(word) + 1
+        if words and piece_tokens + word_tokens > max_tokens:
+            pieces.append((" ".join(words), piece_tokens))
+            words, piece_tokens = [], 0
+        words.append(word)
+        piece_tokens += word_tokens
+    if words:
+        pieces.append((" ".join(words), piece_tokens))
+    return pieces
@@ -1,70 +1,166 @@
 from transformations.base_transformations import TransformationStrategy
-import logging
-import sys
+from clients.bootstrap import get_logger
+from clients.metrics import REGISTRY, SIZE_BUCKETS
+from dataclasses import dataclass
+from typing import Any, Optional
+import hashlib
+import json
+import time
+
+UNKNOWN = 'Unknown'
+# Shared stand-in for missing modules, so no placeholder dict is allocated per study
+_EMPTY = {}
+
+MAPPING_SECONDS = REGISTRY.histogram(
+    "study_mapping_seconds", "Time spent mapping the raw studies of one page (or stream) to StudyRecords"
+)
+STUDIES_PER_MAPPING = REGISTRY.histogram(
+    "study_mapping_studies", "Studies mapped per page (or stream)", buckets=SIZE_BUCKETS
+)
+
+
+@dataclass(slots=True)
+class StudyRecord:
+    """
+    Compact in-memory study. Missing source values are None, the 'Unknown' placeholders of the
+    stored documents are only materialized by to_bson.
+    """
+    trialId: Optional[str]
+    title: Optional[str] = None
+    startDate: Optional[str] = None
+    endDate: Optional[str] = None
+    phase: tuple = ()
+    piName: Optional[str] = None
+    piAffiliation: Optional[str] = None
+    # (facility, city, country) tuples
+    locations: tuple = ()
+    eligibilityCriteria: Optional[str] = None
+    lastUpdateDate: Optional[str] = None
+    contentHash: Optional[str] = None
+    # Set by the pipeline enrichment
+    inclusion_criteria: Optional[str] = None
+    diseases: Any = None
+
+    def to_bson(self):
+        document = {
+            "trialId": self.trialId or UNKNOWN,
+            "title": self.title or UNKNOWN,
+            "startDate": self.startDate or UNKNOWN,
+            "endDate": self.endDate or UNKNOWN,
+            "phase": list(self.phase) or [UNKNOWN],
+            "principalInvestigator": {
+                "name": self.piName or UNKNOWN,
+                "affiliation": self.piAffiliation or UNKNOWN,
+            },
+            "locations": [
+                {"facility": facility or UNKNOWN, "city": city or UNKNOWN, "country": country or UNKNOWN}
+                for facility, city, country in self.locations
+            ] or [{"facility": UNKNOWN, "city": UNKNOWN, "country": UNKNOWN}],
+            "eligibilityCriteria": self.eligibilityCriteria or UNKNOWN,
+            "lastUpdateDate": self.lastUpdateDate or UNKNOWN,
+            "contentHash": self.contentHash,
+        }
+        if self.inclusion_criteria is not None:
+            document["inclusion_criteria"] = self.inclusion_criteria
+            document["diseases"] = self.diseases
+        return document
+
+    @classmethod
+    def from_bson(cls, document):
+        """Rebuild a record from a stored document, e.g. to enrich it again."""
+        def known(value):
+            return None if value == UNKNOWN else value
+
+        principal_investigator = document.get("principalInvestigator") or _EMPTY
+        return cls(
+            trialId=known(document.get("trialId")),
+            title=known(document.get("title")),
+            startDate=known(document.get("startDate")),
+            endDate=known(document.get("endDate")),
+            phase=tuple(phase for phase in document.get("phase", ()) if phase != UNKNOWN),
+            piName=known(principal_investigator.get("name")),
+            piAffiliation=known(principal_investigator.get("affiliation")),
+            locations=tuple(
+                (known(location.get("facility")), known(location.get("city")), known(location.get("country")))
+                for location in document.get("locations", ())
+                if any(known(value) for value in location.values())
+            ),
+            eligibilityCriteria=known(document.get("eligibilityCriteria")),
+            lastUpdateDate=known(document.get("lastUpdateDate")),
+            contentHash=document.get("contentHash"),
+            inclusion_criteria=document.get("inclusion_criteria"),
+            diseases=document.get("diseases"),
+        )
+
+
+def compute_content_hash(record):
+    """
+    Stable hash of the source content of a study, used to skip unchanged trials. The
+    LastUpdatePostDate and the enrichment fields are left out on purpose.
+    """
+    content = (
+        record.trialId, record.title, record.startDate, record.endDate, record.phase,
+        record.piName, record.piAffiliation, record.locations, record.eligibilityCriteria,
+    )
+    return hashlib.sha256(json.dumps(content).encode("utf-8")).hexdigest()
+
+
 class ClinicalTrialTransformationMapping(TransformationStrategy):
     def __init__(self):
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
-            handlers=[
-                logging.FileHandler('clinical_trials_processing.log'),
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
-        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger = get_logger(self.__class__.__name__)
 
     def transform(self, raw_studies):
         if not raw_studies:
             self.logger.error("No raw studies provided")
             return []
-        structured_studies = []
+        return list(self.iter_transform(raw_studies))
+
+    def iter_transform(self, raw_studies):
+        """Single pass over raw API studies (a page or a stream), yielding one StudyRecord per study."""
+        count = 0
+        busy = 0.0
         for study in raw_studies:
-            protocol_section = study.get('protocolSection', {})
-            
+            # Only the mapping itself is timed, not the time spent parsing or by the consumer
+            started = time.perf_counter()
+            protocol_section = study.get('protocolSection') or _EMPTY
+
             # Extract modules safely
-            identification_module = protocol_section.get('identificationModule', {})
-            status_module = protocol_section.get('statusModule', {})
-            design_module = protocol_section.get('designModule', {})
-            contacts_locations_module = protocol_section.get('contactsLocationsModule', {})
-            eligibility_module = protocol_section.get('eligibilityModule', {})
+            identification_module = protocol_section.get('identificationModule') or _EMPTY
+            status_module = protocol_section.get('statusModule') or _EMPTY
+            contacts_locations_module = protocol_section.get('contactsLocationsModule') or _EMPTY
 
             # Extract principal investigator info
-            overall_officials = contacts_locations_module.get('overallOfficials', [])
-            pi_info = next((
-                official for official in overall_officials 
-                if official.get('role', '').upper() == 'PRINCIPAL_INVESTIGATOR'
-            ), {})
-
-            structured_study = {
-                "trialId": identification_module.get('nctId', 'Unknown'),
-                "title": identification_module.get('briefTitle', 'Unknown'),
-                "startDate": self._get_date(status_module.get('startDateStruct')),
-                "endDate": self._get_date(status_module.get('completionDateStruct')),
-                "phase": design_module.get('phases', ['Unknown']),
-                "principalInvestigator": {
-                    "name": pi_info.get('name', 'Unknown'),
-                    "affiliation": pi_info.get('affiliation', 'Unknown'),
-                },
-                "locations": self._extract_locations(contacts_locations_module),
-                "eligibilityCriteria": eligibility_module.get('eligibilityCriteria', 'Unknown')
-            }
-            structured_studies.append(structured_study)
-        self.logger.warning(f'Transformed {len(structured_studies)} studies')
-        return structured_studies
-    
-    def _get_date(self, date_struct):
-        if not date_struct:
-            return 'Unknown'
-        return date_struct.get('date', 'Unknown')
-
-    def _extract_locations(self, contacts_locations_module):
-        locations = contacts_locations_module.get('locations', [])
-        return [
-            {
-                "facility": location.get('facility', 'Unknown'),
-                "city": location.get('city', 'Unknown'),
-                "country": location.get('country', 'Unknown'),
-            } for location in locations
-        ] if locations else [{"facility": "Unknown", "city": "Unknown", "country": "Unknown"}]
+            pi_info = _EMPTY
+            for official in contacts_locations_module.get('overallOfficials') or ():
+                if official.get('role', '').upper() == 'PRINCIPAL_INVESTIGATOR':
+                    pi_info = official
+                    break
 
+            record = StudyRecord(
+                trialId=identification_module.get('nctId'),
+                title=identification_module.get('briefTitle'),
+                startDate=self._get_date(status_module.get('startDateStruct')),
+                endDate=self._get_date(status_module.get('completionDateStruct')),
+                phase=tuple((protocol_section.get('designModule') or _EMPTY).get('phases') or ()),
+                piName=pi_info.get('name'),
+                piAffiliation=pi_info.get('affiliation'),
+                locations=tuple(
+                    (location.get('facility'), location.get('city'), location.get('country'))
+                    for location in contacts_locations_module.get('locations') or ()
+                ),
+                eligibilityCriteria=(protocol_section.get('eligibilityModule') or _EMPTY).get('eligibilityCriteria'),
+                lastUpdateDate=self._get_date(status_module.get('lastUpdatePostDateStruct')),
+            )
+            record.contentHash = compute_content_hash(record)
+            count += 1
+            busy += time.perf_counter() - started
+            yield record
+        MAPPING_SECONDS.observe(busy)
+        STUDIES_PER_MAPPING.observe(count)
+        self.logger.warning(f'Transformed {count} studies')
 
+    @staticmethod
+    def _get_date(date_struct):
+        if not date_struct:
+            return None
+        return date_struct.get('date')